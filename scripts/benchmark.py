@@ -0,0 +1,634 @@
+import argparse
+import math
+import time
+import torch
+from utils import dtype
+
+from controllers.mppi_base import Update
+from models.auv_torch import AUVFossen
+from models.ensemble import AUVEnsemble
+from models.auv_nn_torch import AUVNNSpeed
+from models.model_utils import push_to_tensor
+from costs.quadratic import QuadraticForm
+from costs.obstacles import Obstacles, voxelize
+from utils import load_param, get_device
+from getters import get_controller, get_model, get_cost
+import numpy as np
+
+
+def timed(fn, device, iters=10, warmup=3):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(iters):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return np.median(times)
+
+
+def load(samples, tau, lam, upsilon, gamma, device, task="static_cost_auv.yaml", **options):
+    model_dict = load_param("../config/models/rexrov2.default.yaml")
+    cost_dict = load_param(f"../config/tasks/{task}")
+    cont_dict = load_param("../config/controller/state.default.yaml")
+    cont_dict.update(options)
+    sigma = cont_dict["noise"]
+    dt = cont_dict["dt"]
+
+    cost = get_cost(cost_dict, lam, gamma, upsilon, sigma).to(device)
+    model = get_model(model_dict, dt, 0., 0.).to(device)
+    controller = get_controller(cont_dict, model, cost, None,
+                                samples, tau, lam, upsilon, sigma).to(device)
+    return controller
+
+
+def initial_state(device):
+    return torch.tensor([0., 0., 0.,
+                         0., 0., 0., 1.,
+                         0., 0., 0.,
+                         0., 0., 0.], dtype=dtype)[..., None].to(device)
+
+
+'''
+    Elite subset update against the full update on the costs and noise of
+    a real rollout. Reports the median update time, the speed-up and the
+    relative error of the weighted noise.
+'''
+def elite(args, device):
+    controller = load(args.samples, args.tau, args.lam, 1., 0.1, device)
+    s = initial_state(device)[None]
+    A = controller.A[None]
+    with torch.no_grad():
+        noise = controller.noise(args.samples)
+        costs = controller.rollout(s, noise, A)
+
+    full = Update(args.lam)
+    ref, _, ess = full(costs, noise)
+    t_ref = timed(lambda: full(costs, noise), device)
+    print(f"k: {args.samples}, tau: {args.tau}, lam: {args.lam}, ess: {float(ess[0]):.2f}")
+    print(f"full: {t_ref*1e3:.3f} ms")
+
+    modes = [("elite", m, 0.) for m in [10, 50, 200]]
+    modes += [("threshold", 0, th) for th in [1e-3, 1e-6, 1e-9]]
+    for name, m, th in modes:
+        update = Update(args.lam, elite=m, threshold=th)
+        res, _, _ = update(costs, noise)
+        t = timed(lambda: update(costs, noise), device)
+        err = float(torch.linalg.vector_norm(res - ref)/torch.linalg.vector_norm(ref))
+        print(f"{name} {m if m > 0 else th}: {t*1e3:.3f} ms, "
+              f"speedup: {t_ref/t:.2f}x, rel. error: {err:.2e}")
+
+
+def random_batch(k, device):
+    x = torch.randn(k, 13, 1, dtype=dtype, device=device)
+    x[:, 3:7] = x[:, 3:7]/torch.linalg.norm(x[:, 3:7], dim=1, keepdim=True)
+    u = 100.*torch.randn(k, 6, 1, dtype=dtype, device=device)
+    return x, u
+
+
+'''
+    Closed form AUVFossen kernel against the matrix kernel. Checks the
+    parity of the derivatives and of one step, then reports the
+    throughput in states per second, eager and scripted.
+'''
+def dynamics(args, device):
+    model_dict = load_param("../config/models/rexrov2.default.yaml")
+    matrix = AUVFossen(model_dict, 0.1).to(device)
+    closed = AUVFossen(dict(model_dict, kernel="closed_form"), 0.1).to(device)
+
+    x, u = random_batch(args.samples, device)
+    with torch.no_grad():
+        ref = matrix.x_dot(x, u)[..., 0]
+        err = float(torch.max(torch.abs(closed.x_dot_closed(x[..., 0], u[..., 0]) - ref)))
+        step = float(torch.max(torch.abs(closed(x, u) - matrix(x.clone(), u))))
+    print(f"parity, x_dot max error: {err:.2e} (max |x_dot|: {float(torch.max(torch.abs(ref))):.2e}), "
+          f"step max error: {step:.2e}")
+
+    ws = AUVFossen(model_dict, 0.1).to(device)
+    ws.alloc_workspace(args.samples)
+    models = [("matrix", matrix), ("matrix workspace", ws), ("closed_form", closed)]
+    models += [(name + " scripted", torch.jit.script(m)) for name, m in models]
+    base = None
+    with torch.no_grad():
+        for name, m in models:
+            t = timed(lambda: m(x, u), device)
+            base = t if base is None else base
+            print(f"{name}: {args.samples/t:.3e} states/s, speedup: {base/t:.2f}x")
+
+
+'''
+    Accuracy against throughput of the integrators. Every integrator
+    rolls out the same random action sequences over tau steps of dt, the
+    error is measured against rk4 with 64 sub steps.
+'''
+def integrators(args, device):
+    model_dict = load_param("../config/models/rexrov2.default.yaml")
+    cont_dict = load_param("../config/controller/state.default.yaml")
+    sigma = torch.tensor(cont_dict["noise"], dtype=dtype, device=device)
+    dt = cont_dict["dt"]
+
+    x0 = initial_state(device)[None].repeat(args.samples, 1, 1)
+    actions = torch.matmul(sigma, torch.randn(args.tau, args.samples, 6, 1, dtype=dtype, device=device))
+
+    def rollout(model):
+        x = x0
+        for t in range(args.tau):
+            x = model(x, actions[t])
+        return x
+
+    kernel = dict(model_dict, kernel="closed_form")
+    with torch.no_grad():
+        ref = rollout(AUVFossen(dict(kernel, integrator="rk4", substeps=64), dt).to(device))
+        print(f"k: {args.samples}, tau: {args.tau}, dt: {dt}")
+        for integrator in ["euler", "semi_implicit", "rk2", "rk4"]:
+            for substeps in [1, 2, 4]:
+                model = AUVFossen(dict(kernel, integrator=integrator, substeps=substeps), dt).to(device)
+                model = torch.jit.script(model)
+                x = rollout(model)
+                pos = float(torch.max(torch.linalg.norm(x[:, 0:3] - ref[:, 0:3], dim=1)))
+                vel = float(torch.max(torch.linalg.norm(x[:, 7:13] - ref[:, 7:13], dim=1)))
+                t = timed(lambda: rollout(model), device, iters=5, warmup=1)
+                print(f"{integrator} x{substeps}: {args.samples*args.tau/t:.3e} states/s, "
+                      f"max position error: {pos:.2e} m, max velocity error: {vel:.2e}")
+
+
+'''
+    Ensemble of E AUVFossen parameterisations rolled out at once against
+    E separate rollouts of the same members, eager and scripted.
+'''
+def ensemble(args, device):
+    model_dict = dict(load_param("../config/models/rexrov2.default.yaml"), kernel="closed_form")
+    cost_dict = load_param("../config/tasks/static_cost_auv.yaml")
+    cont_dict = load_param("../config/controller/state.default.yaml")
+    sigma = cont_dict["noise"]
+    cost = get_cost(cost_dict, args.lam, 0.1, 1., sigma).to(device)
+
+    s = initial_state(device)[None]
+    print(f"k: {args.samples}, tau: {args.tau}")
+    for E in [2, 4, 8]:
+        # Members with the damping off by up to +-20%.
+        scales = torch.linspace(0.8, 1.2, E).tolist()
+        members = [dict(model_dict, linear_damping=[d*f for d in model_dict["linear_damping"]],
+                        quad_damping=[d*f for d in model_dict["quad_damping"]]) for f in scales]
+        singles = [get_controller(cont_dict, AUVFossen(m, cont_dict["dt"]).to(device), cost, None,
+                                  args.samples, args.tau, args.lam, 1., sigma).to(device) for m in members]
+        ens = get_controller(cont_dict, AUVEnsemble(members, cont_dict["dt"]).to(device), cost, None,
+                             args.samples, args.tau, args.lam, 1., sigma).to(device)
+        A = ens.A[None]
+        with torch.no_grad():
+            noise = ens.noise(args.samples)
+            for name, single, batched in [("eager", singles, ens),
+                                          ("scripted", [torch.jit.script(c) for c in singles], torch.jit.script(ens))]:
+                t_sep = timed(lambda: [c.rollout_cost(s, noise, A) for c in single], device, iters=5, warmup=1)
+                t_ens = timed(lambda: batched.rollout_cost(s, noise, A), device, iters=5, warmup=1)
+                print(f"E={E} {name}: separate {t_sep*1e3:.2f} ms, ensemble {t_ens*1e3:.2f} ms, "
+                      f"speedup: {t_sep/t_ens:.2f}x")
+
+
+'''
+    Rollout of the lagged network on the circular history buffer against
+    the history rebuilt with push_to_tensor at every step.
+'''
+def lagged(args, device):
+    print(f"k: {args.samples}, tau: {args.tau}")
+    for history in [1, 2, 4]:
+        model = AUVNNSpeed({"type": "auv_nn_speed_torch", "history": history}, 0.1).to(device)
+        x0 = initial_state(device)[None, None, :, 0].repeat(args.samples, history, 1)
+        u = torch.randn(args.samples, args.tau + history, 6, dtype=dtype, device=device)
+
+        def rebuilt():
+            x = x0
+            for t in range(args.tau):
+                x = push_to_tensor(x, model(x, u[:, t:t+history]))
+            return x[:, -1]
+
+        ring = torch.zeros(args.samples, history, model.features, dtype=dtype, device=device)
+
+        def circular():
+            for j in range(history - 1):
+                ring[:, j] = model.encode(x0[:, j], u[:, j])
+            x = x0[:, -1]
+            for t in range(args.tau):
+                x = model.step(ring, (history - 1 + t) % history, x, u[:, t + history - 1])
+            return x
+
+        with torch.no_grad():
+            err = float(torch.max(torch.abs(rebuilt() - circular())))
+            t_cat = timed(rebuilt, device, iters=5, warmup=1)
+            t_ring = timed(circular, device, iters=5, warmup=1)
+        print(f"history {history}: push_to_tensor {t_cat*1e3:.2f} ms, ring {t_ring*1e3:.2f} ms, "
+              f"speedup: {t_cat/t_ring:.2f}x, max error: {err:.2e}")
+
+
+'''
+    Rollouts of the lagged network with the reduced inference precisions
+    against float64. The int8 layers are calibrated on the histories of a
+    float64 rollout. Reports the rollout time, the speed-up, the relative
+    error of the velocity change of one step and the largest error of the
+    final states.
+'''
+def quantized(args, device):
+    history = 4
+    print(f"k: {args.samples}, tau: {args.tau}, history: {history}")
+    model = AUVNNSpeed({"type": "auv_nn_speed_torch", "history": history}, 0.1).to(device)
+    x0 = initial_state(device)[None, :, 0].repeat(args.samples, 1)
+    u = torch.randn(args.samples, args.tau + history, 6, dtype=dtype, device=device)
+    ring = torch.zeros(args.samples, history, model.features, dtype=dtype, device=device)
+
+    def rollout(keep=None):
+        x = x0
+        for j in range(history - 1):
+            ring[:, j] = model.encode(x0, u[:, j])
+        xs = [x0]*(history - 1)
+        for t in range(args.tau):
+            x = model.step(ring, (history - 1 + t) % history, x, u[:, t + history - 1])
+            xs.append(x)
+        if keep is not None:
+            keep.append(torch.stack(xs[-history:], dim=1))
+        return x
+
+    with torch.no_grad():
+        hist = []
+        ref = rollout(hist)
+        t_ref = timed(rollout, device, iters=5, warmup=1)
+        hist = hist[0]
+        print(f"float64: {t_ref*1e3:.2f} ms")
+        for precision in ["float32", "bfloat16", "int8"]:
+            if precision == "int8" and device.type != "cpu":
+                continue
+            model.set_inference(precision)
+            report = model.calibrate(hist, u[:, args.tau:args.tau + history])
+            t = timed(rollout, device, iters=5, warmup=1)
+            err = float(torch.max(torch.abs(rollout() - ref)))
+            keep = f", float32 layers: {report['keep']}" if precision == "int8" else ""
+            print(f"{precision}: {t*1e3:.2f} ms, speedup: {t_ref/t:.2f}x, "
+                  f"step error: {report['error']:.2e}, rollout error: {err:.2e}{keep}")
+        model.set_inference()
+
+
+'''
+    Controller precisions against float64. Every controller draws the
+    same float64 noise, cast to its dtype, and is fed the states of a
+    closed loop run of the float64 controller. Reports the time per call,
+    the speed-up and the largest and relative errors of the actions.
+'''
+def precision(args, device):
+    steps = 10
+    print(f"k: {args.samples}, tau: {args.tau}, steps: {steps}")
+
+    def sampler(scale, seed):
+        generator = torch.Generator(device=device)
+        generator.manual_seed(seed)
+
+        def draw(n, k, dev, dt):
+            z = torch.randn(n, k, args.tau, 6, 1, generator=generator, dtype=dtype, device=device)
+            return torch.matmul(scale, z).to(dt)
+        return draw
+
+    ref = None
+    states = None
+    for prec in ["float64", "float32", "mixed"]:
+        controller = load(args.samples, args.tau, args.lam, 1., 0.1, device, precision=prec)
+        scale = controller.noiseScale.to(dtype)
+        controller.set_sampler(sampler(scale, 0))
+        actions = []
+        with torch.no_grad():
+            if states is None:
+                states = [initial_state(device)]
+                for _ in range(steps):
+                    actions.append(controller(states[-1]).to(dtype))
+                    states.append(controller.model(states[-1][None], actions[-1][None])[0])
+            else:
+                actions = [controller(x).to(dtype) for x in states[:-1]]
+            actions = torch.stack(actions)
+            controller.set_sampler(sampler(scale, 1))
+            t = timed(lambda: controller(states[0]), device, iters=5, warmup=1)
+        if ref is None:
+            ref, t_ref = actions, t
+            print(f"{prec}: {t*1e3:.2f} ms")
+            continue
+        err = float(torch.max(torch.abs(actions - ref)))
+        rel = float(torch.linalg.vector_norm(actions - ref)/torch.linalg.vector_norm(ref))
+        print(f"{prec}: {t*1e3:.2f} ms, speedup: {t_ref/t:.2f}x, "
+              f"max action error: {err:.2e}, relative error: {rel:.2e}")
+
+
+'''
+    Rollout with the cost evaluated once per step against the trajectory
+    buffer evaluated in one cost call, eager and scripted. Reports the
+    rollout time, the speed-up and the relative error of the costs.
+'''
+def trajectory(args, device):
+    print(f"k: {args.samples}, tau: {args.tau}")
+    s = initial_state(device)[None]
+    for scripted in [False, True]:
+        res, times = [], []
+        for traj in [False, True]:
+            controller = load(args.samples, args.tau, args.lam, 1., 0.1, device, trajectory=traj)
+            if scripted:
+                controller = torch.jit.script(controller)
+            torch.manual_seed(0)
+            with torch.no_grad():
+                noise = controller.noise(args.samples)
+                A = torch.randn_like(controller.A[None])
+                res.append(controller.rollout(s, noise, A))
+                times.append(timed(lambda: controller.rollout(s, noise, A), device, iters=5, warmup=1))
+        err = float(torch.max(torch.abs(res[1] - res[0]))/torch.max(torch.abs(res[0])))
+        print(f"{'scripted' if scripted else 'eager'}: per step {times[0]*1e3:.2f} ms, "
+              f"trajectory {times[1]*1e3:.2f} ms, speedup: {times[0]/times[1]:.2f}x, rel. error: {err:.2e}")
+
+
+'''
+    Action cost of the horizon with the per step formula against the
+    hoisted one, the nominal term once per step of the horizon and the
+    noise term on the whole noise tensor. Reports the time, the speed-up
+    and the relative error of the summed action costs.
+'''
+def action_cost(args, device):
+    print(f"k: {args.samples}, tau: {args.tau}")
+    controller = load(args.samples, args.tau, args.lam, 2., 0.1, device)
+    cost = controller.cost
+    with torch.no_grad():
+        noise = controller.noise(args.samples)
+        A = 10.*torch.randn_like(controller.A[None])
+
+        def per_step():
+            total = 0.
+            for t in range(args.tau):
+                a = torch.unsqueeze(A[:, t], dim=1)
+                total = total + torch.squeeze(cost.action_cost(a, noise[:, :, t]), dim=(-2, -1))
+            return total
+
+        def hoisted():
+            return torch.sum(cost.action_cost_traj(torch.unsqueeze(A[..., 0], dim=1), noise[..., 0]), dim=-1)
+
+        ref, res = per_step(), hoisted()
+        err = float(torch.max(torch.abs(res - ref))/torch.max(torch.abs(ref)))
+        t_ref = timed(per_step, device)
+        t = timed(hoisted, device)
+    print(f"per step: {t_ref*1e3:.2f} ms, hoisted: {t*1e3:.2f} ms, "
+          f"speedup: {t_ref/t:.2f}x, rel. error: {err:.2e}")
+
+
+'''
+    Structured state weights against the dense weight matrix, on the
+    column states of a rollout step and on the row states of a whole
+    trajectory, for the 13 fields of the AUV state and a larger state.
+    Reports the path taken, the time, the speed-up and the relative error.
+'''
+def state_cost(args, device):
+    print(f"k: {args.samples}, tau: {args.tau}")
+    torch.manual_seed(0)
+    for m in [13, 64]:
+        diag = 100.*torch.rand(m, dtype=dtype)
+        block = torch.diag(diag)
+        w = torch.randn(3, 3, dtype=dtype)
+        block[3:6, 3:6] = torch.matmul(w, w.T)
+        w = torch.randn(4, 4, dtype=dtype)
+        block[7:11, 7:11] = torch.matmul(w, w.T)
+        factor = torch.randn(m, 2, dtype=dtype)
+
+        step = torch.randn(args.samples, m, 1, dtype=dtype, device=device)
+        traj = torch.randn(args.samples, args.tau + 1, m, dtype=dtype, device=device)
+        for name, Q, U in [("diag", diag, None), ("block", block, None),
+                           ("diag+lowrank", diag, factor), ("block+lowrank", block, factor)]:
+            fast = QuadraticForm(Q, U).to(device)
+            dense = QuadraticForm(Q, U, structured=False).to(device)
+            path = fast.structure + ("+lowrank" if fast.lowRank else "")
+            for layout, x, dim in [("step", step, -2), ("trajectory", traj, -1)]:
+                with torch.no_grad():
+                    ref = dense(x, dim)
+                    err = float(torch.max(torch.abs(fast(x, dim) - ref))/torch.max(torch.abs(ref)))
+                    t_ref = timed(lambda: dense(x, dim), device)
+                    t = timed(lambda: fast(x, dim), device)
+                print(f"{m} fields, {name} {layout} ({path}): dense {t_ref*1e3:.3f} ms, "
+                      f"structured {t*1e3:.3f} ms, speedup: {t_ref/t:.2f}x, rel. error: {err:.2e}")
+
+
+'''
+    Ellipse tracking cost. The reference table of the horizon, computed
+    once per control step, against recomputing the reference at the
+    phase of every sample state at every step. Then the tracking cost
+    of the rollout layouts against the per step aos rollout.
+'''
+def tracking(args, device):
+    print(f"k: {args.samples}, tau: {args.tau}")
+    s = initial_state(device)[None]
+    s[:, 0] = 3.
+    controller = load(args.samples, args.tau, args.lam, 1., 0.1, device, task="elipse3d_task.default.yaml")
+    cost = controller.cost
+    with torch.no_grad():
+        states = s[:, None] + 0.1*torch.randn(1, args.samples, 13, 1, dtype=dtype, device=device)
+
+        def table():
+            controller.prepare(s)
+            return [cost.state_cost(states, t + 1) for t in range(args.tau)]
+
+        def per_sample():
+            res = []
+            for t in range(args.tau):
+                # Reference at the phase of every sample.
+                x = states[..., 0]
+                theta = torch.atan2((x[..., 1] - cost.center[1])/cost.b, (x[..., 0] - cost.center[0])/cost.a)
+                theta = theta + cost.phase_rate(theta)*controller.refTimes[t + 1]
+                pos = torch.stack([cost.center[0] + cost.a*torch.cos(theta),
+                                   cost.center[1] + cost.b*torch.sin(theta),
+                                   torch.zeros_like(theta) + cost.center[2]], dim=-1)
+                tangent = torch.stack([-cost.a*torch.sin(theta), cost.b*torch.cos(theta),
+                                       torch.zeros_like(theta)], dim=-1)
+                vel = cost.speed*tangent/torch.linalg.vector_norm(tangent, dim=-1, keepdim=True)
+                res.append(cost.tracking(x, pos, vel, -1))
+            return res
+
+        t_ref = timed(per_sample, device)
+        t = timed(table, device)
+    print(f"cost of the horizon: per sample reference {t_ref*1e3:.2f} ms, "
+          f"reference table {t*1e3:.2f} ms, speedup: {t_ref/t:.2f}x")
+
+    res = {}
+    for name, options in [("aos", {}), ("soa", {"layout": "soa"}), ("trajectory", {"trajectory": True})]:
+        controller = load(args.samples, args.tau, args.lam, 1., 0.1, device,
+                          task="elipse3d_task.default.yaml", **options)
+        torch.manual_seed(0)
+        with torch.no_grad():
+            noise = controller.noise(args.samples)
+            A = torch.randn_like(controller.A[None])
+            controller.prepare(s)
+            res[name] = controller.rollout(s, noise, A)
+            t = timed(lambda: controller.rollout(s, noise, A), device, iters=5, warmup=1)
+        err = float(torch.max(torch.abs(res[name] - res["aos"]))/torch.max(torch.abs(res["aos"])))
+        print(f"{name} rollout: {t*1e3:.2f} ms, rel. error: {err:.2e}")
+
+
+'''
+    Obstacle cost of the states of a rollout, k*tau positions. The
+    distance of every state to every sphere of the scene against the
+    lookup in the signed distance grid of the scene, for growing scenes.
+    Reports the times and the interpolation error of the grid. Then the
+    cost of the rollout layouts with obstacles against the per step aos
+    rollout.
+'''
+def obstacles(args, device):
+    print(f"k: {args.samples}, tau: {args.tau}")
+    rng = np.random.default_rng(0)
+    origin, resolution, shape = [-5., -5., -15.], 0.25, [41, 41, 81]
+    pos = torch.tensor(rng.uniform([-4., -4., -14.], [4., 4., 4.], (args.samples*args.tau, 3)),
+                       dtype=dtype, device=device)
+    sigma = 0.1*np.eye(6)
+    task = get_cost(load_param("../config/tasks/static_cost_auv.yaml"), args.lam, 0.1, 1., sigma)
+    for m in [1, 10, 100, 1000]:
+        centers = rng.uniform([-4., -4., -14.], [4., 4., 4.], (m, 3))
+        radii = rng.uniform(0.2, 1., m)
+        scene = [{"type": "sphere", "center": c, "radius": r} for c, r in zip(centers, radii)]
+        cost = Obstacles(args.lam, 0.1, 1., sigma, task, voxelize(scene, origin, resolution, shape),
+                         origin, resolution).to(device)
+        c = torch.tensor(centers, dtype=dtype, device=device)
+        r = torch.tensor(radii, dtype=dtype, device=device)
+
+        def brute():
+            return torch.amin(torch.cdist(pos, c) - r, dim=-1)
+
+        with torch.no_grad():
+            ref = brute()
+            err = float(torch.max(torch.abs(cost.distance(pos) - ref)))
+            t_ref = timed(brute, device)
+            t = timed(lambda: cost.distance(pos), device)
+        print(f"{m} obstacles: every obstacle {t_ref*1e3:.2f} ms, grid {t*1e3:.2f} ms, "
+              f"speedup: {t_ref/t:.2f}x, max. distance error: {err:.2e}")
+
+    # Above the sphere of the scene, inside its clearance.
+    s = initial_state(device)[None]
+    s[:, 0:3, 0] = torch.tensor([0.5, 1., -3.6], dtype=dtype)
+    res = {}
+    for name, options in [("aos", {}), ("soa", {"layout": "soa"}), ("trajectory", {"trajectory": True})]:
+        controller = load(args.samples, args.tau, args.lam, 1., 0.1, device,
+                          task="static_obstacles_auv.yaml", **options)
+        torch.manual_seed(0)
+        with torch.no_grad():
+            noise = controller.noise(args.samples)
+            A = 10.*torch.randn_like(controller.A[None])
+            controller.prepare(s)
+            res[name] = controller.rollout(s, noise, A)
+            t = timed(lambda: controller.rollout(s, noise, A), device, iters=5, warmup=1)
+        err = float(torch.max(torch.abs(res[name] - res["aos"]))/torch.max(torch.abs(res["aos"])))
+        print(f"{name} rollout: {t*1e3:.2f} ms, rel. error: {err:.2e}")
+
+
+'''
+    Early termination of the samples leaving a depth envelope or falling
+    behind the best sample, against the full rollout, with wide noise so
+    that part of the samples terminate. Reports the skipped sample steps,
+    the time, the speed-up, whether the surviving samples keep their cost
+    and whether the best sample is the same.
+'''
+def termination(args, device):
+    print(f"k: {args.samples}, tau: {args.tau}")
+    s = initial_state(device)[None]
+    s[:, 2] = -2.5
+    full = load(args.samples, args.tau, args.lam, 1., 0.1, device, task="static_obstacles_auv.yaml")
+    torch.manual_seed(0)
+    with torch.no_grad():
+        noise = 5.*full.noise(args.samples)
+        A = torch.randn_like(full.A[None])
+        full.prepare(s)
+        ref = torch.nan_to_num(full.rollout(s, noise, A), nan=math.inf)
+        t_ref = timed(lambda: full.rollout(s, noise, A), device, iters=5, warmup=1)
+    for options in [{"depth": [-3., -2.]}, {"gap": 3e5}, {"depth": [-3., -2.], "gap": 3e5}]:
+        controller = load(args.samples, args.tau, args.lam, 1., 0.1, device,
+                          task="static_obstacles_auv.yaml", terminate=True, **options)
+        with torch.no_grad():
+            controller.prepare(s)
+            res = controller.rollout(s, noise, A)
+            live, skipped, dead = controller.liveSteps, controller.skippedSteps, controller.terminated
+            t = timed(lambda: controller.rollout(s, noise, A), device, iters=5, warmup=1)
+        kept = res == ref
+        print(f"{options}: terminated {dead}, skipped {skipped}/{live + skipped} sample steps, "
+              f"full {t_ref*1e3:.2f} ms, terminated {t*1e3:.2f} ms, speedup: {t_ref/t:.2f}x, "
+              f"survivors kept: {int(kept.sum()) == args.samples - dead}, "
+              f"same best: {int(torch.argmin(res)) == int(torch.argmin(ref))}")
+
+
+'''
+    Scores the samples under several static goals and the ellipse
+    tracking task: one trajectory controller per objective against one
+    shared rollout scored with every objective. Reports the times, the
+    speed-up and the largest difference of the actions for the same
+    noise.
+'''
+def objectives(args, device):
+    print(f"k: {args.samples}, tau: {args.tau}")
+    s = initial_state(device)
+    tasks = []
+    for goal in [[1., 2., -10.], [5., 0., -2.], [-3., 1., -6.]]:
+        task = load_param("../config/tasks/static_cost_auv.yaml")
+        task["goal"][:3] = goal
+        tasks.append(task)
+    tasks.append(load_param("../config/tasks/elipse3d_task.default.yaml"))
+
+    shared = load(args.samples, args.tau, args.lam, 1., 0.1, device, objectives=tasks)
+    separate = []
+    for task in tasks:
+        controller = load(args.samples, args.tau, args.lam, 1., 0.1, device, trajectory=True)
+        controller.cost = get_cost(task, args.lam, 0.1, 1., controller.sigma.cpu().numpy()).to(device)
+        separate.append(controller)
+
+    with torch.no_grad():
+        torch.manual_seed(0)
+        res = shared.score(s)
+        err = 0.
+        for i, controller in enumerate(separate):
+            torch.manual_seed(0)
+            controller.prepare(s[None])
+            noise = controller.noise(args.samples)
+            costs = controller.rollout(s[None], noise, controller.A[None])
+            weighted, _, _ = controller.update(costs, noise)
+            action, _ = controller.shift(torch.add(controller.A[None], controller.expand(weighted)))
+            err = max(err, float(torch.max(torch.abs(action[0] - res["action"][i]))))
+
+        def one_per_objective():
+            for controller in separate:
+                controller.prepare(s[None])
+                noise = controller.noise(args.samples)
+                costs = controller.rollout(s[None], noise, controller.A[None])
+                controller.update(costs, noise)
+
+        t_ref = timed(one_per_objective, device, iters=5, warmup=1)
+        t = timed(lambda: shared.score(s), device, iters=5, warmup=1)
+    print(f"{len(tasks)} objectives: one rollout each {t_ref*1e3:.2f} ms, shared rollout {t*1e3:.2f} ms, "
+          f"speedup: {t_ref/t:.2f}x, max action difference: {err:.2e}")
+
+
+def main():
+    benchmarks = {
+        "elite": elite,
+        "dynamics": dynamics,
+        "integrators": integrators,
+        "ensemble": ensemble,
+        "lagged": lagged,
+        "quantized": quantized,
+        "precision": precision,
+        "trajectory": trajectory,
+        "action_cost": action_cost,
+        "state_cost": state_cost,
+        "tracking": tracking,
+        "obstacles": obstacles,
+        "termination": termination,
+        "objectives": objectives,
+    }
+    parser = argparse.ArgumentParser(description="Controller micro benchmarks.")
+    parser.add_argument("benchmark", choices=list(benchmarks.keys()))
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--tau", type=int, default=20)
+    parser.add_argument("--lam", type=float, default=0.5)
+    args = parser.parse_args()
+
+    device = get_device()
+    benchmarks[args.benchmark](args, device)
+
+
+if __name__ == "__main__":
+    main()
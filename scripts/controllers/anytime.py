@@ -0,0 +1,164 @@
+import time
+import torch
+
+from controllers.mppi_base import ControllerBase
+
+
+class AnytimeController(ControllerBase):
+    '''
+        Deadline aware MPPI controller. The samples are evaluated in
+        batches of chunk samples until either k samples are done or the
+        next batch would overrun the wall-clock budget. The update weights
+        whatever was evaluated through the running log-sum-exp of
+        Update.fold. Between calls k is adapted from the measured time per
+        sample so that the whole budget is used without being late.
+
+        This controller relies on wall-clock timing and is meant to be run
+        eagerly, the model and the cost can still be scripted.
+
+        - input:
+        --------
+            - budget: Float, the wall-clock budget of a control step in
+                seconds.
+            - margin: Float in (0, 1], the fraction of the budget that
+                can be spent on sampling, the rest is kept for the update
+                and the overhead.
+            - kMin: Int, the minimal number of samples per call.
+            - kMax: Int, the maximal number of samples per call.
+            - smoothing: Float in (0, 1], the exponential smoothing factor
+                of the time per sample estimate.
+            - other arguments: see ControllerBase. chunk sets the batch size
+                and defaults to kMin. The controller is always chunked, norm
+                is rejected like for a chunked ControllerBase and there is
+                no workspace.
+    '''
+    def __init__(self,
+                 model,
+                 cost,
+                 observer,
+                 k=1,
+                 tau=1,
+                 lam=1.,
+                 upsilon=1.,
+                 sigma=0.,
+                 n=None,
+                 chunk=None,
+                 backend=None,
+                 sampler=None,
+                 knots=None,
+                 interp="linear",
+                 horizon=None,
+                 norm=False,
+                 elite=0,
+                 threshold=0.,
+                 layout="aos",
+                 trajectory=False,
+                 precision="float64",
+                 terminate=False,
+                 depth=None,
+                 gap=None,
+                 penalty=1e3,
+                 compact=5,
+                 objectives=None,
+                 budget=0.1,
+                 margin=0.8,
+                 kMin=None,
+                 kMax=None,
+                 smoothing=0.5):
+        kMin = kMin if kMin is not None else (chunk if chunk is not None else k)
+        chunk = chunk if chunk is not None else kMin
+        super(AnytimeController, self).__init__(
+            model=model, cost=cost, observer=observer, k=k, tau=tau, lam=lam,
+            upsilon=upsilon, sigma=sigma, n=n, chunk=chunk, backend=backend,
+            sampler=sampler, knots=knots, interp=interp, horizon=horizon,
+            norm=norm, elite=elite, threshold=threshold, layout=layout, trajectory=trajectory,
+            precision=precision, terminate=terminate, depth=depth, gap=gap,
+            penalty=penalty, compact=compact, objectives=objectives)
+        self.budget = budget
+        self.margin = margin
+        self.kMin = kMin
+        self.kMax = kMax if kMax is not None else 100*k
+        self.smoothing = smoothing
+
+        # Time per sample estimate, in seconds.
+        self.sampleTime = None
+        # Statistics of the last call.
+        self.evaluated = 0
+        self.elapsed = 0.
+
+    def control(self, s, A):
+        start = time.perf_counter()
+        deadline = start + self.margin*self.budget
+
+        s = s.to(A.dtype)
+        self.prepare(s)
+        n = s.shape[0]
+        dt = self.update.dtype(A)
+        beta = torch.full((n, 1), float("inf"), dtype=dt, device=A.device)
+        eta = torch.zeros(n, 1, dtype=dt, device=A.device)
+        sq = torch.zeros(n, 1, dtype=dt, device=A.device)
+        acc = torch.zeros(n, self.steps, self.aDim, 1, dtype=dt, device=A.device)
+
+        evaluated = 0
+        while evaluated < self.k:
+            b = min(self.chunk, self.k - evaluated)
+            t0 = time.perf_counter()
+            noises = self.noise(b)
+            if self.drawIndex:
+                self.select_draws(n, evaluated, b)
+            costs = self.rollout(s, noises, A)
+            beta, eta, sq, acc = self.update.fold(costs, noises, beta, eta, sq, acc)
+            self.sync(acc)
+            now = time.perf_counter()
+            evaluated += b
+
+            self.estimate((now - t0)/b)
+            # Stop if the next batch isn't expected to fit.
+            if now + self.sampleTime*min(self.chunk, self.k - evaluated) > deadline:
+                break
+
+        if self.drawIndex:
+            self.select_draws(n, 0, 0)
+        self.ess = torch.squeeze(torch.div(torch.square(eta), sq), dim=-1)
+        weighted = torch.div(acc, eta[..., None, None]).to(A.dtype)
+        next, A_next = self.shift(torch.add(A, self.expand(weighted)))
+        self.sync(next)
+
+        self.evaluated = evaluated
+        self.elapsed = time.perf_counter() - start
+        self.adapt()
+        return next, A_next
+
+    '''
+        Updates the smoothed time per sample.
+
+        input:
+        ------
+            - t: Float, the last measured time per sample in seconds.
+    '''
+    def estimate(self, t):
+        if self.sampleTime is None:
+            self.sampleTime = t
+        else:
+            self.sampleTime = self.smoothing*t + (1. - self.smoothing)*self.sampleTime
+
+    '''
+        Sets k for the next call to the number of samples expected to fit
+        in the sampling budget, rounded down to a multiple of the batch
+        size and clipped to [kMin, kMax].
+    '''
+    def adapt(self):
+        if self.sampleTime is None or self.sampleTime <= 0.:
+            return
+        k = int(self.margin*self.budget/self.sampleTime)
+        k = (k // self.chunk) * self.chunk
+        k = max(self.kMin, min(self.kMax, k))
+        # A randomized model draws one parameter set per sample.
+        if k != self.k and self.drawIndex and self.model.groups == 0:
+            self.model.resample(self.n*k)
+        self.k = k
+
+    def sync(self, tensor):
+        # Kernels are asynchronous on the gpu, wait for them to time.
+        if tensor.is_cuda:
+            torch.cuda.synchronize(tensor.device)
@@ -0,0 +1,132 @@
+import torch
+
+from controllers.mppi_base import ControllerBase
+
+
+class LaggedController(ControllerBase):
+    '''
+        MPPI controller for lagged models whose prediction depends on the
+        last history states and actions, see models.auv_nn_torch.
+
+        The controller records the observed states and the applied
+        actions of the last history - 1 calls. The rollout keeps the
+        encoded history of every sample in a preallocated circular buffer
+        [n*k, history, features]. Step t writes slot (history - 1 + t) %
+        history in place, nothing is shifted or concatenated. Until enough
+        calls are recorded, the missing past steps hold the first
+        observed state with a zero action.
+
+        - input:
+        --------
+            - model: a lagged model with history, features, encode and
+                step.
+            - other arguments: see ControllerBase. The learned model has a
+                fixed step, there is no horizon schedule. The workspace,
+                soa layout and rollout backends aren't supported.
+    '''
+    def __init__(self,
+                 model,
+                 cost,
+                 observer,
+                 k=1,
+                 tau=1,
+                 lam=1.,
+                 upsilon=1.,
+                 sigma=0.,
+                 n=None,
+                 chunk=None,
+                 sampler=None,
+                 knots=None,
+                 interp="linear",
+                 norm=False,
+                 elite=0,
+                 threshold=0.,
+                 precision="float64"):
+        super(LaggedController, self).__init__(
+            model=model, cost=cost, observer=observer, k=k, tau=tau, lam=lam,
+            upsilon=upsilon, sigma=sigma, n=n, chunk=chunk, sampler=sampler,
+            knots=knots, interp=interp, norm=norm, elite=elite, threshold=threshold,
+            precision=precision)
+        self.history = model.history
+        past = self.history - 1
+        dtype = self.A.dtype
+        self.register_buffer("ring", torch.zeros(self.n*self.chunk, self.history, model.features, dtype=dtype))
+        self.register_buffer("pastX", torch.zeros(self.n, past, self.sDim, dtype=dtype))
+        self.register_buffer("pastU", torch.zeros(self.n, past, self.aDim, dtype=dtype))
+        # Slot of the oldest recorded step.
+        self.pastHead = 0
+        self.observed = False
+
+    '''
+        Computes the next action with MPPI and records the observed state
+        and the applied action. Same inputs and outputs as
+        ControllerBase.forward.
+    '''
+    def forward(self, state) -> torch.Tensor:
+        s = state
+        A = self.A
+        if not self.batched:
+            s = torch.unsqueeze(state, dim=0)
+            A = torch.unsqueeze(self.A, dim=0)
+        if not self.observed:
+            self.pastX.copy_(torch.unsqueeze(s[..., 0], dim=1).expand_as(self.pastX))
+            self.pastU.zero_()
+            self.observed = True
+
+        action, A = self.control(s, A)
+        self.record(s, action)
+        if self.batched:
+            self.A = A
+            return action
+        self.A = A[0]
+        return action[0]
+
+    '''
+        Writes the observed state and the applied action in the oldest
+        slot of the recorded past.
+
+        input:
+        ------
+            - s: the observed states. Shape [n, sDim, 1]
+            - action: the applied actions. Shape [n, aDim, 1]
+    '''
+    def record(self, s, action):
+        past = self.history - 1
+        if past == 0:
+            return
+        self.pastX[:, self.pastHead] = s[..., 0]
+        self.pastU[:, self.pastHead] = action[..., 0]
+        self.pastHead = (self.pastHead + 1) % past
+
+    '''
+        Rollout of the samples on the circular history buffer. Same inputs
+        and outputs as ControllerBase.rollout_cost.
+    '''
+    def rollout_cost(self, s, noise, A) -> torch.Tensor:
+        n = s.shape[0]
+        k = noise.shape[1]
+        h = self.history
+        ring = self.ring[:n*k]
+
+        # The recorded past, oldest first, in slots [0, h-1).
+        if h > 1:
+            order = torch.remainder(torch.arange(h - 1, device=s.device) + self.pastHead, h - 1)
+            past = self.model.encode(torch.reshape(self.pastX[:, order], (-1, self.sDim)),
+                                     torch.reshape(self.pastU[:, order], (-1, self.aDim)))
+            ring.view(n, k, h, -1)[:, :, :h-1] = torch.reshape(past, (n, 1, h - 1, -1))
+
+        cost = torch.zeros(n, k, dtype=s.dtype, device=s.device)
+        x = torch.reshape(torch.broadcast_to(torch.unsqueeze(s[..., 0], dim=1), (n, k, self.sDim)),
+                          (n*k, self.sDim))
+
+        # The action cost of the whole horizon is computed at once.
+        e = self.expand(noise)
+        a_cost = self.cost.action_cost_traj(torch.unsqueeze(A[..., 0], dim=1), e[..., 0])
+        act = torch.add(torch.unsqueeze(A, dim=1), e)
+        for t in range(self.tau):
+            x = self.model.step(ring, (h - 1 + t) % h, x, torch.reshape(act[:, :, t], (n*k, self.aDim)))
+            tmp = self.cost(x.view(n, k, self.sDim, 1), step=t + 1)
+            cost = torch.add(cost, torch.add(torch.reshape(tmp, (n, k)), a_cost[:, :, t]))
+
+        f_cost = self.cost(x.view(n, k, self.sDim, 1), final=True)
+        return torch.add(cost, torch.reshape(f_cost, (n, k)))
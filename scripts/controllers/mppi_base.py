@@ -1,5 +1,13 @@
+import math
 import torch
-from utils import dtype
+from typing import Dict, Final, List
+from utils import dtype, precisions
+from controllers.noise import knot_basis
+
+# Python objects plugged in the controllers, rollout backends and noise
+# samplers. Scripting drops the attributes TorchScript can't type, the
+# ignored methods find them here through the pluginKey attribute.
+_plugins = {}
 
 class ControllerBase(torch.nn.Module):
     '''
@@ -8,6 +16,10 @@ class ControllerBase(torch.nn.Module):
         - Input:
         --------
             - model: a model object heritated from the model_base class.
+                An ensemble model (members attribute, see
+                models.ensemble) is rolled out for every member at once
+                and the member costs are aggregated with
+                cost.risk_aggregate.
             - Cost: a cost object heritated from the cost_base class.
             - k: Int, The number of samples used inside the controller.
             - tau: Int, The number of prediction timesteps.
@@ -17,6 +29,76 @@ class ControllerBase(torch.nn.Module):
             - upsilon: Float, The augmented covariance on the noise term.
             - sigma: The noise of the system.
                 Array with shape [aDim, aDim]
+            - n: Int or None, the number of vehicles controlled in one
+                batched call. If None, the controller handles a single
+                vehicle and uses unbatched shapes.
+            - workspace: Bool, if true the noise, the rollout states and
+                actions, the sample costs, the action sequence and the
+                model intermediates are allocated once and reused in
+                place. The cost terms of every step and the update (log-
+                sum-exp, weights, weighted noise) still allocate their
+                small [n, k] and [n, tau, aDim, 1] results, the step isn't
+                allocation free. The returned action is then a view on the
+                workspace and is overwritten by the next call.
+            - chunk: Int or None, if set the k samples are streamed through
+                the model and the cost in blocks of chunk samples. The
+                weighted average is folded with a running log-sum-exp so
+                memory is bounded by the chunk size. Exclusive with
+                workspace.
+            - backend: RolloutBackend or None, computes the sample costs in
+                place of rollout_cost, see controllers.rollout.
+            - sampler: Sampler or None, draws the noise in place of the
+                default generator, see controllers.noise.
+            - knots: Int or None, if set the noise is sampled on knots
+                control points spread over the horizon and interpolated to
+                the tau steps inside the rollout.
+            - interp: String, the knot interpolation, "linear" or "cubic"
+                (uniform cubic B-spline, needs at least 4 knots).
+            - horizon: List of tau floats or None, the duration of every
+                prediction step. Allows fine steps near the present and
+                coarse steps far in the horizon. The first entry is the
+                control period: the sequence is shifted by that duration
+                after each call. The running cost of a step is weighted by
+                its duration relative to the first one. None keeps the
+                uniform steps of the model dt.
+            - norm: Bool, if true the shifted sample costs are normalized
+                to [0, 1] before weighting, simplifies tuning of lambda.
+                Exclusive with chunk.
+            - elite: Int, if positive only the elite lowest cost samples
+                are reduced in the update.
+            - threshold: Float, if positive only the samples with a weight
+                above threshold times the best weight are reduced in the
+                update. See Update.
+            - layout: String, the state layout inside the rollout. "aos"
+                keeps [k, sDim, 1] column vectors, "soa" converts the
+                states, actions and noise once at the rollout boundary to
+                a structure of arrays, [sDim, n*k], where every field is a
+                contiguous row. The model then needs forward_soa and the
+                cost forward_soa. Exclusive with workspace.
+            - trajectory: Bool, if true the rollout writes the states in a
+                [n*k, tau+1, sDim] trajectory buffer and the cost evaluates
+                every step in one cost.trajectory_cost call. aos layout
+                only, exclusive with workspace.
+            - precision: String, float64|float32|mixed. The controller, the
+                model and the cost are cast to the dtype of the precision,
+                the observed states are cast on entry. mixed rolls out in
+                float32 and reduces the update in float64.
+            - terminate: Bool, if true the samples that collide (see
+                CostBase.collision), leave the depth envelope or fall gap
+                behind the best sample stop their rollout. They get the
+                penalty cost and the live samples are compacted every
+                compact steps, the later steps of the model and the cost
+                only run on them. aos layout with a single non randomized
+                model, exclusive with workspace and trajectory.
+            - depth: [min, max] or None, the safe envelope of z.
+            - gap: Float or None, the running cost above the best running
+                cost of the vehicle past which a sample is dropped.
+            - penalty: Float, the cost added to a terminated sample.
+            - compact: Int, the number of steps between compactions.
+            - objectives: list of costs or None, the costs scored by
+                score on one shared rollout, e.g. the costs of other
+                tasks for task switching and monitoring. They don't
+                change the control.
             - initSeq: The inital action sequence.
                 Array of shape [tau, aDim, 1]
             - normalizeCost: Bool, wether or not normalizin the cost,
@@ -34,6 +116,11 @@ class ControllerBase(torch.nn.Module):
                 and logs more information.
 
     '''
+    dts: List[float]
+    # Constant so that scripting drops the unused layout branch, models
+    # and costs only need the methods of the layout they are used with.
+    soa: Final[bool]
+
     def __init__(self,
                  model,
                  cost,
@@ -42,20 +129,92 @@ class ControllerBase(torch.nn.Module):
                  tau=1,
                  lam=1.,
                  upsilon=1.,
-                 sigma=0.):
+                 sigma=0.,
+                 n=None,
+                 workspace=False,
+                 chunk=None,
+                 backend=None,
+                 sampler=None,
+                 knots=None,
+                 interp="linear",
+                 horizon=None,
+                 norm=False,
+                 elite=0,
+                 threshold=0.,
+                 layout="aos",
+                 trajectory=False,
+                 precision="float64",
+                 terminate=False,
+                 depth=None,
+                 gap=None,
+                 penalty=1e3,
+                 compact=5,
+                 objectives=None):
         # TODO: Check parameters and make the tensors.
         super(ControllerBase, self).__init__()
         # This is needed to create a correct trace.
         self.k = k
         self.tau = tau
 
+        # Multi-vehicle batching. Internally every tensor carries a leading
+        # vehicle dimension, the unbatched mode simply uses n = 1.
+        self.batched = n is not None
+        self.n = n if n is not None else 1
+
         self.aDim = 6
         self.sDim = 13
 
         self.register_buffer("sigma", torch.tensor(sigma, dtype=dtype))
         self.register_buffer("upsilon", torch.tensor(upsilon, dtype=dtype))
         self.register_buffer("lam", torch.tensor(lam))
-        self.register_buffer("A", torch.zeros(tau, self.aDim, 1, dtype=dtype))
+        if self.batched:
+            self.register_buffer("A", torch.zeros(self.n, tau, self.aDim, 1, dtype=dtype))
+        else:
+            self.register_buffer("A", torch.zeros(tau, self.aDim, 1, dtype=dtype))
+
+        # Low dimensional noise parametrisation. The noise lives on
+        # `steps` knots and basis maps it to the tau steps.
+        self.knotted = knots is not None
+        self.steps = knots if knots is not None else tau
+        self.interp = interp
+
+        # Non-uniform horizon schedule.
+        self.variableDt = horizon is not None
+        self.dts = []
+        times = None
+        if self.variableDt:
+            if len(horizon) != tau:
+                raise ValueError(f"The horizon schedule has {len(horizon)} steps, expected tau={tau}.")
+            self.dts = [float(h) for h in horizon]
+            dts = torch.tensor(self.dts, dtype=torch.double)
+            times = torch.cumsum(dts, dim=0) - dts
+            self.register_buffer("stepWeights", (dts/dts[0]).to(dtype))
+        else:
+            self.register_buffer("stepWeights", torch.zeros(0, dtype=dtype))
+        # Time of every state of the rollout, indexes the time dependent
+        # tables of the cost, see CostBase.set_reference.
+        if self.variableDt:
+            stepDts = torch.tensor(self.dts, dtype=torch.double)
+        else:
+            stepDts = torch.full((tau,), float(getattr(model, "dt", 0.1)), dtype=torch.double)
+        self.register_buffer("refTimes", torch.cat([torch.zeros(1, dtype=torch.double),
+                                                    torch.cumsum(stepDts, dim=0)]).to(dtype))
+        shiftIdx, self.shiftTail = shift_map(self.dts, tau)
+        self.register_buffer("shiftIdx", shiftIdx)
+
+        if self.knotted:
+            self.register_buffer("basis", knot_basis(tau, knots, interp, times).to(dtype))
+        else:
+            self.register_buffer("basis", torch.zeros(0, dtype=dtype))
+
+        # The noise transform is computed once. A diagonal transform is
+        # applied as an element-wise product instead of a matmul.
+        scale = torch.mul(self.upsilon, self.sigma)
+        self.noiseDiag = scale.dim() < 2 or \
+            bool(torch.count_nonzero(scale - torch.diag_embed(torch.diagonal(scale))) == 0)
+        self.register_buffer("noiseScale", scale)
+        self.register_buffer("noiseDiagScale",
+                             torch.diagonal(scale)[..., None] if scale.dim() == 2 else scale)
 
         # Shift_init.
         self.register_buffer("init", torch.zeros(self.aDim, 1))
@@ -64,55 +223,173 @@ class ControllerBase(torch.nn.Module):
         self.obs = observer
         self.model = model
         self.cost = cost
+        self.objectives = torch.nn.ModuleList(objectives if objectives is not None else [])
+        # Number of members of an ensemble model, 1 for a single model.
+        self.members = getattr(model, "members", 1)
+
+        if precision not in precisions:
+            raise ValueError(f"Unknown precision {precision}, supported are: {'|'.join(precisions)}")
+        self.precision = precision
+        self.update = Update(self.lam, norm, elite, threshold, mixed=precision == "mixed")
+        # Effective sample size of the last update, one per vehicle.
+        self.register_buffer("ess", torch.zeros(self.n, dtype=dtype))
 
-        self.update = Update(self.lam)
+        if workspace and chunk is not None:
+            raise ValueError("workspace and chunk modes are exclusive.")
+        if layout not in ["aos", "soa"]:
+            raise ValueError(f"Unknown layout {layout}, supported are: aos|soa")
+        self.soa = layout == "soa"
+        self.layout = layout
+        if workspace and self.soa:
+            raise ValueError("workspace and soa layout are exclusive.")
+        if trajectory and (workspace or self.soa):
+            raise ValueError("trajectory cost needs the aos layout and is exclusive with workspace.")
+        self.trajectory = trajectory
+        if terminate and (workspace or self.soa or trajectory):
+            raise ValueError("early termination needs the aos layout and is exclusive with workspace and trajectory.")
+        if terminate and (self.members > 1 or getattr(model, "randomized", False)):
+            raise ValueError("early termination doesn't support ensemble or randomized models.")
+        if compact < 1:
+            raise ValueError("The compaction period needs to be at least one step.")
+        self.terminate = terminate
+        self.depthMin = float(depth[0]) if depth is not None else -math.inf
+        self.depthMax = float(depth[1]) if depth is not None else math.inf
+        self.gap = float(gap) if gap is not None else math.inf
+        self.penalty = float(penalty)
+        self.compact = compact
+        # Work counters of the rollouts since the last prepare, in sample
+        # steps: evaluated, skipped and the number of terminated samples.
+        self.liveSteps = 0
+        self.skippedSteps = 0
+        self.terminated = 0
+        if workspace and self.members > 1:
+            raise ValueError("workspace mode doesn't support ensemble models.")
+        if norm and chunk is not None:
+            raise ValueError("cost normalization needs every sample, it can't be chunked.")
+        self.chunked = chunk is not None
+        self.chunk = chunk if chunk is not None else k
+
+        self.pluginKey = id(self)
+        self.useBackend = False
+        if backend is not None:
+            self.set_backend(backend)
+
+        self.useSampler = False
+        if sampler is not None:
+            self.set_sampler(sampler)
+
+        # Casts the controller with its model and cost.
+        self.to(precisions[precision])
+
+        # Preallocated buffers for the steady-state control step. Empty
+        # unless the workspace mode is on, see alloc_workspace.
+        self.workspace = workspace
+        dt = self.A.dtype
+        self.register_buffer("wsRaw", torch.zeros(0, dtype=dt))
+        self.register_buffer("wsNoise", torch.zeros(0, dtype=dt))
+        self.register_buffer("wsE", torch.zeros(0, dtype=dt))
+        self.register_buffer("wsState", torch.zeros(0, dtype=dt))
+        self.register_buffer("wsAct", torch.zeros(0, dtype=dt))
+        self.register_buffer("wsCost", torch.zeros(0, dtype=dt))
+        self.register_buffer("wsA", torch.zeros(0, dtype=dt))
+        self.register_buffer("wsNext", torch.zeros(0, dtype=dt))
+        self.register_buffer("wsShift", torch.zeros(0, dtype=dt))
+        if workspace:
+            self.alloc_workspace()
+            if hasattr(self.model, "alloc_workspace"):
+                self.model.alloc_workspace(self.n*self.k)
+        # Randomized models without draws get one parameter set per sample.
+        # Models loaded with torch.jit.load can't draw, rollout workers get
+        # the draws of the main process.
+        if getattr(self.model, "randomized", False) and hasattr(self.model, "resample") \
+                and self.model.rMass.shape[0] == 0:
+            self.model.resample(self.n*self.k)
+        # Chunks of a randomized model draw the parameter sets of their
+        # global sample indices, like a single rollout of the k samples.
+        self.drawIndex = self.chunked and getattr(self.model, "randomized", False)
+
+    '''
+        Allocates the workspace buffers for the current (k, tau) on the
+        device and dtype of the controller. Needs to be called again if k
+        or tau change.
+    '''
+    @torch.jit.ignore
+    def alloc_workspace(self):
+        n, k, tau = self.n, self.k, self.tau
+        device = self.A.device
+        dt = self.A.dtype
+        self.wsRaw = torch.zeros(n, k, self.steps, self.aDim, 1, dtype=dt, device=device)
+        self.wsNoise = torch.zeros(n, k, self.steps, self.aDim, 1, dtype=dt, device=device)
+        self.wsE = torch.zeros(n, k, self.aDim, 1, dtype=dt, device=device)
+        self.wsState = torch.zeros(n*k, self.sDim, 1, dtype=dt, device=device)
+        self.wsAct = torch.zeros(n, k, self.aDim, 1, dtype=dt, device=device)
+        self.wsCost = torch.zeros(n, k, dtype=dt, device=device)
+        self.wsA = torch.zeros(n, tau, self.aDim, 1, dtype=dt, device=device)
+        self.wsNext = torch.zeros(n, self.aDim, 1, dtype=dt, device=device)
+        if self.variableDt:
+            self.wsShift = torch.zeros(n, tau, self.aDim, 1, dtype=dt, device=device)
 
     '''
         Computes the next action with MPPI.
         input:
         ------
             - state: The current observed state of the system.
-                shape: [StateDim, 1]
+                shape: [StateDim, 1] or [n, StateDim, 1] in batched mode.
         output:
         -------
             - action: the next optimal aciton.
-                shape: [ActionDim, 1]
+                shape: [ActionDim, 1] or [n, ActionDim, 1] in batched mode.
     '''    
     def forward(self, state) -> torch.Tensor:
-        action, self.A = self.control(state, self.A)
-        return action
+        if self.batched:
+            action, self.A = self.control(state, self.A)
+            return action
+
+        action, A = self.control(torch.unsqueeze(state, dim=0),
+                                 torch.unsqueeze(self.A, dim=0))
+        self.A = A[0]
+        return action[0]
 
     '''
         Computes the optimal action sequence with MPPI.
 
         input:
         ------
-            - k: the number of samples to use.
-            - s: the state of the system.
-                shape: [StateDim, 1]
-            - A: the action sequence to optimize.
-                shape: [tau, ActionDim, 1]
+            - s: the state of every vehicle.
+                shape: [n, StateDim, 1]
+            - A: the action sequences to optimize.
+                shape: [n, tau, ActionDim, 1]
+
+        output:
+        -------
+            - next: the next action of every vehicle.
+                shape: [n, ActionDim, 1]
+            - A_next: the shifted action sequences.
+                shape: [n, tau, ActionDim, 1]
     '''
     def control(self, s, A):
+        s = s.to(A.dtype)
+        self.prepare(s)
+        if self.workspace:
+            return self.control_ws(s, A)
+
+        if self.chunked:
+            return self.control_chunked(s, A)
+
         # Compute random noise.
-        noises = self.noise()
+        noises = self.noise(self.k)
 
         # Rollout the model and compute the cost of every sample.
-        costs = self.rollout_cost(s, noises, A)
+        costs = self.rollout(s, noises, A)
         # Compute the update of the action sequence.
-        weighted_noises, eta = self.update(costs, noises)
-        A = torch.add(A, weighted_noises)
-
-        # Get next action.
-        next = A[0].clone()
-
-        # Shift and Update the Action Sequence.
-        A[0] = self.init
-        A_next = torch.roll(A, -1, 0)
+        weighted_noises, eta, ess = self.update(costs, noises)
+        self.ess = ess
+        next, A_next = self.shift(torch.add(A, self.expand(weighted_noises)))
 
         # Log the percent of samples contributing to the decision makeing.
         # self.obs.write_control("state", s)
         # self.obs.write_control("eta", eta)
+        # self.obs.write_control("ess", ess)
         # self.obs.write_control("action", next)
         # self.obs.write_control("sample_cost", costs)
         # self.obs.write_control("sample_weight", weights)
@@ -121,60 +398,691 @@ class ControllerBase(torch.nn.Module):
 
         return next, A_next
 
+    '''
+        Precomputes the time dependent tables of the cost for the control
+        step, e.g. the reference of a tracking cost. The rollouts then
+        index them with the step. Resets the termination counters.
+
+        input:
+        ------
+            - s: the state of every vehicle. shape: [n, StateDim, 1]
+    '''
+    def prepare(self, s):
+        self.cost.set_reference(s, self.refTimes)
+        self.liveSteps = 0
+        self.skippedSteps = 0
+        self.terminated = 0
+
+    '''
+        Chunked variant of control. The samples are generated, rolled out
+        and folded in the update chunk by chunk. Same inputs and outputs.
+    '''
+    def control_chunked(self, s, A):
+        n = s.shape[0]
+        dt = self.update.dtype(A)
+        beta = torch.full((n, 1), float("inf"), dtype=dt, device=A.device)
+        eta = torch.zeros(n, 1, dtype=dt, device=A.device)
+        sq = torch.zeros(n, 1, dtype=dt, device=A.device)
+        acc = torch.zeros(n, self.steps, self.aDim, 1, dtype=dt, device=A.device)
+
+        for i in range(0, self.k, self.chunk):
+            c = min(self.chunk, self.k - i)
+            noises = self.noise(c)
+            if self.drawIndex:
+                self.select_draws(n, i, c)
+            costs = self.rollout(s, noises, A)
+            beta, eta, sq, acc = self.update.fold(costs, noises, beta, eta, sq, acc)
+        if self.drawIndex:
+            self.select_draws(n, 0, 0)
+
+        self.ess = torch.squeeze(torch.div(torch.square(eta), sq), dim=-1)
+        weighted = torch.div(acc, eta[..., None, None]).to(A.dtype)
+        return self.shift(torch.add(A, self.expand(weighted)))
+
+    '''
+        Noise applied at a given step of the rollout. With knots, the knot
+        noise is interpolated on the fly.
+
+        input:
+        ------
+            - noise: the noise of every sample.
+                Shape: [n, k, steps, aDim, 1]
+            - t: Int, the rollout step.
+
+        output:
+        -------
+            - the noise at step t. Shape: [n, k, aDim, 1]
+    '''
+    def step_noise(self, noise, t: int):
+        if self.knotted:
+            return torch.unsqueeze(
+                torch.matmul(self.basis[t], torch.squeeze(noise, dim=-1)), dim=-1)
+        return noise[:, :, t]
+
+    '''
+        Maps a per knot sequence, typically the weighted noise, to the tau
+        steps. Identity without knots.
+
+        input:
+        ------
+            - seq: Shape [n, steps, aDim, 1]
+
+        output:
+        -------
+            - Shape [n, tau, aDim, 1]
+    '''
+    def expand(self, seq):
+        if self.knotted:
+            return torch.unsqueeze(
+                torch.matmul(self.basis, torch.squeeze(seq, dim=-1)), dim=-1)
+        return seq
+
+    '''
+        Extracts the next action and shifts the action sequences by one
+        control period, the actions past the horizon are reset to init.
+        With a non-uniform horizon every step takes the action held at
+        its start time one period later.
+
+        input:
+        ------
+            - A: the updated action sequences.
+                shape: [n, tau, ActionDim, 1]
+
+        output:
+        -------
+            - next: the next action of every vehicle.
+                shape: [n, ActionDim, 1]
+            - A_next: the shifted action sequences.
+                shape: [n, tau, ActionDim, 1]
+    '''
+    def shift(self, A):
+        # Get next action.
+        next = A[:, 0].clone()
+
+        # Shift and Update the Action Sequence.
+        if self.variableDt:
+            A_next = torch.index_select(A, 1, self.shiftIdx)
+            A_next[:, self.tau - self.shiftTail:] = self.init
+            return next, A_next
+
+        A[:, 0] = self.init
+        A_next = torch.roll(A, -1, 1)
+        return next, A_next
+
     '''
         Noise generator for the samples.
 
         input:
         ------
-            - k: the number of samples
-        
+            - k: the number of samples to generate per vehicle.
+
         output:
         -------
             - the noise associated with each samples ~ \mathcal{N}(\mu, \Sigma)
-                Shape, [k, tau, aDim, 1]
+                Shape, [n, k, steps, aDim, 1], steps is tau without knots.
+    '''
+    def noise(self, k: int):
+        if self.useSampler:
+            return self.sample(k)
+
+        n = torch.randn((self.n, k, self.steps, self.aDim, 1),
+                        dtype=self.noiseScale.dtype, device=self.noiseScale.device)
+        if self.noiseDiag:
+            return torch.mul(self.noiseDiagScale, n)
+        return torch.matmul(self.noiseScale, n)
+
+    '''
+        Points the rows of the next rollout at the parameter sets of the
+        samples [lo, lo + c) of every vehicle, sample j of vehicle i is
+        the global sample i*k + j. c = 0 restores the row order. Without
+        groups the model needs one parameter set per global sample, the
+        sets of another sample or vehicle are never reused.
+
+        input:
+        ------
+            - n: Int, the number of vehicles.
+            - lo: Int, the global index of the first sample of the chunk.
+            - c: Int, the number of samples of the chunk.
+    '''
+    @torch.jit.ignore
+    def select_draws(self, n: int, lo: int, c: int):
+        device = self.model.rIndex.device
+        if c == 0:
+            self.model.rIndex = torch.zeros(0, dtype=torch.long, device=device)
+            return
+        if self.model.groups == 0 and self.model.rMass.shape[0] < n*self.k:
+            raise RuntimeError(f"The model holds {self.model.rMass.shape[0]} parameter sets for "
+                               f"{n*self.k} samples, call resample(n*k) when k changes.")
+        idx = torch.arange(n, device=device)[:, None]*self.k + torch.arange(lo, lo + c, device=device)[None]
+        self.model.rIndex = torch.reshape(idx, (-1,))
+
+    '''
+        Plugs a noise sampler, None restores the default generator.
+
+        input:
+        ------
+            - sampler: Sampler or None.
+    '''
+    @torch.jit.ignore
+    def set_sampler(self, sampler):
+        _plugins[(self.pluginKey, "sampler")] = sampler
+        self.useSampler = sampler is not None
+
+    @torch.jit.ignore
+    def sample(self, k: int) -> torch.Tensor:
+        sampler = _plugins[(self.pluginKey, "sampler")]
+        return sampler(self.n, k, self.noiseScale.device, self.noiseScale.dtype)
+
+    '''
+        Plugs a rollout backend, None restores rollout_cost.
+
+        input:
+        ------
+            - backend: RolloutBackend or None.
+    '''
+    @torch.jit.ignore
+    def set_backend(self, backend):
+        _plugins[(self.pluginKey, "backend")] = backend
+        self.useBackend = backend is not None
+
+    '''
+        Dispatches the rollout to the backend if one is set, otherwise to
+        rollout_cost. Same inputs and outputs as rollout_cost.
     '''
-    def noise(self):
-        n = torch.normal(mean=torch.zeros(self.k, self.tau, self.aDim, 1, dtype=torch.double),
-                         std=torch.ones(self.k, self.tau, self.aDim, 1, dtype=torch.double)).to(self.upsilon.device)
-        noise = torch.matmul(self.upsilon*self.sigma, n)
-        return noise
+    def rollout(self, s, noise, A) -> torch.Tensor:
+        if self.useBackend:
+            return self.backend_rollout(s, noise, A)
+        return self.rollout_cost(s, noise, A)
+
+    @torch.jit.ignore
+    def backend_rollout(self, s, noise, A) -> torch.Tensor:
+        return _plugins[(self.pluginKey, "backend")](self, s, noise, A)
 
     '''
         Computes the rollout of samples and it's associated cost.
 
+        The n vehicles and k samples are flattened into a single [n*k] batch
+        so that the model is evaluated once per timestep for the whole fleet.
+        The cost sees the same batch viewed as [n, k].
+
         input:
         ------
-            - s: the inital state of the system.
-                Shape: [sDim, 1]
+            - s: the inital state of every vehicle.
+                Shape: [n, sDim, 1]
             - noise: The noise generated for each sample and applied for the rollout.
-                Shape: [k, tau, aDim, 1]
-            - A: the action sequence. The mean to apply.
-                Shape: [tau, aDim, 1]
+                Shape: [n, k, steps, aDim, 1]
+            - A: the action sequences. The mean to apply.
+                Shape: [n, tau, aDim, 1]
 
         output:
         -------
             - costs: Cost tensor of each rollout. 
-                Shape: [k/1]
+                Shape: [n, k]
     '''
     def rollout_cost(self, s, noise, A) -> torch.Tensor:
-        s = torch.unsqueeze(s, dim=0)
-        cost = torch.zeros(self.k).to(s.device)
-        s = torch.broadcast_to(s, (self.k, self.sDim, 1))
+        if self.soa:
+            return self.rollout_cost_soa(s, noise, A)
+        if self.trajectory:
+            return self.rollout_cost_traj(s, noise, A)
+        if self.terminate:
+            return self.rollout_cost_term(s, noise, A)
 
+        n = s.shape[0]
+        k = noise.shape[1]
+        # The E ensemble members roll out member-major [E*n*k] states.
+        E = self.members
+        cost = torch.zeros(E, n, k, dtype=s.dtype, device=s.device)
+        s = torch.broadcast_to(torch.unsqueeze(torch.unsqueeze(s, dim=1), dim=0), (E, n, k, self.sDim, 1))
+        s = torch.reshape(s, (E*n*k, self.sDim, 1))
+
+        # The action cost of the whole horizon is computed at once, the
+        # steps only evaluate the state cost.
+        e = self.expand(noise)
+        a_cost = self.cost.action_cost_traj(torch.unsqueeze(A[..., 0], dim=1), e[..., 0])
+        act = torch.add(torch.unsqueeze(A, dim=1), e)
         for t in range(self.tau):
-            a = A[t]
-            n = noise[:, t]
-            act = torch.add(a, n)
+            if self.variableDt:
+                next_s = self.model(s, torch.reshape(act[:, :, t], (n*k, self.aDim, 1)), dt=self.dts[t])
+            else:
+                next_s = self.model(s, torch.reshape(act[:, :, t], (n*k, self.aDim, 1)))
+            tmp = torch.add(torch.reshape(self.cost(torch.reshape(next_s, (E, n, k, self.sDim, 1)), step=t + 1),
+                                          (E, n, k)),
+                            a_cost[:, :, t])
+            if self.variableDt:
+                tmp = torch.mul(tmp, self.stepWeights[t])
 
-            next_s = self.model(s, act)
-            tmp = self.cost(next_s, a, n)
+            cost = torch.add(cost, tmp)
+            s = next_s
+
+        f_cost = self.cost(torch.reshape(s, (E, n, k, self.sDim, 1)), final=True)
+        cost = torch.add(cost, torch.reshape(f_cost, (E, n, k)))
+        return self.aggregate(cost)
+
+    '''
+        Structure of arrays variant of rollout_cost. Same inputs and
+        outputs. The initial states, the action sequences and the noise
+        are converted once, the model then steps [sDim, n*k] states and
+        the cost sees the [sDim, n, k] view of them. The members of an
+        ensemble are stacked along n for the cost.
+    '''
+    def rollout_cost_soa(self, s, noise, A) -> torch.Tensor:
+        n = s.shape[0]
+        k = noise.shape[1]
+        E = self.members
+        cost = torch.zeros(E*n, k, dtype=s.dtype, device=s.device)
+        x = self.to_soa(s, k)
+        if E > 1:
+            x = x.repeat(1, E)
+        # Action cost of the whole horizon, [tau, E*n, k].
+        a_cost = self.cost.action_cost_traj(torch.unsqueeze(A[..., 0], dim=1), self.expand(noise)[..., 0])
+        a_cost = torch.permute(a_cost, (2, 0, 1))
+        if E > 1:
+            a_cost = a_cost.repeat(1, E, 1)
+        # [steps, aDim, n, k] and [tau, aDim, n, 1].
+        noise = torch.permute(noise[..., 0], (2, 3, 0, 1)).contiguous()
+        A = torch.unsqueeze(torch.permute(A[..., 0], (1, 2, 0)), dim=-1)
+
+        for t in range(self.tau):
+            a = A[t]
+            if self.knotted:
+                e = torch.tensordot(self.basis[t], noise, dims=1)
+            else:
+                e = noise[t]
+            act = torch.reshape(torch.add(a, e), (self.aDim, n*k))
 
+            if self.variableDt:
+                x = self.model.forward_soa(x, act, dt=self.dts[t])
+            else:
+                x = self.model.forward_soa(x, act)
+            tmp = torch.add(self.cost.forward_soa(torch.reshape(x, (self.sDim, E*n, k)), step=t + 1), a_cost[t])
+            if self.variableDt:
+                tmp = torch.mul(tmp, self.stepWeights[t])
             cost = torch.add(cost, tmp)
+
+        f_cost = self.cost.forward_soa(torch.reshape(x, (self.sDim, E*n, k)), final=True)
+        return self.aggregate(torch.reshape(torch.add(cost, f_cost), (E, n, k)))
+
+    '''
+        Trajectory variant of rollout_cost. Same inputs and outputs. The
+        rollout only steps the model and writes the states in a
+        trajectory buffer, the cost of every step is then computed in one
+        cost.trajectory_cost call on the whole buffer.
+    '''
+    def rollout_cost_traj(self, s, noise, A) -> torch.Tensor:
+        traj, e = self.rollout_traj(s, noise, A)
+        cost = self.cost.trajectory_cost(traj, torch.unsqueeze(A[..., 0], dim=1), e, self.traj_weights(A))
+        return self.aggregate(cost)
+
+    '''
+        Steps the model for every sample and keeps the states.
+
+        input:
+        ------
+            - s, noise, A: see rollout_cost.
+
+        output:
+        -------
+            - traj: the initial state followed by the state reached at
+                every step. Shape: [E, n, k, tau+1, sDim]
+            - e: the noise of every step. Shape: [n, k, tau, aDim]
+    '''
+    def rollout_traj(self, s, noise, A):
+        n = s.shape[0]
+        k = noise.shape[1]
+        E = self.members
+        traj = torch.empty(E*n*k, self.tau + 1, self.sDim, dtype=s.dtype, device=s.device)
+        s = torch.broadcast_to(torch.unsqueeze(torch.unsqueeze(s, dim=1), dim=0), (E, n, k, self.sDim, 1))
+        s = torch.reshape(s, (E*n*k, self.sDim, 1))
+        traj[:, 0] = s[..., 0]
+
+        # [n, k, tau, aDim], the noise of every step.
+        e = self.expand(noise)[..., 0]
+        act = torch.add(torch.unsqueeze(A[..., 0], dim=1), e)
+        for t in range(self.tau):
+            a = torch.reshape(act[:, :, t], (n*k, self.aDim, 1))
+            if self.variableDt:
+                s = self.model(s, a, dt=self.dts[t])
+            else:
+                s = self.model(s, a)
+            traj[:, t + 1] = s[..., 0]
+        return torch.reshape(traj, (E, n, k, self.tau + 1, self.sDim)), e
+
+    def traj_weights(self, A):
+        # The weight of the running cost of every step.
+        if self.variableDt:
+            return self.stepWeights
+        return torch.ones(self.tau, dtype=A.dtype, device=A.device)
+
+    '''
+        Scores one rollout under every objective. The samples are rolled
+        out once and the trajectories kept, every objective then costs
+        them in one trajectory_cost call and reduces them with the update
+        of the controller. The action sequence of the controller isn't
+        changed. The rollout steps the model on the aos layout, like the
+        trajectory rollout, in the process and without early termination.
+
+        input:
+        ------
+            - state: the observed state.
+                shape: [StateDim, 1] or [n, StateDim, 1] in batched mode.
+
+        output:
+        -------
+            - Dict of the N objectives stacked along the first dimension,
+                without n in unbatched mode:
+                - action: the next action. Shape [N, n, aDim, 1]
+                - sequence: the shifted action sequence, ready to replace
+                    A. Shape [N, n, tau, aDim, 1]
+                - min, mean: the lowest and the mean sample cost. Shape
+                    [N, n]
+                - ess: the effective sample size. Shape [N, n]
+    '''
+    @torch.jit.export
+    def score(self, state) -> Dict[str, torch.Tensor]:
+        if self.batched:
+            s = state.to(self.A.dtype)
+            A = self.A
+        else:
+            s = torch.unsqueeze(state, dim=0).to(self.A.dtype)
+            A = torch.unsqueeze(self.A, dim=0)
+        if len(self.objectives) == 0:
+            raise ValueError("The controller has no objectives to score.")
+
+        noises = self.noise(self.k)
+        traj, e = self.rollout_traj(s, noises, A)
+        a = torch.unsqueeze(A[..., 0], dim=1)
+        weights = self.traj_weights(A)
+
+        actions, sequences, lows, means, esss = [], [], [], [], []
+        for objective in self.objectives:
+            objective.set_reference(s, self.refTimes)
+            costs = objective.trajectory_cost(traj, a, e, weights)
+            costs = costs[0] if self.members == 1 else objective.risk_aggregate(costs)
+            weighted_noises, eta, ess = self.update(costs, noises)
+            next, A_next = self.shift(torch.add(A, self.expand(weighted_noises)))
+            actions.append(next)
+            sequences.append(A_next)
+            lows.append(torch.amin(costs, dim=1))
+            means.append(torch.mean(costs, dim=1))
+            esss.append(ess)
+
+        res = {"action": torch.stack(actions), "sequence": torch.stack(sequences),
+               "min": torch.stack(lows), "mean": torch.stack(means), "ess": torch.stack(esss)}
+        if not self.batched:
+            for key in res.keys():
+                res[key] = res[key][:, 0]
+        return res
+
+    '''
+        Early termination variant of rollout_cost. Same inputs and outputs.
+
+        The live samples of every vehicle are tracked by their index in
+        ids [n, kk]. A terminated sample gets the penalty, its running
+        cost is then frozen and it is masked out of the costs. As it
+        misses the cost of the rest of the horizon, it ends at least at
+        the cost of the worst surviving sample of the vehicle plus the
+        penalty, it ranks behind every surviving sample. The best and
+        worst samples are those of the rollout call: per chunk or per
+        backend shard when the samples are split.
+
+        Every compact steps the live samples are moved to the front and
+        kk shrinks to the largest live count of the vehicles, the dead
+        samples are then no longer stepped. The vehicles with fewer live
+        samples keep masked padding to stay rectangular.
+    '''
+    def rollout_cost_term(self, s, noise, A) -> torch.Tensor:
+        n = s.shape[0]
+        k = noise.shape[1]
+        cost = torch.zeros(n, k, dtype=s.dtype, device=s.device)
+        ids = torch.broadcast_to(torch.arange(k, device=s.device), (n, k))
+        alive = torch.ones(n, k, dtype=torch.bool, device=s.device)
+        kk = k
+        x = torch.reshape(torch.broadcast_to(torch.unsqueeze(s, dim=1), (n, k, self.sDim, 1)),
+                          (n*k, self.sDim, 1))
+
+        e = self.expand(noise)
+        a_cost = self.cost.action_cost_traj(torch.unsqueeze(A[..., 0], dim=1), e[..., 0])
+        act = torch.add(torch.unsqueeze(A, dim=1), e)
+        for t in range(self.tau):
+            if kk < k:
+                a = torch.gather(act[:, :, t], 1, ids[..., None, None].expand(n, kk, self.aDim, 1))
+                step_a_cost = torch.gather(a_cost[:, :, t], 1, ids)
+            else:
+                a = act[:, :, t]
+                step_a_cost = a_cost[:, :, t]
+            if self.variableDt:
+                x = self.model(x, torch.reshape(a, (n*kk, self.aDim, 1)), dt=self.dts[t])
+            else:
+                x = self.model(x, torch.reshape(a, (n*kk, self.aDim, 1)))
+            self.liveSteps += n*kk
+            self.skippedSteps += n*(k - kk)
+
+            states = x.view(n, kk, self.sDim, 1)
+            tmp = torch.add(torch.reshape(self.cost(states, step=t + 1), (n, kk)), step_a_cost)
+            if self.variableDt:
+                tmp = torch.mul(tmp, self.stepWeights[t])
+            cost.scatter_add_(1, ids, torch.where(alive, tmp, torch.zeros_like(tmp)))
+
+            # Termination of the live samples.
+            running = torch.gather(cost, 1, ids)
+            best = torch.amin(torch.where(alive, running, torch.full_like(running, math.inf)),
+                              dim=1, keepdim=True)
+            z = states[:, :, 2, 0]
+            dead = self.cost.collision(states) | (z < self.depthMin) | (z > self.depthMax) | \
+                (running > best + self.gap)
+            dead = dead & alive
+            cost.scatter_add_(1, ids, torch.mul(dead.to(cost.dtype), self.penalty))
+            self.terminated += int(torch.count_nonzero(dead))
+            alive = alive & ~dead
+
+            if (t + 1) % self.compact == 0 and t + 1 < self.tau:
+                live = int(torch.amax(torch.sum(alive, dim=1)))
+                if live == 0:
+                    self.skippedSteps += n*k*(self.tau - t - 1)
+                    return self.rank_terminated(cost, ids, alive)
+                if live < kk:
+                    # Live samples first, stable to keep the padding last.
+                    order = torch.sort((~alive).to(torch.int8), dim=1, stable=True)[1][:, :live]
+                    ids = torch.gather(ids, 1, order)
+                    alive = torch.gather(alive, 1, order)
+                    x = torch.reshape(torch.gather(states, 1, order[..., None, None].expand(n, live, self.sDim, 1)),
+                                      (n*live, self.sDim, 1))
+                    kk = live
+
+        f_cost = torch.reshape(self.cost(x.view(n, kk, self.sDim, 1), final=True), (n, kk))
+        cost.scatter_add_(1, ids, torch.where(alive, f_cost, torch.zeros_like(f_cost)))
+        return self.rank_terminated(cost, ids, alive)
+
+    '''
+        Raises the cost of the terminated samples to at least the cost of
+        the worst surviving sample of their vehicle plus the penalty.
+
+        input:
+        ------
+            - cost: the costs of the samples. Shape [n, k]
+            - ids: the tracked samples. Shape [n, kk]
+            - alive: the live tracked samples. Shape [n, kk]
+
+        output:
+        -------
+            - the costs. Shape [n, k]
+    '''
+    def rank_terminated(self, cost, ids, alive):
+        live = torch.zeros_like(cost, dtype=torch.bool).scatter_(1, ids, alive)
+        worst = torch.amax(torch.where(live, cost, torch.full_like(cost, -math.inf)), dim=1, keepdim=True)
+        return torch.where(live, cost, torch.maximum(cost, worst + self.penalty))
+
+    '''
+        Aggregates the costs of the members of an ensemble model with the
+        risk aggregate of the cost.
+
+        input:
+        ------
+            - costs: the cost of every sample under every member.
+                Shape: [E, n, k]
+
+        output:
+        -------
+            - costs: Shape: [n, k]
+    '''
+    def aggregate(self, costs):
+        if self.members == 1:
+            return costs[0]
+        return self.cost.risk_aggregate(costs)
+
+    '''
+        Converts the states of the n vehicles to the structure of arrays
+        layout and broadcasts them to the k samples.
+
+        input:
+        ------
+            - s: the states. Shape [n, sDim, 1]
+            - k: Int, the number of samples.
+
+        output:
+        -------
+            - the states, one contiguous row per field. Shape [sDim, n*k]
+    '''
+    def to_soa(self, s, k: int):
+        n = s.shape[0]
+        x = torch.broadcast_to(torch.unsqueeze(torch.transpose(s[..., 0], 0, 1), dim=-1),
+                               (self.sDim, n, k))
+        return torch.reshape(x, (self.sDim, n*k))
+
+    '''
+        Workspace variant of control. Same inputs and outputs. The noise,
+        the rollout states and the action sequence are written in the
+        preallocated buffers. A is shifted in place. The cost and the
+        update allocate their results as in control.
+    '''
+    def control_ws(self, s, A):
+        noises = self.noise_ws()
+        costs = self.rollout_cost_ws(s, noises, A)
+        weighted_noises, eta, ess = self.update(costs, noises)
+        self.ess = ess
+        torch.add(A, self.expand(weighted_noises), out=self.wsA)
+
+        self.wsNext.copy_(self.wsA[:, 0])
+
+        keep = self.tau - self.shiftTail
+        if self.variableDt:
+            torch.index_select(self.wsA, 1, self.shiftIdx, out=self.wsShift)
+            A[:, :keep].copy_(self.wsShift[:, :keep])
+        else:
+            A[:, :-1].copy_(self.wsA[:, 1:])
+        A[:, keep:] = self.init
+        return self.wsNext, A
+
+    '''
+        Workspace variant of the noise generator, samples in place.
+
+        output:
+        -------
+            - the noise buffer ~ \mathcal{N}(\mu, \Sigma)
+                Shape, [n, k, steps, aDim, 1]
+    '''
+    def noise_ws(self):
+        if self.useSampler:
+            self.wsNoise.copy_(self.sample(self.k))
+            return self.wsNoise
+
+        self.wsRaw.normal_()
+        if self.noiseDiag:
+            torch.mul(self.noiseDiagScale, self.wsRaw, out=self.wsNoise)
+        else:
+            torch.matmul(self.noiseScale, self.wsRaw, out=self.wsNoise)
+        return self.wsNoise
+
+    '''
+        Workspace variant of rollout_cost. Same inputs and outputs, the
+        returned costs are the workspace cost buffer.
+    '''
+    def rollout_cost_ws(self, s, noise, A) -> torch.Tensor:
+        n = s.shape[0]
+        self.wsCost.zero_()
+        self.wsState.view(n, self.k, self.sDim, 1).copy_(torch.unsqueeze(s, dim=1))
+        s = self.wsState
+        act = self.wsAct.view(n*self.k, self.aDim, 1)
+
+        e = self.wsE
+        for t in range(self.tau):
+            a = torch.unsqueeze(A[:, t], dim=1)
+            if self.knotted:
+                torch.matmul(self.basis[t], noise[..., 0], out=e[..., 0])
+            else:
+                e = noise[:, :, t]
+            torch.add(a, e, out=self.wsAct)
+
+            if self.variableDt:
+                next_s = self.model(s, act, dt=self.dts[t])
+            else:
+                next_s = self.model(s, act)
+            tmp = self.cost(next_s.view(n, self.k, self.sDim, 1), a, e, step=t + 1)
+            if self.variableDt:
+                tmp = torch.mul(tmp, self.stepWeights[t])
+
+            self.wsCost.add_(tmp.view(n, self.k))
             s = next_s
 
-        f_cost = self.cost(s, A[-1], noise[:, -1], final=True)
-        cost = torch.add(cost, f_cost)
-        return cost
+        f_cost = self.cost(s.view(n, self.k, self.sDim, 1),
+                           torch.unsqueeze(A[:, -1], dim=1), e, final=True)
+        self.wsCost.add_(f_cost.view(n, self.k))
+        return self.wsCost
+
+def rollout_config(controller):
+    '''
+        The constructor arguments needed to rebuild the rollout of a
+        controller, used by the rollout backends. Only reads attributes so
+        that it works on scripted controllers too.
+    '''
+    return {"knots": controller.steps if controller.knotted else None,
+            "interp": controller.interp,
+            "horizon": list(controller.dts) if controller.variableDt else None,
+            "layout": controller.layout,
+            "trajectory": controller.trajectory,
+            "precision": controller.precision,
+            "terminate": controller.terminate,
+            "depth": [controller.depthMin, controller.depthMax],
+            "gap": controller.gap,
+            "penalty": controller.penalty,
+            "compact": controller.compact}
+
+
+def shift_map(dts, tau):
+    '''
+        Index map of the action sequence shift by one control period.
+
+        input:
+        ------
+            - dts: List of floats, the step durations, empty for uniform
+                steps.
+            - tau: Int, the number of steps.
+
+        output:
+        -------
+            - idx: torch.Tensor, the step of the current sequence held by
+                every step of the shifted one. Shape [tau]
+            - tail: Int, the number of last steps falling past the horizon,
+                they are reset to init.
+    '''
+    if len(dts) == 0:
+        dts = [1.]*tau
+    starts = [0.]
+    for h in dts[:-1]:
+        starts.append(starts[-1] + h)
+    end = starts[-1] + dts[-1]
+    # Tolerance on the step boundaries for the float sums.
+    eps = 1e-9*end
+
+    idx = []
+    for t in starts:
+        target = t + dts[0]
+        if target >= end - eps:
+            break
+        idx.append(max(j for j, s in enumerate(starts) if s <= target + eps))
+    tail = tau - len(idx)
+    return torch.tensor(idx + [0]*tail, dtype=torch.long), tail
+
 
 class Update(torch.nn.Module):
     '''
@@ -183,36 +1091,89 @@ class Update(torch.nn.Module):
         input:
         ------
             - lam: float, the inverse temperature \lambda
+            - norm: bool, if true the shifted costs are normalized to
+                [0, 1] before the exponential. Default: False
+            - elite: int, if positive only the elite samples with the
+                lowest costs enter the weighted noise. Default: 0
+            - threshold: float, if positive only the samples with a weight
+                of at least threshold times the best weight enter the
+                weighted noise. Combined with elite, elite caps their
+                number. Default: 0.
+            - mixed: bool, if true the costs and the noise are cast to
+                float64 and the weights and the weighted noise are reduced
+                in float64. The weighted noise is cast back to the dtype
+                of the noise. Default: False
+
+        With elite or threshold the samples are selected from the costs
+        and only their noise rows are gathered and reduced, the weights
+        are renormalized over the selection.
     '''
-    def __init__(self, lam):
+    def __init__(self, lam, norm: bool=False, elite: int=0, threshold: float=0., mixed: bool=False):
         super(Update, self).__init__()
         self.lam = lam
+        self.mixed = mixed
+        self.norm = norm
+        self.elite = elite
+        self.threshold = threshold
+        self.subset = elite > 0 or threshold > 0.
+        self.logThreshold = math.log(threshold) if threshold > 0. else 0.
 
     '''
         Compute the weights update according to the MPPI algorithm.
 
+        The weights are a softmax of the scaled costs computed in log
+        space: the normalization term is a log-sum-exp and the weights are
+        exp(logits - log(eta)), so no intermediate exponential can overflow.
+        The weighted noise is then a single [k] x [k, tau*aDim] product per
+        vehicle.
+
         input:
         ------
             - costs: torch.tensor, the costs associated with each sample rollout. 
-                Shape, [k]
+                Shape, [n, k]
             - noise: torch.tensor, the noise associated with each sample rollout.
-                Shape, [k, tau, aDim, 1]
+                Shape, [n, k, tau, aDim, 1]
 
         output:
         -------
             - weighted_noise: torch.tensor, the noise reweighted according to the
-                importance sampling procedure. Shape, [k, tau, aDim, 1]
-            - eta: float, the normalization term, indicator of MPPI's behavior.
+                importance sampling procedure. Shape, [n, tau, aDim, 1]
+            - eta: torch.tensor, the normalization term, indicator of MPPI's behavior.
+                Shape, [n]
+            - ess: torch.tensor, the effective sample size 1/sum(w^2), in
+                [1, k]. Close to 1 when a single sample dominates, lam is
+                then too small. Shape, [n]
     '''
     def forward(self, costs, noise):
+        dt = noise.dtype
+        if self.mixed:
+            costs = costs.to(torch.float64)
+            noise = noise.to(torch.float64)
         beta = self.beta(costs)
-        arg = self.arg(costs, beta)
+        arg = self.arg(costs, beta, self.norm)
         exp_arg = self.exp_arg(arg)
-        exp = self.exp(exp_arg)
-        eta = self.eta(exp)
-        weights = self.weights(exp, eta)
-        weighted_noise = self.weighted_noise(weights, noise)
-        return weighted_noise, eta
+        if self.subset:
+            exp_arg, noise = self.select(exp_arg, noise)
+        logEta = torch.logsumexp(exp_arg, dim=-1, keepdim=True)
+        weights = self.exp(torch.sub(exp_arg, logEta))
+        weighted_noise = self.weighted_noise(weights, noise).to(dt)
+        return weighted_noise, torch.squeeze(self.exp(logEta), dim=-1), self.ess(weights)
+
+    '''
+        dtype of the reductions of the update.
+
+        input:
+        ------
+            - like: torch.Tensor, a tensor of the rollout dtype.
+
+        output:
+        -------
+            - torch.float64 if mixed, the dtype of like otherwise.
+    '''
+    def dtype(self, like) -> torch.dtype:
+        if self.mixed:
+            return torch.float64
+        return like.dtype
 
     '''
         Finds the cost with the smallest value. Alows to shift the
@@ -220,14 +1181,14 @@ class Update(torch.nn.Module):
 
         input:
         ------
-            - costs: torch.tensor, the cost tensor. Shape [k]
+            - costs: torch.tensor, the cost tensor. Shape [n, k]
 
         output:
         -------
-            - min(costs), float, the minimal cost value.
+            - min(costs), the minimal cost value of every vehicle. Shape [n, 1]
     '''
     def beta(self, costs):
-        return torch.min(costs)
+        return torch.min(costs, dim=-1, keepdim=True)[0]
 
     '''
         Shifts the costs by beta. And normalize the cost so that every
@@ -235,8 +1196,8 @@ class Update(torch.nn.Module):
 
         input:
         ------
-            - costs: torch.tensor, the costs tensor. Shape [k]
-            - beta: float, the min value of the costs.
+            - costs: torch.tensor, the costs tensor. Shape [n, k]
+            - beta: torch.tensor, the min value of the costs. Shape [n, 1]
             - norm: bool, if true the costs will be normalized. Default: False
 
         output:
@@ -246,7 +1207,9 @@ class Update(torch.nn.Module):
     def arg(self, costs, beta, norm:bool=False):
         shift = torch.sub(costs, beta)
         if norm:
-            max = torch.max(shift)
+            max = torch.max(shift, dim=-1, keepdim=True)[0]
+            # All samples have the same cost, keep them unscaled.
+            max = torch.where(max > 0., max, torch.ones_like(max))
             return torch.div(shift, max)
         return shift
 
@@ -256,12 +1219,12 @@ class Update(torch.nn.Module):
         input:
         ------
             - arg, the shifted (and normalized) costs.
-                Shape [k]
+                Shape [n, k]
 
         output:
         -------
             - (-\frac{1}{\lambda} * arg).
-                Shape [k]
+                Shape [n, k]
     '''
     def exp_arg(self, arg):
         return torch.mul((-1/self.lam), arg)
@@ -272,11 +1235,11 @@ class Update(torch.nn.Module):
         input:
         ------
             - arg, the exponential argument.
-                shape [k]
+                shape [n, k]
 
         output:
         -------
-            - exp(arg), shape [k]
+            - exp(arg), shape [n, k]
     '''
     def exp(self, arg):
         return torch.exp(arg)
@@ -287,48 +1250,133 @@ class Update(torch.nn.Module):
 
         input:
         ------
-            - exp, the exponential, shape [k]
+            - exp, the exponential, shape [n, k]
 
         output:
         -------
-            - sum(exp), float. The normalization term
+            - sum(exp), the normalization term. Shape [n, 1]
     '''
     def eta(self, exp):
-        return torch.sum(exp)
+        return torch.sum(exp, dim=-1, keepdim=True)
 
     '''
-        Normalize the exponential to get the sample weights.
+        Selects the samples contributing to the update, from the weights
+        alone, and gathers their noise rows.
 
         input:
         ------
-            - exp, torch.tensor. the exponential, shape [k]
-            - eta, float, the normalization term.
-        
+            - exp_arg, torch.Tensor, the log weights up to a constant.
+                Shape [n, k]
+            - noise, torch.Tensor, the noise samples.
+                Shape [n, k, tau, aDim, 1]
+
         output:
         -------
-            - \frac{exp}{eta}, torch.Tensor. The sample weights.
-                Shape [k]
+            - the log weights of the selected samples. Shape [n, m]
+            - the noise of the selected samples. Shape [n, m, tau, aDim, 1]
     '''
-    def weights(self, exp, eta):
-        return torch.div(exp, eta)
+    def select(self, exp_arg, noise):
+        n = noise.shape[0]
+        k = noise.shape[1]
+        m = k
+        keep = torch.zeros(0, dtype=torch.bool, device=exp_arg.device)
+        if self.threshold > 0.:
+            # The vehicles share m, the one with the most samples above
+            # the threshold sets it.
+            best = torch.max(exp_arg, dim=-1, keepdim=True)[0]
+            keep = torch.sub(exp_arg, best) >= self.logThreshold
+            m = int(torch.max(torch.sum(keep, dim=-1)))
+            if 2*m > k and (self.elite <= 0 or m <= self.elite):
+                # Most samples are kept, gathering costs more than the
+                # full reduction. Mask the others out instead.
+                return torch.where(keep, exp_arg, torch.full_like(exp_arg, -float("inf"))), noise
+        if self.elite > 0:
+            m = min(m, self.elite)
+
+        idx = torch.topk(exp_arg, m, dim=-1, sorted=False)[1]
+        flat = torch.reshape(noise, (n, k, -1))
+        rows = torch.gather(flat, 1, torch.unsqueeze(idx, dim=-1).expand(n, m, flat.shape[-1]))
+        selected = torch.gather(exp_arg, 1, idx)
+        if self.threshold > 0.:
+            # The vehicles with fewer samples above the threshold than m
+            # gather some below it, they are masked out.
+            selected = torch.where(torch.gather(keep, 1, idx), selected,
+                                   torch.full_like(selected, -float("inf")))
+        return selected, torch.reshape(rows, [n, m] + list(noise.shape[2:]))
 
     '''
-        compute the weighted noise.
+        Effective sample size of normalized weights.
 
         input:
         ------
-            - weights, torch.Tensor, the sample weights. Shape [k]
+            - weights, torch.Tensor, the sample weights. Shape [n, k]
+
+        output:
+        -------
+            - \frac{1}{\sum w^2}, torch.Tensor. Shape [n]
+    '''
+    def ess(self, weights):
+        return torch.reciprocal(torch.sum(torch.square(weights), dim=-1))
+
+    '''
+        compute the weighted noise as a batched matrix-vector product.
+
+        input:
+        ------
+            - weights, torch.Tensor, the sample weights. Shape [n, k]
             - noise, torch.Tensor, the noise samples.
-                Shape [k, tau, aDim, 1]
+                Shape [n, k, tau, aDim, 1]
 
         output:
         -------
             - Weighted_noise, torch.Tensor.
-                Shape [tau, aDim, 1]
+                Shape [n, tau, aDim, 1]
     '''
     def weighted_noise(self, weights, noise):
-        w = torch.unsqueeze(
-                torch.unsqueeze(
-                    torch.unsqueeze(weights, -1), -1), -1)
+        n = noise.shape[0]
+        k = noise.shape[1]
+        flat = torch.reshape(noise, (n, k, -1))
+        res = torch.bmm(torch.unsqueeze(weights, dim=1), flat)
+        return torch.reshape(res, [n] + list(noise.shape[2:]))
+
+    '''
+        Folds a chunk of samples in a running log-sum-exp. The running
+        minimum beta is lowered when the chunk contains a better sample and
+        the previous sums are rescaled accordingly, so that once every
+        chunk is folded acc/eta equals the weighted noise of forward and
+        eta^2/sq its effective sample size. The norm flag needs every
+        cost at once and isn't applied here. The elite selection applies
+        per chunk. The running sums are of the dtype given by dtype.
+
+        input:
+        ------
+            - costs, torch.Tensor, the costs of the chunk. Shape [n, c]
+            - noise, torch.Tensor, the noise of the chunk.
+                Shape [n, c, tau, aDim, 1]
+            - beta, torch.Tensor, the running min cost. Shape [n, 1]
+            - eta, torch.Tensor, the running normalization term. Shape [n, 1]
+            - sq, torch.Tensor, the running sum of squared exponentials.
+                Shape [n, 1]
+            - acc, torch.Tensor, the running unnormalized weighted noise.
+                Shape [n, tau, aDim, 1]
+
+        output:
+        -------
+            - the updated beta, eta, sq and acc.
+    '''
+    def fold(self, costs, noise, beta, eta, sq, acc):
+        if self.mixed:
+            costs = costs.to(torch.float64)
+            noise = noise.to(torch.float64)
+        new_beta = torch.minimum(beta, self.beta(costs))
+        scale = self.exp(self.exp_arg(torch.sub(beta, new_beta)))
+        exp_arg = self.exp_arg(self.arg(costs, new_beta))
+        if self.subset:
+            exp_arg, noise = self.select(exp_arg, noise)
+        exp = self.exp(exp_arg)
 
-        return torch.sum(torch.mul(w, noise), 0)
+        eta = torch.add(torch.mul(eta, scale), self.eta(exp))
+        sq = torch.add(torch.mul(sq, torch.square(scale)), self.eta(torch.square(exp)))
+        acc = torch.add(torch.mul(acc, scale[..., None, None]),
+                        self.weighted_noise(exp, noise))
+        return new_beta, eta, sq, acc
@@ -0,0 +1,262 @@
+import threading
+import torch
+from utils import dtype
+
+
+class Sampler(object):
+    '''
+        Noise subsystem for the controller samples.
+
+        The noise transform is factored once at construction. Samples are
+        drawn with a per-sampler seeded torch.Generator living on the
+        device of the controller. Optionally a ring buffer (bank) of
+        standard samples is pregenerated and refilled off the critical
+        path, either explicitly with refill() between control steps or in
+        a background thread.
+
+        - input:
+        --------
+            - sigma: the noise matrix. Array with shape [aDim, aDim].
+            - upsilon: Float, the covariance augmentation.
+            - tau: Int, the number of noise steps, the number of knots
+                if the controller uses them.
+            - aDim: Int, the action space dimension.
+            - seed: Int or None, the generator seed.
+            - cholesky: Bool, if true upsilon*sigma is treated as the
+                covariance and its cholesky factor is used as transform.
+                Otherwise upsilon*sigma is applied as is, like
+                ControllerBase.noise.
+            - sequence: String, "gaussian" for pseudo random samples,
+                "sobol" or "halton" for scrambled low-discrepancy samples.
+            - bank: Int, the number of samples kept in the ring buffer.
+                0 disables the bank and samples on every call.
+            - background: Bool, if true the consumed part of the bank is
+                refilled in a background thread right after each draw.
+    '''
+    def __init__(self, sigma, upsilon=1., tau=1, aDim=6, seed=None,
+                 cholesky=False, sequence="gaussian", bank=0, background=False):
+        if sequence not in ["gaussian", "sobol", "halton"]:
+            raise ValueError(f"Unknown noise sequence {sequence}, "
+                             "supported are: gaussian|sobol|halton")
+        self.tau = tau
+        self.aDim = aDim
+        self.dim = tau*aDim
+        self.seed = seed if seed is not None else torch.seed()
+        self.sequence = sequence
+
+        scale = upsilon*torch.tensor(sigma, dtype=dtype)
+        self.L = torch.linalg.cholesky(scale) if cholesky else scale
+        self.diag = bool(torch.count_nonzero(
+            self.L - torch.diag_embed(torch.diagonal(self.L))) == 0)
+        self.Ldiag = torch.diagonal(self.L)[..., None]
+
+        self.device = torch.device("cpu")
+        self.dtype = dtype
+        self.generator = torch.Generator().manual_seed(self.seed)
+
+        if sequence == "sobol":
+            self.engine = torch.quasirandom.SobolEngine(
+                self.dim, scramble=True, seed=self.seed)
+        elif sequence == "halton":
+            self.index = 1
+            self.bases = torch.tensor(primes(self.dim), dtype=torch.long)
+            # Random shift (Cranley-Patterson rotation) of the sequence.
+            self.shift = torch.rand(self.dim, generator=self.generator, dtype=torch.double)
+
+        self.size = bank
+        self.background = background
+        self.thread = None
+        self.head = 0
+        self.fresh = 0
+        self.bank = torch.zeros(bank, self.dim, dtype=self.dtype)
+        if bank > 0:
+            self.refill()
+
+    def to(self, device, dt=None):
+        '''
+            Moves the sampler to device/dtype. The generator is reseeded on
+            the new device.
+        '''
+        device = torch.device(device)
+        dt = dt if dt is not None else self.dtype
+        if device == self.device and dt == self.dtype:
+            return self
+        self.wait()
+        self.L = self.L.to(device, dt)
+        self.Ldiag = self.Ldiag.to(device, dt)
+        self.bank = self.bank.to(device, dt)
+        self.generator = torch.Generator(device=device).manual_seed(self.seed)
+        self.device = device
+        self.dtype = dt
+        return self
+
+    def __call__(self, n, k, device=None, dt=None):
+        '''
+            Draws the noise of n vehicles and k samples.
+
+            - input:
+            --------
+                - n: Int, the number of vehicles.
+                - k: Int, the number of samples per vehicle.
+                - device, dt: the device and dtype of the controller.
+
+            - output:
+            ---------
+                - the noise ~ \\mathcal{N}(0, \\Sigma). Shape [n, k, tau, aDim, 1]
+        '''
+        if device is not None:
+            self.to(device, dt)
+        m = n*k
+        if self.size == 0:
+            z = self.standard(m)
+        else:
+            z = self.draw(m)
+
+        z = torch.reshape(z, (n, k, self.tau, self.aDim, 1))
+        if self.diag:
+            return torch.mul(self.Ldiag, z)
+        return torch.matmul(self.L, z)
+
+    def draw(self, m):
+        if m > self.size:
+            raise ValueError(f"Asked for {m} samples but the noise bank only holds {self.size}.")
+        self.wait()
+        if self.fresh < m:
+            self.refill()
+        idx = torch.remainder(
+            torch.arange(self.head, self.head + m, device=self.device), self.size)
+        z = self.bank[idx]
+        self.head = (self.head + m) % self.size
+        self.fresh -= m
+        if self.background:
+            self.thread = threading.Thread(target=self.refill, daemon=True)
+            self.thread.start()
+        return z
+
+    def refill(self):
+        '''
+            Regenerates the consumed entries of the bank.
+        '''
+        stale = self.size - self.fresh
+        if stale == 0:
+            return
+        idx = torch.remainder(
+            torch.arange(self.head + self.fresh, self.head + self.size, device=self.device),
+            self.size)
+        self.bank[idx] = self.standard(stale)
+        self.fresh = self.size
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def standard(self, m):
+        '''
+            Draws m standard normal samples of dimension tau*aDim.
+        '''
+        if self.sequence == "gaussian":
+            return torch.randn((m, self.dim), generator=self.generator,
+                               device=self.device, dtype=self.dtype)
+
+        if self.sequence == "sobol":
+            u = self.engine.draw(m, dtype=torch.double)
+        else:
+            u = torch.remainder(halton(self.index, m, self.bases) + self.shift, 1.)
+            self.index += m
+        # Inverse normal cdf, u is kept away from 0 and 1.
+        u = torch.clamp(u, 1e-10, 1. - 1e-10)
+        z = torch.special.ndtri(u)
+        return z.to(self.device, self.dtype)
+
+
+def knot_basis(tau, m, interp="linear", times=None):
+    '''
+        Interpolation matrix from m knots spread uniformly over the horizon
+        to the tau steps.
+
+        input:
+        ------
+            - tau: Int, the number of steps.
+            - m: Int, the number of knots.
+            - interp: String, "linear" or "cubic" (uniform cubic B-spline).
+            - times: torch.Tensor or None, the start time of every step
+                for a non-uniform horizon, the knots are then uniform in
+                time. Defaults to the step indices. Shape [tau]
+
+        output:
+        -------
+            - the basis, row t holds the knot weights of step t.
+                Shape [tau, m]
+    '''
+    if times is None:
+        times = torch.arange(tau, dtype=torch.double)
+    times = times.to(torch.double)
+    span = float(times[-1] - times[0])
+
+    if interp == "linear":
+        if m < 2:
+            raise ValueError("Linear interpolation needs at least 2 knots.")
+        t = times[:, None]
+        knots = torch.linspace(float(times[0]), float(times[-1]), m, dtype=torch.double)[None, :]
+        width = span/(m - 1.) if tau > 1 else 1.
+        return torch.clamp(1. - torch.abs(t - knots)/width, min=0.)
+
+    if interp == "cubic":
+        if m < 4:
+            raise ValueError("Cubic B-spline interpolation needs at least 4 knots.")
+        # The m - 3 segments of the spline span the horizon.
+        if tau > 1:
+            u = (times - times[0])*((m - 3.)/span)
+        else:
+            u = torch.zeros(1, dtype=torch.double)
+        seg = torch.clamp(torch.floor(u), max=m - 4).long()
+        x = u - seg
+        w = torch.stack([(1. - x)**3,
+                         3.*x**3 - 6.*x**2 + 4.,
+                         -3.*x**3 + 3.*x**2 + 3.*x + 1.,
+                         x**3], dim=-1)/6.
+        basis = torch.zeros(tau, m, dtype=torch.double)
+        for i in range(4):
+            basis[torch.arange(tau), seg + i] = w[:, i]
+        return basis
+
+    raise ValueError(f"Unknown knot interpolation {interp}, supported are: linear|cubic")
+
+
+def halton(start, m, bases):
+    '''
+        Radical inverse of the indices [start, start+m) in every base.
+
+        input:
+        ------
+            - start: Int, the first index.
+            - m: Int, the number of points.
+            - bases: torch.Tensor, the base of every dimension. Shape [d]
+
+        output:
+        -------
+            - the halton points. Shape [m, d]
+    '''
+    idx = torch.arange(start, start + m, dtype=torch.long)[:, None].expand(m, bases.shape[0])
+    idx = idx.clone()
+    res = torch.zeros(idx.shape, dtype=torch.double)
+    f = torch.ones(bases.shape[0], dtype=torch.double)
+    while bool(torch.any(idx > 0)):
+        f = f / bases
+        res = res + f*torch.remainder(idx, bases)
+        idx = torch.div(idx, bases, rounding_mode="floor")
+    return res
+
+
+def primes(d):
+    '''
+        The first d prime numbers.
+    '''
+    res = []
+    c = 2
+    while len(res) < d:
+        if all(c % p != 0 for p in res if p*p <= c):
+            res.append(c)
+        c += 1
+    return res
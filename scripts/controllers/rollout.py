@@ -0,0 +1,220 @@
+import copy
+import io
+import queue
+import torch
+import torch.multiprocessing as mp
+
+from controllers.mppi_base import ControllerBase, rollout_config
+from models.auv_torch import RANDOM_PARAMS
+
+
+class RolloutBackend(object):
+    '''
+        Rollout backend interface. A backend computes the cost of every
+        sample for a controller and can be swapped in with
+        ControllerBase.set_backend to compare execution strategies.
+    '''
+    def __call__(self, controller, s, noise, A):
+        '''
+            Computes the cost of every sample.
+
+            - input:
+            --------
+                - controller: the ControllerBase requesting the rollout.
+                - s: the inital state of every vehicle.
+                    Shape: [n, sDim, 1]
+                - noise: the noise of every sample.
+                    Shape: [n, k, tau, aDim, 1]
+                - A: the action sequences. Shape: [n, tau, aDim, 1]
+
+            - output:
+            ---------
+                - costs: Shape: [n, k]
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class LocalRollout(RolloutBackend):
+    '''
+        Single process backend, runs ControllerBase.rollout_cost.
+    '''
+    def __call__(self, controller, s, noise, A):
+        return controller.rollout_cost(s, noise, A)
+
+
+class ProcessPoolRollout(RolloutBackend):
+    '''
+        Shards the k samples across a persistent pool of worker processes.
+        Every worker owns a copy of the model and the cost. The state, the
+        action sequences, the noise and the costs live in shared-memory
+        tensors so that a control step only sends the shard bounds through
+        the queues and each worker writes its per-sample costs in place.
+
+        - input:
+        --------
+            - model: the model to roll out, eager or scripted.
+            - cost: the cost to evaluate, eager or scripted.
+            - tau: Int, the number of prediction timesteps.
+            - workers: Int, the number of worker processes.
+            - threads: Int, the number of torch threads of each worker.
+            - context: String, the multiprocessing start method.
+            - poll: Float, the period in seconds at which a waiting
+                control step checks that the workers are alive.
+    '''
+    def __init__(self, model, cost, tau, workers=2, threads=1, context="spawn", poll=1.):
+        self.tau = tau
+        self.workers = workers
+        self.poll = poll
+        ctx = mp.get_context(context)
+        self.tasks = [ctx.Queue() for _ in range(workers)]
+        self.done = ctx.Queue()
+        self.procs = []
+        model = _pack(model)
+        cost = _pack(cost)
+        for i in range(workers):
+            p = ctx.Process(target=_worker,
+                            args=(self.tasks[i], self.done, model, cost, tau, threads),
+                            daemon=True)
+            p.start()
+            self.procs.append(p)
+
+        self.s = None
+        self.A = None
+        self.noise = None
+        self.costs = None
+        self.draws = 0
+
+    def __call__(self, controller, s, noise, A):
+        self._share(controller, s, noise, A)
+        self.s.copy_(s)
+        self.A.copy_(A)
+        self.noise.copy_(noise)
+
+        n, k = noise.shape[0], noise.shape[1]
+        # Global sample index of every row, set by chunked controllers.
+        index = getattr(controller.model, "rIndex", None)
+        if index is None or index.shape[0] == 0:
+            index = torch.arange(n*k)
+        index = torch.reshape(index.cpu(), (n, k))
+        bounds = torch.linspace(0, k, self.workers + 1).long().tolist()
+        jobs = 0
+        for i in range(self.workers):
+            if bounds[i+1] > bounds[i]:
+                self.tasks[i].put(("run", bounds[i], bounds[i+1], index[:, bounds[i]:bounds[i+1]].clone()))
+                jobs += 1
+        # The early termination counters of the shards add up to those of
+        # a local rollout.
+        counters = [0, 0, 0]
+        for _ in range(jobs):
+            err, shard = self._wait()
+            if err is not None:
+                raise RuntimeError(f"Rollout worker failed: {err}")
+            counters = [c + v for c, v in zip(counters, shard)]
+        controller.liveSteps += counters[0]
+        controller.skippedSteps += counters[1]
+        controller.terminated += counters[2]
+        return self.costs.clone().to(noise.device)
+
+    def _wait(self):
+        '''
+            Waits for the next completion, raises instead of blocking if a
+            worker exited.
+        '''
+        while True:
+            try:
+                return self.done.get(timeout=self.poll)
+            except queue.Empty:
+                for i, p in enumerate(self.procs):
+                    if not p.is_alive():
+                        raise RuntimeError(f"Rollout worker {i} exited with code {p.exitcode}.")
+
+    def _share(self, controller, s, noise, A):
+        '''
+            (Re)allocates the shared tensors if the shapes changed and hands
+            them to the workers, with the parameter draws of a randomized
+            model. Happens once in steady state and after every resample.
+        '''
+        draws = getattr(controller.model, "draws", 0)
+        if self.noise is not None and self.noise.shape == noise.shape \
+                and self.s.shape == s.shape and self.noise.dtype == noise.dtype \
+                and self.draws == draws:
+            return
+        self.draws = draws
+        n, k = noise.shape[0], noise.shape[1]
+        self.s = torch.zeros_like(s, device="cpu").share_memory_()
+        self.A = torch.zeros_like(A, device="cpu").share_memory_()
+        self.noise = torch.zeros_like(noise, device="cpu").share_memory_()
+        self.costs = torch.zeros(n, k, dtype=noise.dtype).share_memory_()
+        params = None
+        if getattr(controller.model, "randomized", False):
+            params = {buffer: getattr(controller.model, buffer).cpu()
+                      for buffer, _, _ in RANDOM_PARAMS.values()}
+        for q in self.tasks:
+            q.put(("share", self.s, self.A, self.noise, self.costs,
+                   rollout_config(controller), params))
+
+    def close(self):
+        for q in self.tasks:
+            q.put(None)
+        for p in self.procs:
+            p.join()
+        self.procs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _pack(module):
+    # Scripted modules don't pickle, ship them serialized.
+    if isinstance(module, torch.jit.ScriptModule):
+        buffer = io.BytesIO()
+        torch.jit.save(module, buffer)
+        return ("script", buffer.getvalue())
+    # Copy so that the module of the caller stays on its device.
+    return ("eager", copy.deepcopy(module).cpu())
+
+
+def _unpack(packed):
+    kind, payload = packed
+    if kind == "script":
+        return torch.jit.load(io.BytesIO(payload))
+    return payload
+
+
+def _worker(tasks, done, model, cost, tau, threads):
+    torch.set_num_threads(threads)
+    model = _unpack(model)
+    cost = _unpack(cost)
+    # Only rollout_cost is used, it reads k from the noise shard.
+    controller = None
+    s, A, noise, costs = None, None, None, None
+    with torch.no_grad():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            if task[0] == "share":
+                _, s, A, noise, costs, config, params = task
+                controller = ControllerBase(model, cost, None, k=1, tau=tau, **config)
+                continue
+            _, lo, hi, index = task
+            try:
+                # Same parameter draws as the main process for the samples
+                # of the shard, index holds their global sample indices.
+                if params is not None:
+                    idx = torch.reshape(index, (-1,))
+                    for name, value in params.items():
+                        setattr(model, name, value[torch.remainder(idx, value.shape[0])])
+                    model.rIndex = torch.zeros(0, dtype=torch.long)
+                # The time dependent cost tables of the control step.
+                controller.prepare(s)
+                costs[:, lo:hi] = controller.rollout_cost(s, noise[:, lo:hi], A)
+                done.put((None, (controller.liveSteps, controller.skippedSteps, controller.terminated)))
+            except Exception as e:
+                done.put((repr(e), None))
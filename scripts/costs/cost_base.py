@@ -1,4 +1,6 @@
+import math
 import torch
+from typing import Optional
 from utils import dtype
 
 # TODO: compute all constants without tensorflow. Out of the graph
@@ -9,7 +11,7 @@ class CostBase(torch.nn.Module):
         This is an abstract class and should be heritated by every
         specific cost.
     '''
-    def __init__(self, lam, gamma, upsilon, sigma):
+    def __init__(self, lam, gamma, upsilon, sigma, risk="mean", alpha=0.1):
         '''
             Abstract class for the cost function.
             - input:
@@ -18,6 +20,9 @@ class CostBase(torch.nn.Module):
                 - gamma: decoupling parameter between action and noise.
                 - upsilon: covariance augmentation for noise generation.
                 - sigma: the noise covariance matrix. shape [aDim, aDim]
+                - risk: String, aggregate of the costs of an ensemble of
+                    models, mean|worst|cvar. See risk_aggregate.
+                - alpha: Float in (0, 1], the tail fraction of cvar.
                 - TODO: add diag arg to feed sigma as the diag element if
                 prefered.
 
@@ -30,9 +35,16 @@ class CostBase(torch.nn.Module):
         self.lam = lam
         self.gamma = gamma
         self.upsilon = upsilon
+        if risk not in ["mean", "worst", "cvar"]:
+            raise ValueError(f"Unknown risk aggregate {risk}, supported are: mean|worst|cvar")
+        if not 0. < alpha <= 1.:
+            raise ValueError("The cvar tail fraction alpha needs to be in (0, 1].")
+        self.risk = risk
+        self.alpha = alpha
         self.register_buffer("invSig", torch.linalg.inv(torch.tensor(sigma, dtype=dtype)))
 
-    def forward(self, state, action=None, noise=None, final: bool =False):
+    def forward(self, state, action: Optional[torch.Tensor]=None,
+                noise: Optional[torch.Tensor]=None, final: bool =False, step: int=0):
         '''
             Computes the cost of a sample at a given time.
             - input:
@@ -44,6 +56,11 @@ class CostBase(torch.nn.Module):
                 - noise: The noise applied to the sample.
                     shape: [k/1, aDim, 1]
                 - final: Bool, if true it computes the final state cost.
+                - step: Int, the step of the horizon reaching the state,
+                    indexes the reference of tracking costs.
+                Without action and noise only the state cost is computed,
+                the rollouts add the action cost of the whole horizon,
+                see action_cost_traj.
 
             - output:
             ---------
@@ -54,14 +71,156 @@ class CostBase(torch.nn.Module):
         if final:
             return torch.squeeze(self.final_cost(state))
 
-        s_cost = torch.squeeze(self.state_cost(state))
+        s_cost = torch.squeeze(self.state_cost(state, step))
+        if action is None or noise is None:
+            return s_cost
         a_cost = torch.squeeze(self.action_cost(action, noise))
         return torch.add(s_cost, a_cost)
 
+    @torch.jit.export
+    def forward_soa(self, state, action: Optional[torch.Tensor]=None,
+                    noise: Optional[torch.Tensor]=None, final: bool =False, step: int=0):
+        '''
+            Computes the cost of a sample at a given time, structure of
+            arrays layout: the fields come first and every field is a
+            contiguous row over the samples.
+            - input:
+            --------
+                - state: The current state of the system.
+                    shape: [sDim, n, k]
+                - action: The action applied to reach the current state.
+                    shape: [aDim, n, 1]
+                - noise: The noise applied to the sample.
+                    shape: [aDim, n, k]
+                - final: Bool, if true it computes the final state cost.
+                - step: Int, the step of the horizon reaching the state.
+                Without action and noise only the state cost is computed.
+
+            - output:
+            ---------
+                - cost for a given step,
+                    shape: [n, k]
+        '''
+        if final:
+            return self.final_cost_soa(state)
+        if action is None or noise is None:
+            return self.state_cost_soa(state, step)
+
+        return torch.add(self.state_cost_soa(state, step), self.action_cost_soa(action, noise))
+
+    @torch.jit.export
+    def collision(self, state):
+        '''
+            Flags the states in collision, they terminate their rollout
+            with the early termination of the controller. No collisions
+            by default.
+            - input:
+            --------
+                - state: the states. shape: [n, k, sDim, 1]
+
+            - output:
+            ---------
+                - Bool tensor, shape: [n, k]
+        '''
+        return torch.zeros(state.shape[:-2], dtype=torch.bool, device=state.device)
+
+    @torch.jit.export
+    def set_reference(self, s, times):
+        '''
+            Precomputes the time-indexed tables of the cost once per
+            control step, e.g. the reference of a tracking cost. Nothing
+            to do for costs that don't depend on time.
+            - input:
+            --------
+                - s: the observed state of every vehicle.
+                    shape: [n, sDim, 1]
+                - times: the time of every state of the rollout, the
+                    observed one first.
+                    shape: [tau+1]
+        '''
+        pass
+
+    @torch.jit.export
+    def trajectory_cost(self, states, action, noise, weights):
+        '''
+            Computes the cost of whole trajectories in one call, the
+            running cost of every step and the final cost.
+            - input:
+            --------
+                - states: the trajectories, the initial state followed by
+                    the state reached at every step.
+                    shape: [..., n, k, tau+1, sDim]
+                - action: the action sequences.
+                    shape: [n, 1, tau, aDim]
+                - noise: the noise applied at every step.
+                    shape: [n, k, tau, aDim]
+                - weights: the weight of the running cost of every step.
+                    shape: [tau]
+
+            - output:
+            ---------
+                - sum_t w_t c(s_{t+1}, a_t, e_t) + final(s_tau),
+                    shape: [..., n, k]
+        '''
+        running = torch.add(self.state_cost_traj(states[..., 1:, :]),
+                            self.action_cost_traj(action, noise))
+        running = torch.sum(torch.mul(running, weights), dim=-1)
+        return torch.add(running, self.final_cost_traj(states[..., -1, :]))
+
+    def state_cost_traj(self, states):
+        '''
+            State cost of a batch of row states. Evaluates state_cost on
+            the column vectors, costs can override it with a row form.
+            - input:
+            --------
+                - states: shape [..., sDim]
+
+            - output:
+            ---------
+                - shape [...]
+        '''
+        return torch.reshape(self.state_cost(torch.unsqueeze(states, dim=-1)), states.shape[:-1])
+
+    def final_cost_traj(self, states):
+        '''
+            Final cost of a batch of row states, see state_cost_traj.
+        '''
+        return torch.reshape(self.final_cost(torch.unsqueeze(states, dim=-1)), states.shape[:-1])
+
+    def risk_aggregate(self, costs):
+        '''
+            Aggregates the trajectory costs of the members of a model
+            ensemble into one cost per sample.
+
+            - input:
+            --------
+                - costs: the cost of every sample under every member.
+                    shape: [E, n, k]
+
+            - output:
+            ---------
+                - mean: the expected cost over the members.
+                - worst: the highest cost over the members.
+                - cvar: the mean of the ceil(alpha*E) highest costs.
+                shape: [n, k]
+        '''
+        if self.risk == "mean":
+            return torch.mean(costs, dim=0)
+        if self.risk == "worst":
+            return torch.amax(costs, dim=0)
+        m = max(1, int(math.ceil(self.alpha*costs.shape[0])))
+        return torch.mean(torch.topk(costs, m, dim=0).values, dim=0)
+
     def final_cost(self, state):
         raise NotImplementedError
     
-    def state_cost(self, state):
+    def state_cost(self, state, step: int=0):
+        raise NotImplementedError
+
+    def final_cost_soa(self, state):
+        raise NotImplementedError
+
+    def state_cost_soa(self, state, step: int=0):
         raise NotImplementedError
 
     def action_cost(self, action, noise):
@@ -106,5 +265,98 @@ class CostBase(torch.nn.Module):
         actionCost = torch.multiply(torch.add(controlCost, nCost), 0.5)
         return actionCost
 
+    def action_cost_soa(self, action, noise):
+        '''
+            action related cost part, structure of arrays layout.
+
+            - input: 
+            --------
+                - action: the action applied to reach the current state.
+                    shape: [aDim, n, 1]
+                - noise: the noise applied to the sample.
+                    shape: [aDim, n, k]
+
+            - output:
+            ---------
+                - The cost associated with the current action. shape [n, k]
+        '''
+        rhsNcost = torch.tensordot(self.invSig, noise, dims=1)
+        rhsAcost = torch.tensordot(self.invSig, action, dims=1)
+
+        mixCost = torch.multiply(torch.sum(action*rhsNcost, dim=0), 2.)
+        nCost = torch.sum(noise*rhsNcost, dim=0)
+        aCost = torch.sum(action*rhsAcost, dim=0)
+
+        aCost = torch.multiply(aCost, self.gamma)
+        mixCost = torch.multiply(mixCost, self.gamma)
+        nCost = torch.multiply(nCost, self.lam*(1.-1./self.upsilon))
+
+        controlCost = torch.add(aCost, mixCost)
+        return torch.multiply(torch.add(controlCost, nCost), 0.5)
+
+    @torch.jit.export
+    def action_cost_traj(self, action, noise):
+        '''
+            action related cost part for every step at once. The sample
+            independent term of the nominal actions is computed once per
+            step of the horizon and broadcast over the samples, \Sigma^{-1}
+            is applied to the whole noise tensor in one product.
+
+            - input: 
+            --------
+                - action: the action sequences.
+                    shape: [n, 1, tau, aDim]
+                - noise: the noise applied at every step.
+                    shape: [n, k, tau, aDim]
+
+            - output:
+            ---------
+                - The cost associated with the actions. shape [n, k, tau]
+        '''
+        return torch.add(self.nominal_cost(action), self.noise_cost(action, noise))
+
+    def nominal_cost(self, action):
+        '''
+            Sample independent part of the action cost,
+            0.5 \gamma u^{T}_t \Sigma^{-1} u_t.
+
+            - input: 
+            --------
+                - action: the action sequences. shape: [n, 1, tau, aDim]
+
+            - output:
+            ---------
+                - shape [n, 1, tau]
+        '''
+        # \Sigma^{-1} is symmetric, the rows are multiplied by its transpose.
+        rhsAcost = torch.matmul(action, self.invSig)
+        aCost = torch.sum(action*rhsAcost, dim=-1)
+        return torch.multiply(aCost, 0.5*self.gamma)
+
+    def noise_cost(self, action, noise):
+        '''
+            Noise dependent part of the action cost,
+            0.5 (2 \gamma u^{T}_t \Sigma^{-1} \epsilon_t
+            + \lambda (1 - 1/\\upsilon) \epsilon^{T}_t \Sigma^{-1} \epsilon_t).
+
+            - input: 
+            --------
+                - action: the action sequences. shape: [n, 1, tau, aDim]
+                - noise: the noise applied at every step.
+                    shape: [n, k, tau, aDim]
+
+            - output:
+            ---------
+                - shape [n, k, tau]
+        '''
+        rhsNcost = torch.matmul(noise, self.invSig)
+
+        mixCost = torch.multiply(torch.sum(action*rhsNcost, dim=-1), 2.)
+        nCost = torch.sum(noise*rhsNcost, dim=-1)
+
+        mixCost = torch.multiply(mixCost, self.gamma)
+        nCost = torch.multiply(nCost, self.lam*(1.-1./self.upsilon))
+        return torch.multiply(torch.add(mixCost, nCost), 0.5)
+
     def set_observer(self, observer):
         self._observer = observer
\ No newline at end of file
@@ -0,0 +1,199 @@
+import torch
+from .cost_base import CostBase
+
+
+class Elipse(CostBase):
+    '''
+        Tracking cost of an ellipse in the horizontal plane, followed
+        counter-clockwise at a constant speed (clockwise if the speed is
+        negative).
+
+        The reference of the whole horizon is computed once per control
+        step by set_reference: it starts at the phase of the observed
+        position of every vehicle and advances along the ellipse with the
+        step durations of the controller. The cost of step t then indexes
+        the table, no geometry is evaluated per sample.
+
+        The cost of a state is
+            m_state |p - p_ref(t)|^2 + m_vel |v - v_ref(t)|^2,
+        with p the position and v the inertial linear velocity. Elipse
+        tracks the x, y plane and ignores the depth, Elipse3D also holds
+        the depth of the ellipse.
+
+        - input:
+        --------
+            - lam (lambda) the inverse temperature.
+            - gamma: decoupling parameter between action and noise.
+            - upsilon: covariance augmentation for noise generation.
+            - sigma: the noise covariance matrix. shape [aDim, aDim].
+            - a, b: the semi axes along x and y.
+            - center_x, center_y, center_z: the center of the ellipse.
+            - speed: the tangential speed of the reference.
+            - m_state: weight of the position error.
+            - m_vel: weight of the velocity error.
+            - risk, alpha: the ensemble risk aggregate, see CostBase.
+    '''
+    def __init__(self, lam, gamma, upsilon, sigma, a, b, center_x, center_y, speed,
+                 m_state, m_vel, center_z=0., risk="mean", alpha=0.1, dims=2):
+        super(Elipse, self).__init__(lam, gamma, upsilon, sigma, risk, alpha)
+        if a <= 0. or b <= 0.:
+            raise ValueError("The semi axes of the ellipse need to be positive.")
+        self.a = float(a)
+        self.b = float(b)
+        self.speed = float(speed)
+        self.mState = float(m_state)
+        self.mVel = float(m_vel)
+        self.dims = dims
+        dtype = self.invSig.dtype
+        self.register_buffer("center", torch.tensor([center_x, center_y, center_z], dtype=dtype))
+        # Reference of the last control step, [n, 1, tau+1, dims].
+        self.register_buffer("refPos", torch.zeros(0, 1, 0, dims, dtype=dtype))
+        self.register_buffer("refVel", torch.zeros(0, 1, 0, dims, dtype=dtype))
+
+    '''
+        Computes the reference of the horizon for the observed states.
+
+        input:
+        ------
+            - s: the observed state of every vehicle. shape [n, sDim, 1]
+            - times: the time of every state of the rollout, the observed
+                one first. shape [tau+1]
+    '''
+    @torch.jit.export
+    def set_reference(self, s, times):
+        c = self.center.to(s.dtype)
+        theta = torch.atan2((s[:, 1, 0] - c[1])/self.b, (s[:, 0, 0] - c[0])/self.a)
+        dts = torch.diff(times.to(s.dtype))
+        phases = [theta]
+        # Midpoint steps of the phase rate speed/|dp/dtheta|.
+        for i in range(dts.shape[0]):
+            mid = torch.add(theta, 0.5*dts[i]*self.phase_rate(theta))
+            theta = torch.add(theta, dts[i]*self.phase_rate(mid))
+            phases.append(theta)
+        theta = torch.stack(phases, dim=-1)
+
+        cos, sin = torch.cos(theta), torch.sin(theta)
+        pos = torch.stack([c[0] + self.a*cos, c[1] + self.b*sin,
+                           torch.zeros_like(theta) + c[2]], dim=-1)
+        tangent = torch.stack([-self.a*sin, self.b*cos, torch.zeros_like(theta)], dim=-1)
+        vel = self.speed*tangent/torch.linalg.vector_norm(tangent, dim=-1, keepdim=True)
+        self.refPos = torch.unsqueeze(pos[..., :self.dims], dim=1)
+        self.refVel = torch.unsqueeze(vel[..., :self.dims], dim=1)
+
+    def phase_rate(self, theta):
+        return self.speed/torch.sqrt(torch.square(self.a*torch.sin(theta)) +
+                                     torch.square(self.b*torch.cos(theta)))
+
+    '''
+        Computes the tracking cost of the states reached at a step.
+
+        input:
+        ------
+            - state: the states. shape [..., n, k, sDim, 1]
+            - step: Int, the index of the step in the reference, 0 is the
+                observed state.
+
+        output:
+        -------
+            - the cost. shape [..., n, k]
+    '''
+    def state_cost(self, state, step: int=0):
+        return self.tracking(state[..., 0], self.refPos[:, :, step], self.refVel[:, :, step], -1)
+
+    def final_cost(self, state):
+        return self.state_cost(state, -1)
+
+    '''
+        Computes the tracking cost, structure of arrays layout. The
+        members of an ensemble are stacked along n.
+
+        input:
+        ------
+            - state: the states. shape [sDim, E*n, k]
+            - step: Int, the index of the step in the reference.
+
+        output:
+        -------
+            - the cost. shape [E*n, k]
+    '''
+    def state_cost_soa(self, state, step: int=0):
+        members = state.shape[1]//self.refPos.shape[0]
+        pos = torch.unsqueeze(torch.transpose(self.refPos[:, 0, step], 0, 1), dim=-1)
+        vel = torch.unsqueeze(torch.transpose(self.refVel[:, 0, step], 0, 1), dim=-1)
+        return self.tracking(state, pos.repeat(1, members, 1), vel.repeat(1, members, 1), 0)
+
+    def final_cost_soa(self, state):
+        return self.state_cost_soa(state, -1)
+
+    '''
+        Computes the tracking cost of whole trajectories, the states of
+        step t+1 are tracked against the reference of step t+1.
+
+        input:
+        ------
+            - states: the row states. shape [..., n, k, tau, sDim]
+
+        output:
+        -------
+            - the cost. shape [..., n, k, tau]
+    '''
+    def state_cost_traj(self, states):
+        return self.tracking(states, self.refPos[:, :, 1:], self.refVel[:, :, 1:], -1)
+
+    def final_cost_traj(self, states):
+        return self.tracking(states, self.refPos[:, :, -1], self.refVel[:, :, -1], -1)
+
+    '''
+        Weighted square errors of the position and of the inertial
+        velocity to the reference.
+
+        input:
+        ------
+            - x: the states, the fields along dim.
+            - pos, vel: the reference, broadcastable to x with dims
+                fields along dim.
+            - dim: Int, the dimension of the fields, -1 or 0.
+
+        output:
+        -------
+            - the cost, the shape of x without dim.
+    '''
+    def tracking(self, x, pos, vel, dim: int):
+        pErr = torch.subtract(torch.narrow(x, dim, 0, self.dims), pos)
+        v = inertial_velocity(torch.narrow(x, dim, 3, 4), torch.narrow(x, dim, 7, 3), dim)
+        vErr = torch.subtract(torch.narrow(v, dim, 0, self.dims), vel)
+        return torch.add(self.mState*torch.sum(torch.square(pErr), dim=dim),
+                         self.mVel*torch.sum(torch.square(vErr), dim=dim))
+
+
+class Elipse3D(Elipse):
+    '''
+        Tracking cost of an ellipse at the depth center_z, the depth and
+        the vertical velocity are tracked too. Same arguments as Elipse.
+    '''
+    def __init__(self, lam, gamma, upsilon, sigma, a, b, center_x, center_y, speed,
+                 m_state, m_vel, center_z=0., risk="mean", alpha=0.1):
+        super(Elipse3D, self).__init__(lam, gamma, upsilon, sigma, a, b, center_x, center_y, speed,
+                                       m_state, m_vel, center_z, risk, alpha, dims=3)
+
+
+def inertial_velocity(q, v, dim: int):
+    '''
+        Rotates the body velocity in the inertial frame,
+        v + 2w (u x v) + 2u x (u x v) with the quaternion q = (u, w).
+
+        input:
+        ------
+            - q: the quaternions (x, y, z, w), 4 fields along dim.
+            - v: the body linear velocities, 3 fields along dim.
+            - dim: Int, the dimension of the fields.
+
+        output:
+        -------
+            - the inertial velocities, 3 fields along dim.
+    '''
+    u = torch.narrow(q, dim, 0, 3)
+    w = torch.narrow(q, dim, 3, 1)
+    u, v = torch.broadcast_tensors(u, v)
+    uv = torch.linalg.cross(u, v, dim=dim)
+    return v + 2.*(w*uv + torch.linalg.cross(u, uv, dim=dim))
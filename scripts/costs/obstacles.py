@@ -0,0 +1,178 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from .cost_base import CostBase
+
+
+class Obstacles(CostBase):
+    '''
+        Adds the cost of obstacles to a task cost. The scene is a signed
+        distance grid, the distance of every state is a trilinear lookup
+        in the grid: the cost of a state is constant in the number of
+        obstacles.
+
+        With d the distance of the vehicle position to the closest
+        obstacle, the cost of a state is
+            collision                               if d < radius,
+            weight*max(0, clearance - (d - radius))^2 otherwise,
+        added to the cost of the task. Outside the grid the distance of
+        the closest cell on the border is used.
+
+        - input:
+        --------
+            - lam (lambda) the inverse temperature.
+            - gamma: decoupling parameter between action and noise.
+            - upsilon: covariance augmentation for noise generation.
+            - sigma: the noise covariance matrix. shape [aDim, aDim].
+            - task: the cost of the task, a CostBase.
+            - sdf: the signed distances on the grid, negative inside
+                obstacles. shape [nx, ny, nz]
+            - origin: the position of the cell [0, 0, 0]. shape [3]
+            - resolution: Float, the size of a cell.
+            - radius: Float, the radius of the vehicle.
+            - clearance: Float, the distance to the obstacles below which
+                the clearance cost starts.
+            - weight: Float, the weight of the clearance cost.
+            - collision: Float, the cost of a state in collision.
+    '''
+    def __init__(self, lam, gamma, upsilon, sigma, task, sdf, origin, resolution,
+                 radius=0.5, clearance=1., weight=1., collision=1e4):
+        super(Obstacles, self).__init__(lam, gamma, upsilon, sigma, task.risk, task.alpha)
+        if np.ndim(sdf) != 3 or min(np.shape(sdf)) < 2:
+            raise ValueError(f"The signed distance grid needs the shape [nx, ny, nz] with at least "
+                             f"2 cells per axis, got {list(np.shape(sdf))}.")
+        if not np.all(np.isfinite(sdf)):
+            raise ValueError("The signed distance grid needs finite distances.")
+        if resolution <= 0.:
+            raise ValueError("The grid resolution needs to be positive.")
+        self.task = task
+        self.radius = float(radius)
+        self.clearance = float(clearance)
+        self.weight = float(weight)
+        self.collisionCost = float(collision)
+        dtype = self.invSig.dtype
+        # grid_sample reads [D, H, W] = [z, y, x] volumes with (x, y, z)
+        # coordinates normalized to [-1, 1] on the corner cells. The grid
+        # is copied once, in that order.
+        zyx = torch.from_numpy(np.ascontiguousarray(np.transpose(sdf, (2, 1, 0)), dtype=np.float64))
+        self.register_buffer("sdf", zyx[None, None].to(dtype))
+        size = torch.tensor([zyx.shape[2] - 1, zyx.shape[1] - 1, zyx.shape[0] - 1], dtype=dtype)
+        scale = 2./(size*resolution)
+        self.register_buffer("gridScale", scale)
+        self.register_buffer("gridOffset", -1. - torch.tensor(origin, dtype=dtype)*scale)
+
+    '''
+        Signed distance of positions, trilinear interpolation of the grid.
+
+        input:
+        ------
+            - pos: the positions. shape [..., 3]
+
+        output:
+        -------
+            - the distances. shape [...]
+    '''
+    def distance(self, pos):
+        grid = torch.add(torch.mul(pos, self.gridScale), self.gridOffset)
+        d = F.grid_sample(self.sdf, torch.reshape(grid, (1, -1, 1, 1, 3)),
+                          mode="bilinear", padding_mode="border", align_corners=True)
+        return torch.reshape(d, pos.shape[:-1])
+
+    '''
+        Cost of the obstacles for row states.
+
+        input:
+        ------
+            - states: shape [..., sDim]
+
+        output:
+        -------
+            - shape [...]
+    '''
+    def obstacle_cost(self, states):
+        d = torch.subtract(self.distance(states[..., 0:3]), self.radius)
+        clear = torch.mul(torch.square(torch.clamp(self.clearance - d, min=0.)), self.weight)
+        return torch.where(d < 0., torch.full_like(d, self.collisionCost), clear)
+
+    @torch.jit.export
+    def collision(self, state):
+        return torch.subtract(self.distance(state[..., 0:3, 0]), self.radius) < 0.
+
+    @torch.jit.export
+    def set_reference(self, s, times):
+        self.task.set_reference(s, times)
+
+    def state_cost(self, state, step: int=0):
+        c = self.obstacle_cost(state[..., 0])
+        return torch.add(torch.reshape(self.task.state_cost(state, step), c.shape), c)
+
+    def final_cost(self, state):
+        c = self.obstacle_cost(state[..., 0])
+        return torch.add(torch.reshape(self.task.final_cost(state), c.shape), c)
+
+    def state_cost_soa(self, state, step: int=0):
+        c = self.obstacle_cost(torch.permute(state, (1, 2, 0)))
+        return torch.add(self.task.state_cost_soa(state, step), c)
+
+    def final_cost_soa(self, state):
+        c = self.obstacle_cost(torch.permute(state, (1, 2, 0)))
+        return torch.add(self.task.final_cost_soa(state), c)
+
+    def state_cost_traj(self, states):
+        return torch.add(self.task.state_cost_traj(states), self.obstacle_cost(states))
+
+    def final_cost_traj(self, states):
+        return torch.add(self.task.final_cost_traj(states), self.obstacle_cost(states))
+
+
+def voxelize(obstacles, origin, resolution, shape):
+    '''
+        Signed distance grid of a scene of spheres and boxes, the distance
+        of every cell center to the closest obstacle. Computed once, the
+        cost then only reads the grid.
+
+        input:
+        ------
+            - obstacles: non-empty list of dict, {"type": "sphere",
+                "center", "radius"} or {"type": "box", "center", "size"}
+                with size the edge lengths along x, y, z.
+            - origin: the position of the cell [0, 0, 0]. shape [3]
+            - resolution: Float, the size of a cell.
+            - shape: the number of cells [nx, ny, nz].
+
+        output:
+        -------
+            - the signed distances, negative inside the obstacles.
+                shape [nx, ny, nz]
+    '''
+    if len(obstacles) == 0:
+        raise ValueError("The scene has no obstacles, the distance grid would be infinite.")
+    axes = [origin[i] + resolution*np.arange(shape[i]) for i in range(3)]
+    p = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1)
+    sdf = np.full(tuple(shape), np.inf)
+    for o in obstacles:
+        center = np.asarray(o["center"], dtype=np.float64)
+        if o["type"] == "sphere":
+            d = np.linalg.norm(p - center, axis=-1) - o["radius"]
+        elif o["type"] == "box":
+            q = np.abs(p - center) - 0.5*np.asarray(o["size"], dtype=np.float64)
+            d = np.linalg.norm(np.maximum(q, 0.), axis=-1) + np.minimum(np.max(q, axis=-1), 0.)
+        else:
+            raise ValueError(f"Unknown obstacle type {o['type']}, supported are: sphere|box")
+        sdf = np.minimum(sdf, d)
+    return sdf
+
+
+def load_sdf(path):
+    '''
+        Loads a signed distance grid saved with numpy.save.
+
+        input:
+        ------
+            - path: the .npy file. shape [nx, ny, nz]
+
+        output:
+        -------
+            - the grid. shape [nx, ny, nz]
+    '''
+    return np.load(path)
@@ -0,0 +1,165 @@
+import torch
+from typing import Tuple
+
+
+class QuadraticForm(torch.nn.Module):
+    '''
+        Weighted square sum x^T Q x of state deviations, with a fast path
+        for the structure of Q.
+
+        - diag: Q is diagonal, the form is the product of the squared
+            deviations with the diagonal, a single matrix-vector product.
+        - block: Q is block diagonal along contiguous state fields, e.g.
+            position, orientation and velocity. The fields outside the
+            span of the blocks larger than 1x1 are weighted like diag and
+            only the span is a dense form on its slice of the state.
+        - dense: any other Q.
+
+        A low-rank term U U^T, Q + U U^T, is applied as the squared norm of
+        the projection U^T x, the dense [sDim, sDim] matrix is never formed.
+
+        The block and low-rank paths are only taken when they touch at most
+        an eighth of the weights of the dense form, below that the single
+        dense product is faster. Q + U U^T is then applied dense.
+
+        The state fields are along dim: -2 for column states [..., sDim, 1],
+        -1 for row states [..., sDim] and 0 for the structure of arrays
+        layout [sDim, n, k].
+
+        - input:
+        --------
+            - Q: the weights, a vector of the diagonal or a matrix.
+                shape [sDim] or [sDim, sDim]
+            - factor: the low rank factor U or None. shape [sDim, r]
+            - structured: Bool, if false Q + U U^T is always applied as a
+                dense matrix, the reference of the fast paths.
+    '''
+    span: Tuple[int, int]
+
+    def __init__(self, Q, factor=None, structured=True):
+        super(QuadraticForm, self).__init__()
+        Q = torch.as_tensor(Q)
+        if Q.dim() == 1:
+            Q = torch.diag(Q)
+        if Q.dim() != 2 or Q.shape[0] != Q.shape[1]:
+            raise ValueError(f"Q needs to be a vector or a square matrix, got shape {list(Q.shape)}.")
+        self.lowRank = factor is not None
+        U = torch.as_tensor(factor, dtype=Q.dtype) if self.lowRank else torch.zeros(Q.shape[0], 0, dtype=Q.dtype)
+        if U.dim() != 2 or U.shape[0] != Q.shape[0]:
+            raise ValueError(f"The low rank factor needs the shape [{Q.shape[0]}, r], got {list(U.shape)}.")
+
+        self.span = (0, 0)
+        self.structure = "dense"
+        if structured:
+            m = Q.shape[0]
+            blocks = diagonal_blocks(Q)
+            if len(blocks) > 0:
+                start = blocks[0][0]
+                self.span = (start, blocks[-1][0] + blocks[-1][1] - start)
+            # Weights touched by the structured form. Small states are
+            # faster with one dense product, the structure only pays when
+            # it touches at most an eighth of the dense weights.
+            touched = m + self.span[1]**2 + m*U.shape[1]
+            if len(blocks) == 0 and not self.lowRank:
+                self.structure = "diag"
+            elif 8*touched <= m*m:
+                self.structure = "block" if len(blocks) > 0 else "diag"
+        if self.structure == "dense":
+            Q = Q + torch.matmul(U, U.T)
+            self.lowRank = False
+            self.span = (0, 0)
+
+        # Diagonal weights of the fields outside the span.
+        single = torch.diagonal(Q).clone()
+        single[self.span[0]:self.span[0] + self.span[1]] = 0.
+        self.register_buffer("Q", Q)
+        self.register_buffer("qDiag", single)
+        self.register_buffer("qSpan", Q[self.span[0]:self.span[0] + self.span[1],
+                                       self.span[0]:self.span[0] + self.span[1]].clone())
+        self.register_buffer("U", U)
+
+    '''
+        Computes the form.
+
+        input:
+        ------
+            - x: the state deviations, the fields along dim.
+            - dim: Int, the dimension of the fields, -2, -1 or 0.
+
+        output:
+        -------
+            - x^T Q x, the shape of x without dim.
+    '''
+    def forward(self, x, dim: int):
+        if self.structure == "dense":
+            res = dense_form(x, self.Q, dim)
+        else:
+            res = diag_form(x, self.qDiag, dim)
+            if self.structure == "block":
+                res = torch.add(res, dense_form(torch.narrow(x, dim, self.span[0], self.span[1]),
+                                                self.qSpan, dim))
+        if self.lowRank:
+            res = torch.add(res, torch.sum(torch.square(project(x, self.U, dim)), dim=dim))
+        return res
+
+
+def diag_form(x, w, dim: int):
+    '''
+        x^T diag(w) x with the fields of x along dim, see QuadraticForm.
+    '''
+    if dim == -1:
+        return torch.matmul(torch.square(x), w)
+    if dim == -2:
+        return torch.matmul(torch.transpose(torch.square(x), -1, -2), w)
+    return torch.tensordot(w, torch.square(x), dims=1)
+
+
+def dense_form(x, Q, dim: int):
+    '''
+        x^T Q x with the fields of x along dim, see QuadraticForm.
+    '''
+    if dim == -1:
+        return torch.sum(x*torch.matmul(x, Q.T), dim=-1)
+    if dim == -2:
+        return torch.sum(x*torch.matmul(Q, x), dim=-2)
+    return torch.sum(x*torch.tensordot(Q, x, dims=1), dim=0)
+
+
+def project(x, U, dim: int):
+    '''
+        U^T x with the fields of x along dim, the result keeps the layout
+        with r fields.
+    '''
+    if dim == -1:
+        return torch.matmul(x, U)
+    if dim == -2:
+        return torch.matmul(U.T, x)
+    return torch.tensordot(U.T, x, dims=1)
+
+
+def diagonal_blocks(Q):
+    '''
+        Finds the contiguous diagonal blocks of a matrix, the smallest
+        ranges of fields with no weight coupling them to the other fields.
+
+        input:
+        ------
+            - Q: the matrix. shape [m, m]
+
+        output:
+        -------
+            - List of (start, size) of the blocks larger than 1x1. Empty if
+                Q is diagonal.
+    '''
+    coupled = (Q != 0) | (Q.T != 0)
+    blocks = []
+    start, end = 0, 0
+    for i in range(Q.shape[0]):
+        nz = torch.nonzero(coupled[i])
+        if nz.numel() > 0:
+            end = max(end, int(nz[-1]))
+        if i == end:
+            if end > start:
+                blocks.append((start, end - start + 1))
+            start, end = i + 1, i + 1
+    return blocks
@@ -1,5 +1,6 @@
 import torch
 from .cost_base import CostBase
+from .quadratic import QuadraticForm
 
 # TODO: compute all constants without tensorflow. Out of the graph computation.
 class Static(CostBase):
@@ -14,11 +15,22 @@ class Static(CostBase):
             - sigma: the noise covariance matrix. shape [aDim, aDim].
             - goal: target goal (psition; speed). shape [sDim, 1].
             - Q: weight matrix for the different part of the cost function. shape: [sDim, sDim]
+                or the diagonal, shape [sDim].
+            - diag: Bool, if true Q is given as its diagonal.
+            - risk, alpha: the ensemble risk aggregate, see CostBase.
+            - factor: low rank weight U, the weight matrix is then
+                Q + U U^T. shape [sDim, r] or None.
+            - structured: Bool, if true the structure of Q (diagonal,
+                block diagonal, low rank) is exploited, see QuadraticForm.
+                Otherwise the weight is a dense matrix.
     '''
-    def __init__(self, lam, gamma, upsilon, sigma, goal, Q, diag=False):
-        super(Static, self).__init__(lam, gamma, upsilon, sigma)
-        # TODO register buffer for those parameters.
-        self.register_buffer("Q", torch.diag(torch.tensor(Q)))
+    def __init__(self, lam, gamma, upsilon, sigma, goal, Q, diag=False, risk="mean", alpha=0.1,
+                 factor=None, structured=True):
+        super(Static, self).__init__(lam, gamma, upsilon, sigma, risk, alpha)
+        Q = torch.as_tensor(Q)
+        if diag and Q.dim() != 1:
+            raise ValueError(f"A diagonal Q is given as a vector, got shape {list(Q.shape)}.")
+        self.weight = QuadraticForm(Q, factor, structured)
         self.register_buffer("goal", torch.tensor(goal))
         
     def setGoal(self, goal):
@@ -35,10 +47,48 @@ class Static(CostBase):
         ---------
             - (state-goal)^T Q (state-goal)
     '''
-    def state_cost(self, state):
+    def state_cost(self, state, step: int=0):
         diff = torch.subtract(state, self.goal)
-        stateCost = torch.matmul(torch.transpose(diff, -1, -2), torch.matmul(self.Q, diff))
-        return stateCost
+        stateCost = self.weight(diff, -2)
+        return torch.unsqueeze(stateCost, dim=-1)
+
+    '''
+        Computes state cost for the static point, structure of arrays
+        layout.
+
+        - input:
+        --------
+            - state: current state. Shape: [sDim, n, k]
+
+        - output:
+        ---------
+            - (state-goal)^T Q (state-goal). Shape: [n, k]
+    '''
+    def state_cost_soa(self, state, step: int=0):
+        diff = torch.subtract(state, torch.unsqueeze(self.goal, dim=-1))
+        return self.weight(diff, 0)
+
+    '''
+        Computes state cost for the static point on row states, used for
+        whole trajectories.
+
+        - input:
+        --------
+            - states: the states. Shape: [..., sDim]
+
+        - output:
+        ---------
+            - (state-goal)^T Q (state-goal). Shape: [...]
+    '''
+    def state_cost_traj(self, states):
+        diff = torch.subtract(states, self.goal[..., 0])
+        return self.weight(diff, -1)
 
     def final_cost(self, state):
-        return self.state_cost(state)
\ No newline at end of file
+        return self.state_cost(state)
+
+    def final_cost_traj(self, states):
+        return self.state_cost_traj(states)
+
+    def final_cost_soa(self, state):
+        return self.state_cost_soa(state)
\ No newline at end of file
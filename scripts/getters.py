@@ -1,6 +1,15 @@
 from controllers.mppi_base import ControllerBase
+from controllers.anytime import AnytimeController
+from controllers.lagged import LaggedController
+from controllers.rollout import LocalRollout, ProcessPoolRollout
+from controllers.noise import Sampler
 from models.auv_torch import AUVFossen
+from models.ensemble import AUVEnsemble
+from models.auv_nn_torch import AUVNNSpeed
 from costs.static import Static
+from costs.elipse import Elipse, Elipse3D
+from costs.obstacles import Obstacles, voxelize, load_sdf
+from utils import load_param
 
 import numpy as np
 
@@ -8,24 +17,187 @@ import numpy as np
 #       Controller seciton         #
 ####################################
 
-def state(model, cost, observer, k, tau, lam, upsilon, sigma):
+def state(cont_dict, model, cost, observer, k, tau, lam, upsilon, sigma, n=None):
     return ControllerBase(model=model, cost=cost, observer=observer,
-                          k=k, tau=tau, lam=lam, upsilon=upsilon, sigma=sigma)
+                          k=k, tau=tau, lam=lam, upsilon=upsilon, sigma=sigma,
+                          n=n, workspace=cont_dict.get("workspace", False),
+                          chunk=cont_dict.get("chunk", None),
+                          backend=get_backend(cont_dict, model, cost, tau),
+                          sampler=get_sampler(cont_dict, tau, upsilon, sigma),
+                          knots=cont_dict.get("knots", None),
+                          interp=cont_dict.get("interp", "linear"),
+                          horizon=get_horizon(cont_dict, tau),
+                          norm=cont_dict.get("norm", False),
+                          elite=cont_dict.get("elite", 0),
+                          threshold=cont_dict.get("threshold", 0.),
+                          layout=cont_dict.get("layout", "aos"),
+                          trajectory=cont_dict.get("trajectory", False),
+                          precision=cont_dict.get("precision", "float64"),
+                          **get_termination(cont_dict),
+                          objectives=get_objectives(cont_dict, cost, lam, upsilon, sigma))
+
+def anytime(cont_dict, model, cost, observer, k, tau, lam, upsilon, sigma, n=None):
+    if cont_dict.get("workspace", False):
+        raise ValueError("The anytime controller is chunked, it has no workspace.")
+    return AnytimeController(model=model, cost=cost, observer=observer,
+                             k=k, tau=tau, lam=lam, upsilon=upsilon, sigma=sigma,
+                             n=n, chunk=cont_dict.get("chunk", None),
+                             backend=get_backend(cont_dict, model, cost, tau),
+                             sampler=get_sampler(cont_dict, tau, upsilon, sigma),
+                             knots=cont_dict.get("knots", None),
+                             interp=cont_dict.get("interp", "linear"),
+                             horizon=get_horizon(cont_dict, tau),
+                             norm=cont_dict.get("norm", False),
+                             elite=cont_dict.get("elite", 0),
+                             threshold=cont_dict.get("threshold", 0.),
+                             layout=cont_dict.get("layout", "aos"),
+                             trajectory=cont_dict.get("trajectory", False),
+                             precision=cont_dict.get("precision", "float64"),
+                             **get_termination(cont_dict),
+                             objectives=get_objectives(cont_dict, cost, lam, upsilon, sigma),
+                             budget=cont_dict.get("budget", cont_dict["dt"]),
+                             margin=cont_dict.get("margin", 0.8),
+                             kMin=cont_dict.get("k_min", None),
+                             kMax=cont_dict.get("k_max", None))
+
+# Controller options the lagged controller doesn't support.
+LAGGED_UNSUPPORTED = ["backend", "horizon", "layout", "trajectory", "terminate", "depth", "gap",
+                      "penalty", "compact", "objectives", "workspace"]
+
+def lagged(cont_dict, model, cost, observer, k, tau, lam, upsilon, sigma, n=None):
+    if not hasattr(model, "history"):
+        raise ValueError(f"The lagged controller needs a lagged model with a history, "
+                         f"got {type(model).__name__}.")
+    unsupported = [key for key in LAGGED_UNSUPPORTED if key in cont_dict]
+    if len(unsupported) > 0:
+        raise ValueError(f"The lagged controller doesn't support {'|'.join(unsupported)}.")
+    if cont_dict.get("history", model.history) != model.history:
+        raise ValueError(f"The controller history {cont_dict['history']} doesn't match "
+                         f"the model history {model.history}.")
+    return LaggedController(model=model, cost=cost, observer=observer,
+                            k=k, tau=tau, lam=lam, upsilon=upsilon, sigma=sigma,
+                            n=n, chunk=cont_dict.get("chunk", None),
+                            sampler=get_sampler(cont_dict, tau, upsilon, sigma),
+                            knots=cont_dict.get("knots", None),
+                            interp=cont_dict.get("interp", "linear"),
+                            norm=cont_dict.get("norm", False),
+                            elite=cont_dict.get("elite", 0),
+                            threshold=cont_dict.get("threshold", 0.),
+                            precision=cont_dict.get("precision", "float64"))
 
 def get_controller(cont_dict, model, cost, observer,
-                   k, tau, lam, upsilon, sigma):
+                   k, tau, lam, upsilon, sigma, n=None):
     switcher = {
         "state_controller": state,
+        "anytime_controller": anytime,
+        "lagged_controller": lagged,
     }
     controller_type = cont_dict["type"]
     getter = switcher.get(controller_type, lambda: "invalid controller type, \
-                          check spelling. Supported are: lagged_controller")
+                          check spelling. Supported are: state_controller|anytime_controller|lagged_controller")
+
+    return getter(
+        cont_dict=cont_dict, model=model, cost=cost, observer=observer, 
+        k=k, tau=tau, lam=lam, upsilon=upsilon, sigma=sigma, n=n
+    )
+
+'''
+    Reads the horizon schedule of the controller config. Either a list of
+    tau step durations or a dict of segments, e.g.
+        horizon:
+          steps: [10, 5]
+          dt: [0.1, 0.4]
+    for 10 steps of 0.1s followed by 5 steps of 0.4s.
+'''
+def get_horizon(cont_dict, tau):
+    if "horizon" not in cont_dict:
+        return None
+    horizon = cont_dict["horizon"]
+    if isinstance(horizon, dict):
+        dts = []
+        for steps, dt in zip(horizon["steps"], horizon["dt"]):
+            dts += [dt]*steps
+        horizon = dts
+    if len(horizon) != tau:
+        raise ValueError(f"The horizon schedule has {len(horizon)} steps, expected tau={tau}.")
+    return horizon
+
+'''
+    Reads the early termination options of the controller config, e.g.
+        terminate: true
+        depth: [-50.0, 0.0]
+        gap: 1000.0
+        penalty: 1000.0
+        compact: 5
+'''
+def get_termination(cont_dict):
+    return {"terminate": cont_dict.get("terminate", False),
+            "depth": cont_dict.get("depth", None),
+            "gap": cont_dict.get("gap", None),
+            "penalty": cont_dict.get("penalty", 1e3),
+            "compact": cont_dict.get("compact", 5)}
+
+'''
+    Builds the objectives scored by ControllerBase.score. Every entry of
+    the objectives list is a task config or the path of one, e.g.
+        objectives:
+          - "../config/tasks/static_cost_auv.yaml"
+          - "../config/tasks/elipse3d_task.default.yaml"
+    They share gamma with the cost of the controller.
+'''
+def get_objectives(cont_dict, cost, lam, upsilon, sigma):
+    if "objectives" not in cont_dict:
+        return None
+    objectives = []
+    for task in cont_dict["objectives"]:
+        task_dict = load_param(task) if isinstance(task, str) else task
+        objectives.append(get_cost(task_dict, lam, cost.gamma, upsilon, sigma))
+    return objectives
+
+####################################
+#      Rollout backend seciton     #
+####################################
+
+def local(cont_dict, model, cost, tau):
+    return LocalRollout()
+
+def process_pool(cont_dict, model, cost, tau):
+    return ProcessPoolRollout(model, cost, tau,
+                              workers=cont_dict.get("workers", 2),
+                              threads=cont_dict.get("threads", 1))
+
+def get_backend(cont_dict, model, cost, tau):
+    if "backend" not in cont_dict:
+        return None
+    switcher = {
+        "local": local,
+        "process_pool": process_pool,
+    }
+    backend_type = cont_dict["backend"]
+    getter = switcher.get(backend_type, lambda: "invalid backend type, \
+                          check spelling. Supported are: local|process_pool")
 
     return getter(
-        model=model, cost=cost, observer=observer, 
-        k=k, tau=tau, lam=lam, upsilon=upsilon, sigma=sigma
+        cont_dict=cont_dict, model=model, cost=cost, tau=tau
     )
 
+####################################
+#          Noise seciton           #
+####################################
+
+def get_sampler(cont_dict, tau, upsilon, sigma):
+    if "sampler" not in cont_dict:
+        return None
+    sampler_dict = cont_dict["sampler"]
+    # With knots the noise is only sampled on the knots.
+    steps = cont_dict.get("knots", None) or tau
+    return Sampler(sigma, upsilon, steps,
+                   seed=sampler_dict.get("seed", None),
+                   cholesky=sampler_dict.get("cholesky", False),
+                   sequence=sampler_dict.get("sequence", "gaussian"),
+                   bank=sampler_dict.get("bank", 0),
+                   background=sampler_dict.get("background", False))
+
 ####################################
 #          Model seciton           #
 ####################################
@@ -33,17 +205,38 @@ def get_controller(cont_dict, model, cost, observer,
 def auv(model_dict, dt, limMax, limMin):
     return AUVFossen(model_dict, dt)
 
+'''
+    Ensemble of AUVFossen parameterisations. The members are overrides of
+    the rest of the model config, e.g.
+        type: auv_ensemble
+        mass: 1862.87
+        ...
+        members:
+          - {}
+          - {mass: 1950.}
+          - {linear_damping: [-60., -55., -600., -250., -280., -90.]}
+'''
+def ensemble(model_dict, dt, limMax, limMin):
+    base = {key: value for key, value in model_dict.items() if key != "members"}
+    members = [dict(base, **member) for member in model_dict["members"]]
+    return AUVEnsemble(members, dt)
+
+def nn_speed(model_dict, dt, limMax, limMin):
+    return AUVNNSpeed(model_dict, dt)
+
 def rnn(model_dict, dt, limMax, limMin):
     pass
 
 def get_model(model_dict, dt, limMax, limMin):
     switcher = {
         "auv_fossen": auv,
+        "auv_ensemble": ensemble,
+        "auv_nn_speed_torch": nn_speed,
         "auv_rnn": rnn,
     }
     model_type = model_dict["type"]
     getter = switcher.get(model_type, lambda: "invalid model type, \
-                          check spelling. Supported are: auv_fossen|auv_rnn")
+                          check spelling. Supported are: auv_fossen|auv_ensemble|auv_nn_speed_torch|auv_rnn")
 
     return getter(
         model_dict=model_dict, dt=dt,
@@ -59,16 +252,53 @@ def static(cost_dict, lam, gamma, upsilon, sigma):
     Q = np.array(cost_dict['Q'])
     goal = np.array(cost_dict['goal'])[..., None]
     diag = cost_dict['diag']
-    return Static(lam, gamma, upsilon, sigma, goal, Q, diag)
+    factor = cost_dict.get("Q_factor", None)
+    return Static(lam, gamma, upsilon, sigma, goal, Q, diag,
+                  risk=cost_dict.get("risk", "mean"),
+                  alpha=cost_dict.get("cvar_alpha", 0.1),
+                  factor=np.array(factor) if factor is not None else None,
+                  structured=cost_dict.get("structured", True))
+
+def elipse(cost_dict, lam, gamma, upsilon, sigma, cls=Elipse):
+    return cls(lam, gamma, upsilon, sigma,
+               a=cost_dict["a"], b=cost_dict["b"],
+               center_x=cost_dict["center_x"], center_y=cost_dict["center_y"],
+               speed=cost_dict["speed"],
+               m_state=cost_dict["m_state"], m_vel=cost_dict["m_vel"],
+               center_z=cost_dict.get("center_z", 0.),
+               risk=cost_dict.get("risk", "mean"),
+               alpha=cost_dict.get("cvar_alpha", 0.1))
+
+def elipse3d(cost_dict, lam, gamma, upsilon, sigma):
+    return elipse(cost_dict, lam, gamma, upsilon, sigma, cls=Elipse3D)
+
+def obstacles(cost_dict, task, lam, gamma, upsilon, sigma):
+    obs_dict = cost_dict["obstacles"]
+    if "sdf" in obs_dict:
+        sdf = load_sdf(obs_dict["sdf"])
+    else:
+        sdf = voxelize(obs_dict["scene"], obs_dict["origin"], obs_dict["resolution"], obs_dict["shape"])
+    return Obstacles(lam, gamma, upsilon, sigma, task, sdf,
+                     origin=obs_dict["origin"], resolution=obs_dict["resolution"],
+                     radius=obs_dict.get("radius", 0.5),
+                     clearance=obs_dict.get("clearance", 1.),
+                     weight=obs_dict.get("weight", 1.),
+                     collision=obs_dict.get("collision", 1e4))
 
 def get_cost(cost_dict, lam, gamma, upsilon, sigma):
     switcher = {
         "static": static,
+        "elipse": elipse,
+        "elipse3d": elipse3d,
     }
     cost_type = cost_dict["type"]
     getter = switcher.get(cost_type, lambda: "invalid cost type, \
-                          check spelling. Supported are: static|elipse")
+                          check spelling. Supported are: static|elipse|elipse3d")
 
-    return getter(
+    cost = getter(
         cost_dict=cost_dict, lam=lam, gamma=gamma, upsilon=upsilon, sigma=sigma
-    )
\ No newline at end of file
+    )
+    # Any task can be given obstacles, see costs.obstacles.
+    if "obstacles" in cost_dict:
+        cost = obstacles(cost_dict, cost, lam, gamma, upsilon, sigma)
+    return cost
\ No newline at end of file
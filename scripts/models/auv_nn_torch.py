@@ -0,0 +1,366 @@
+import os
+import torch
+from typing import Optional
+from utils import dtype
+
+from models.model_utils import SE3enc, SE3integ
+
+
+ACTIVATIONS = {"relu": torch.nn.ReLU,
+               "leaky_relu": torch.nn.LeakyReLU,
+               "tanh": torch.nn.Tanh}
+
+# Weight and activation dtype of the inference precisions. int8 runs
+# dynamically quantized linear layers on float32 activations.
+PRECISIONS = {"float64": torch.float64,
+              "float32": torch.float32,
+              "bfloat16": torch.bfloat16,
+              "int8": torch.float32}
+
+
+class AUVNNSpeed(torch.nn.Module):
+    '''
+        Lagged neural network velocity model. A multilayer perceptron
+        predicts the velocity change over one step from the last history
+        steps. Every step is encoded by SE3enc as [orientation, velocity,
+        action]. SE3integ then integrates the pose with the current velocity
+        and adds the change to it.
+
+        The network input follows the training code of model_utils: the
+        state features of the history steps, oldest first, followed by
+        their actions, [x_{t-h+1}, ..., x_t, u_{t-h+1}, ..., u_t].
+
+        For rollouts, step keeps the encoded history in a circular buffer
+        [k, history, features] that is written once per step. The
+        columns of the first layer are permuted to the buffer order
+        instead of reordering the buffer, there is one permutation per
+        position of the newest slot.
+
+        - input:
+        --------
+            - model_dict: the model config. history, rot ("rot" or "quat",
+                the orientation encoding), trainedFile (a TorchScript
+                network, or a state dict if it ends with .pth), topology
+                (the hidden layer sizes, read from the trained file if
+                given), activation (relu|leaky_relu|tanh) and inference,
+                the arguments of set_inference, e.g.
+                    inference: {precision: int8}
+            - dt: Float, the step duration.
+    '''
+    def __init__(self, model_dict, dt=0.1):
+        super(AUVNNSpeed, self).__init__()
+        self.name = model_dict["type"]
+        self.dt = dt
+        self.history = int(model_dict.get("history", 1))
+        rot = model_dict.get("rot", "rot")
+        if rot not in ["rot", "quat"]:
+            raise ValueError(f"Unknown orientation encoding {rot}, supported are: rot|quat")
+        self.enc = SE3enc(rot=rot == "rot")
+        self.integ = SE3integ()
+        self.aDim = 6
+        self.features = len(self.enc)
+        self.sFeatures = self.features - self.aDim
+
+        weights = None
+        if "trainedFile" in model_dict:
+            weights = load_weights(model_dict["trainedFile"])
+            topology = [w.shape[0] for w, _ in weights[:-1]]
+        else:
+            topology = model_dict.get("topology", [128, 128, 128, 128, 128])
+        activation = model_dict.get("activation", "leaky_relu")
+        self.activation = activation
+        if activation not in ACTIVATIONS:
+            raise ValueError(f"Unknown activation {activation}, supported are: {'|'.join(ACTIVATIONS)}")
+
+        sizes = [self.history*self.features] + list(topology) + [self.aDim]
+        self.inLayer = torch.nn.Linear(sizes[0], sizes[1], dtype=dtype)
+        layers = []
+        for i in range(1, len(sizes) - 1):
+            layers += [ACTIVATIONS[activation](), torch.nn.Linear(sizes[i], sizes[i+1], dtype=dtype)]
+        self.body = torch.nn.Sequential(*layers)
+        for p in self.parameters():
+            p.requires_grad = False
+
+        if weights is not None:
+            linears = [self.inLayer] + [l for l in self.body if isinstance(l, torch.nn.Linear)]
+            if [tuple(w.shape) for w, _ in weights] != [tuple(l.weight.shape) for l in linears]:
+                raise ValueError(f"The trained network doesn't match {sizes} with history {self.history}.")
+            for (w, b), l in zip(weights, linears):
+                l.weight.copy_(w)
+                l.bias.copy_(b)
+
+        self.register_buffer("ringWeight", torch.zeros(self.history, sizes[1], sizes[0], dtype=dtype))
+        self.refresh()
+
+        # Reduced precision inference network, see set_inference.
+        self.inference = False
+        self.precision = "float64"
+        self.infDtype = dtype
+        self.keep = []
+        self.infFirst = torch.nn.ModuleList()
+        self.infBody = torch.nn.Sequential()
+        if "inference" in model_dict:
+            self.set_inference(**model_dict["inference"])
+
+    '''
+        Permutes the columns of the first layer for every position of the
+        newest slot of the history buffer. Call it again if the weights
+        of the first layer change.
+    '''
+    @torch.jit.ignore
+    def refresh(self):
+        h, f, fs = self.history, self.features, self.sFeatures
+        slot = torch.arange(h)[:, None]
+        newest = torch.arange(h)[None, :]
+        # Lag of every slot, 0 the oldest step and h-1 the newest.
+        lag = torch.remainder(slot - newest - 1, h).T[..., None]
+        feat = torch.arange(f)[None, None, :]
+        cols = torch.where(feat < fs, lag*fs + feat, h*fs + lag*(f - fs) + feat - fs)
+        W = self.inLayer.weight
+        self.ringWeight = torch.permute(W[:, torch.reshape(cols, (h, h*f))], (1, 0, 2)).contiguous()
+
+    '''
+        Builds the inference network used by forward and step in place of
+        the float64 layers. Without arguments the float64 layers are used.
+        Call it again after refresh.
+
+        input:
+        ------
+            - precision: String, float64|float32|bfloat16|int8. int8
+                quantizes the weights of the linear layers to int8 and the
+                activations dynamically, per batch. CPU only.
+            - keep: List of Int or None, the linear layers kept in float32
+                with the int8 precision, 0 is the input layer. See
+                calibrate.
+    '''
+    @torch.jit.ignore
+    def set_inference(self, precision="float64", keep=None):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision}, supported are: {'|'.join(PRECISIONS)}")
+        if precision == "int8" and self.ringWeight.device.type != "cpu":
+            raise ValueError("The int8 precision is only supported on the cpu.")
+        self.precision = precision
+        self.inference = precision != "float64"
+        self.infDtype = PRECISIONS[precision]
+        self.keep = list(keep) if keep is not None else []
+        linears = [l for l in self.body if isinstance(l, torch.nn.Linear)]
+        last = len(linears)
+
+        def stage(weight, bias, i):
+            lin = torch.nn.Linear(weight.shape[1], weight.shape[0],
+                                  dtype=self.infDtype, device=weight.device)
+            with torch.no_grad():
+                lin.weight.copy_(weight)
+                lin.bias.copy_(bias)
+            if precision == "int8" and i not in self.keep:
+                lin = torch.ao.quantization.quantize_dynamic(
+                    torch.nn.Sequential(lin), {torch.nn.Linear}, dtype=torch.qint8)[0]
+            return Stage(lin, self.activation if i < last else "none")
+
+        # One input layer per newest slot of the history buffer.
+        self.infFirst = torch.nn.ModuleList(
+            [stage(w, self.inLayer.bias, 0) for w in self.ringWeight])
+        self.infBody = torch.nn.Sequential(
+            *[stage(l.weight, l.bias, i + 1) for i, l in enumerate(linears)])
+
+    '''
+        Casts and moves the float64 layers, then rebuilds the inference
+        network from them so that it keeps its own precision.
+    '''
+    def _apply(self, fn):
+        super(AUVNNSpeed, self)._apply(fn)
+        if self.inference:
+            self.set_inference(self.precision, self.keep)
+        return self
+
+    '''
+        Calibrates the int8 precision on a representative batch, e.g. the
+        histories seen in a rollout. Every linear layer is quantized alone
+        and the layers whose quantization error on the velocity change
+        exceeds tol are kept in float32. Then reports the error of the
+        resulting inference network against the float64 one. With another
+        precision only the report is computed.
+
+        input:
+        ------
+            - x: the state histories. Shape [k, history, 13]
+            - u: the action histories. Shape [k, history, 6]
+            - tol: Float, the relative error tolerated per layer.
+
+        output:
+        -------
+            - dict with keep, the layers kept in float32, layers, the
+                relative error of every layer quantized alone, error, the
+                relative rms error of the velocity change and max, its
+                largest absolute error.
+    '''
+    @torch.jit.ignore
+    def calibrate(self, x, u, tol=1e-2):
+        precision = self.precision
+        with torch.no_grad():
+            self.set_inference()
+            ref = self(x, u)[:, 7:] - x[:, -1, 7:]
+
+            def error():
+                delta = self(x, u)[:, 7:] - x[:, -1, 7:]
+                return float(torch.linalg.vector_norm(delta - ref)/torch.linalg.vector_norm(ref)), \
+                    float(torch.max(torch.abs(delta - ref)))
+
+            layers = []
+            keep = []
+            if precision == "int8":
+                n = len([l for l in self.body if isinstance(l, torch.nn.Linear)]) + 1
+                for i in range(n):
+                    self.set_inference("int8", keep=[j for j in range(n) if j != i])
+                    layers.append(error()[0])
+                    if layers[-1] > tol:
+                        keep.append(i)
+            self.set_inference(precision, keep)
+            err, worst = error()
+        return {"keep": keep, "layers": layers, "error": err, "max": worst}
+
+    '''
+        Velocity change predicted by the inference network.
+
+        input:
+        ------
+            - inp: the encoded history in the slot order of the history
+                buffer. Shape [k, history*features]
+            - newest: Int, the slot of the current step.
+
+        output:
+        -------
+            - the velocity change, in the dtype of inp. Shape [k, 6]
+    '''
+    def delta_inference(self, inp, newest: int):
+        x = inp.to(self.infDtype)
+        y = x
+        for i, first in enumerate(self.infFirst):
+            if i == newest:
+                y = first(x)
+        return self.infBody(y).to(inp.dtype)
+
+    '''
+        Encodes one step of the batch.
+
+        input:
+        ------
+            - x: the states. Shape [k, 13]
+            - u: the actions. Shape [k, 6]
+
+        output:
+        -------
+            - the step features. Shape [k, features]
+    '''
+    @torch.jit.export
+    def encode(self, x, u):
+        return self.enc(x, u, False)
+
+    '''
+        Predicts the next state from a history of states and actions.
+
+        input:
+        ------
+            - x: the last history states, oldest first. Shape [k, history, 13]
+            - u: the actions applied in those states. Shape [k, history, 6]
+            - dt: Float or None, the integration step of the pose. Defaults
+                to the model dt. The velocity change is the one learned for
+                the training step.
+
+        output:
+        -------
+            - the next state. Shape [k, 13]
+    '''
+    def forward(self, x, u, dt:Optional[float]=None):
+        h = self.dt
+        if dt is not None:
+            h = dt
+        k = x.shape[0]
+        feat = torch.reshape(self.encode(torch.reshape(x, (-1, 13)), torch.reshape(u, (-1, self.aDim))),
+                             (k, self.history, self.features))
+        if self.inference:
+            # Chronological slots are the buffer order with the newest last.
+            delta = self.delta_inference(torch.reshape(feat, (k, -1)), self.history - 1)
+        else:
+            inp = torch.cat([torch.reshape(feat[..., :self.sFeatures], (k, -1)),
+                             torch.reshape(feat[..., self.sFeatures:], (k, -1))], dim=1)
+            delta = self.body(self.inLayer(inp))
+        return self.integ(x[:, -1], delta, h)
+
+    '''
+        Rollout step on a circular history buffer. The features of (x, u)
+        are written in slot newest, the older steps are the other slots.
+
+        input:
+        ------
+            - ring: the history buffer. Shape [k, history, features]
+            - newest: Int, the slot of the current step.
+            - x: the current states. Shape [k, 13]
+            - u: the actions. Shape [k, 6]
+
+        output:
+        -------
+            - the next states. Shape [k, 13]
+    '''
+    @torch.jit.export
+    def step(self, ring, newest: int, x, u):
+        k = x.shape[0]
+        ring[:, newest] = self.encode(x, u)
+        if self.inference:
+            return self.integ(x, self.delta_inference(torch.reshape(ring, (k, -1)), newest), self.dt)
+        y = torch.nn.functional.linear(torch.reshape(ring, (k, -1)),
+                                       self.ringWeight[newest], self.inLayer.bias)
+        return self.integ(x, self.body(y), self.dt)
+
+
+class Stage(torch.nn.Module):
+    '''
+        Linear layer followed by its activation, for the inference
+        network. The activation is applied in place on the layer output.
+
+        - input:
+        --------
+            - linear: the linear layer, float or dynamically quantized.
+            - activation: String, relu|leaky_relu|tanh|none.
+    '''
+    def __init__(self, linear, activation):
+        super(Stage, self).__init__()
+        self.linear = linear
+        self.activation = activation
+
+    def forward(self, x):
+        y = self.linear(x)
+        if self.activation == "relu":
+            return torch.relu_(y)
+        if self.activation == "leaky_relu":
+            return torch.nn.functional.leaky_relu_(y)
+        if self.activation == "tanh":
+            return torch.tanh_(y)
+        return y
+
+
+def load_weights(file):
+    '''
+        Reads the (weight, bias) pairs of the linear layers of a trained
+        multilayer perceptron, in order.
+
+        input:
+        ------
+            - file: String, a TorchScript network or a .pth state dict.
+
+        output:
+        -------
+            - list of (weight, bias) tensors.
+    '''
+    if not os.path.isfile(file):
+        raise FileNotFoundError(f"Trained network {file} not found.")
+    if file.endswith(".pth"):
+        params = torch.load(file, map_location="cpu")
+        if isinstance(params, torch.nn.Module):
+            params = params.state_dict()
+        params = list(params.values())
+    else:
+        params = list(torch.jit.load(file, map_location="cpu").parameters())
+    weights = [p for p in params if p.dim() == 2]
+    biases = [p for p in params if p.dim() == 1]
+    return list(zip(weights, biases))
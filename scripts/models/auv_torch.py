@@ -1,9 +1,20 @@
 import yaml
 import torch
 import numpy as np
+from typing import Dict, List, Optional
 from utils import dtype
 
 
+# Randomizable AUVFossen parameters: buffer, size and wether the draw is an
+# offset (True) or a factor (False).
+RANDOM_PARAMS = {"mass": ("rMass", 1, False),
+                 "volume": ("rVolume", 1, False),
+                 "mtot": ("rMtot", 1, False),
+                 "linear_damping": ("rLinDamp", 6, False),
+                 "quad_damping": ("rQuadDamp", 6, False),
+                 "cog": ("rCog", 3, True),
+                 "cob": ("rCob", 3, True)}
+
 def diag(tensor):
     diag_matrix = tensor.unsqueeze(1) * torch.eye(len(tensor))
     return diag_matrix
@@ -12,6 +23,10 @@ def diag_embed(tensor):
     return torch.stack([diag(s_) for s_ in tensor]) if tensor.dim() > 1 else diag(tensor)
 
 class AUVFossen(torch.nn.Module):
+    # Randomized parameters: [distribution (0 normal, 1 uniform), std or
+    # low, high].
+    randomSpec: Dict[str, List[float]]
+
     def __init__(self, dict={}, dt=0.1, file=None):
         super(AUVFossen, self).__init__()
         self.name = dict["type"]
@@ -31,6 +46,24 @@ class AUVFossen(torch.nn.Module):
         self.register_buffer("B", torch.tensor([[[0., 0., -1.], [0., 0., 0.], [1., 0., 0.]]], dtype=dtype))
         self.register_buffer("C", torch.tensor([[[0., 1., 0.], [-1., 0., 0.], [0., 0., 0.]]], dtype=dtype))
 
+        # Per sample parameters, drawn for a batch size by resample.
+        for name in ["rMass", "rVolume", "rMtot", "rLinDamp", "rQuadDamp", "rCog", "rCob"]:
+            self.register_buffer(name, torch.zeros(0, 0, dtype=dtype))
+        # Global sample index of every row of the batch, set by chunked
+        # controllers. Empty, row i is sample i.
+        self.register_buffer("rIndex", torch.zeros(0, dtype=torch.long))
+        if self.randomized and self.groups > 0:
+            self.resample(self.groups)
+
+        # Workspace buffers, empty until alloc_workspace is called.
+        self.ws = False
+        self.wsFlip = False
+        for name in ["wsJac", "wsProd", "wsPDot", "wsVDot", "wsD", "wsAbsV",
+                     "wsCori", "wsMv", "wsDv", "wsCv", "wsG", "wsRhs",
+                     "wsK1", "wsK2", "wsX", "wsOut0", "wsOut1", "wsNorm",
+                     "wsFz", "wsR"]:
+            self.register_buffer(name, torch.zeros(0, dtype=dtype))
+
     def init_param(self, dict, file=None):
         
         if file is not None:
@@ -131,20 +164,195 @@ class AUVFossen(torch.nn.Module):
                     torch.tensor(quadDam, dtype=dtype)),
                 dim=0),
             requires_grad=False)
-            
-    def forward(self, x, u, rk:int=2):
-        # Rk2 integration.
-        # self.k = x.shape[0]
-        k1 = self.x_dot(x, u)
-        tmp = k1*self.dt
-        # if rk == 1:
-        #     tmp = k1*self.dt
 
-        if rk == 2:
-            k2 = self.x_dot(x + k1*self.dt, u)
-            tmp = (self.dt/2.)*(k1 + k2)
+        # Derivative kernel, "matrix" builds the rotation, jacobian,
+        # coriolis and damping matrices, "closed_form" evaluates the same
+        # derivatives with element-wise vector formulas.
+        if "kernel" in dict:
+            kernel = dict["kernel"]
+        else:
+            kernel = "matrix"
+
+        if kernel not in ["matrix", "closed_form"]:
+            raise ValueError(f"Unknown kernel {kernel}, supported are: matrix|closed_form")
+        self.closedForm = kernel == "closed_form"
+
+        # Integrator, the legacy rk key selects euler (1), rk2 (2) or
+        # rk4 (4), the integrator key takes precedence.
+        if "integrator" in dict:
+            integrator = dict["integrator"]
+        elif "rk" in dict:
+            integrator = {1: "euler", 2: "rk2", 4: "rk4"}.get(dict["rk"], None)
+            if integrator is None:
+                raise ValueError(f"Unsupported rk order {dict['rk']}, supported are: 1|2|4")
+        else:
+            integrator = "rk2"
+
+        if integrator not in ["euler", "rk2", "rk4", "semi_implicit"]:
+            raise ValueError(f"Unknown integrator {integrator}, "
+                             "supported are: euler|rk2|rk4|semi_implicit")
+        self.integrator = integrator
 
-        return self.norm_quat(x+tmp)
+        if "substeps" in dict:
+            self.substeps = int(dict["substeps"])
+        else:
+            self.substeps = 1
+        # Per sample randomization of the parameters, e.g.
+        #   randomize:
+        #     groups: 0          # 0, one draw per sample. Otherwise the
+        #                        # samples share groups draws round-robin.
+        #     seed: 0
+        #     mass: {dist: normal, std: 0.05}
+        #     linear_damping: {dist: uniform, low: 0.8, high: 1.2}
+        #     cob: {dist: normal, std: 0.01}
+        # mass, volume, mtot (one factor for the whole matrix),
+        # linear_damping and quad_damping (one factor per coefficient) are
+        # scaled by the drawn factor. cog and cob are offset by the draw,
+        # in meters. normal draws 1 + std*z for factors, std*z for offsets.
+        self.randomSpec = {}
+        self.groups = 0
+        self.seed = 0
+        self.draws = 0
+        if "randomize" in dict:
+            spec = dict["randomize"].copy()
+            self.groups = int(spec.pop("groups", 0))
+            seed = spec.pop("seed", None)
+            self.seed = int(seed) if seed is not None else torch.seed() % 2**62
+            for name, d in spec.items():
+                if name not in RANDOM_PARAMS:
+                    raise ValueError(f"Unknown randomized parameter {name}, "
+                                     f"supported are: {'|'.join(RANDOM_PARAMS)}")
+                if d["dist"] == "normal":
+                    self.randomSpec[name] = [0., float(d["std"]), 0.]
+                elif d["dist"] == "uniform":
+                    self.randomSpec[name] = [1., float(d["low"]), float(d["high"])]
+                else:
+                    raise ValueError(f"Unknown distribution {d['dist']}, supported are: normal|uniform")
+        # The randomized mode runs on the closed form derivatives.
+        self.randomized = len(self.randomSpec) > 0
+        if self.randomized:
+            self.closedForm = True
+
+        # A diagonal inertia is applied element-wise, otherwise with one
+        # [k, 6] x [6, 6] product.
+        self.mDiag = bool(torch.count_nonzero(
+            self.mTot[0] - torch.diag_embed(torch.diagonal(self.mTot[0]))) == 0)
+
+    '''
+        Draws a parameter set for every sample of a batch of k states, in
+        one vectorised pass per parameter. With groups the sets are drawn
+        at construction, otherwise ControllerBase draws one set per sample
+        at construction. Call it to redraw, e.g. once per control step.
+        Sample i of a batch uses set i modulo the number of sets.
+
+        input:
+        ------
+            - k: Int, the batch size.
+    '''
+    @torch.jit.ignore
+    def resample(self, k: int):
+        device = self.mTot.device
+        dt = self.mTot.dtype
+        m = self.groups if self.groups > 0 else k
+        idx = torch.remainder(torch.arange(k), m)
+        # Every draw has its own seed, the sequence is reproducible.
+        generator = torch.Generator().manual_seed(self.seed + self.draws)
+        self.draws += 1
+        for name, (buffer, size, offset) in RANDOM_PARAMS.items():
+            if name not in self.randomSpec:
+                value = torch.zeros(m, size, dtype=dt) if offset else torch.ones(m, size, dtype=dt)
+            else:
+                dist, a, b = self.randomSpec[name]
+                if dist == 0.:
+                    value = a*torch.randn(m, size, generator=generator, dtype=dt)
+                    if not offset:
+                        value = 1. + value
+                else:
+                    value = a + (b - a)*torch.rand(m, size, generator=generator, dtype=dt)
+            setattr(self, buffer, value[idx].to(device))
+
+    '''
+        Allocates every intermediate buffer of forward for a batch of k
+        states. Once called, forward writes in the workspace and returns
+        one of two ping-pong output buffers. The restoring terms are
+        cached here, call it again if the parameters are modified.
+
+        input:
+        ------
+            - k: Int, the batch size used in forward.
+    '''
+    @torch.jit.ignore
+    def alloc_workspace(self, k: int):
+        if self.integrator not in ["euler", "rk2"] or self.substeps != 1:
+            raise ValueError("The workspace only supports the euler and rk2 integrators without substeps.")
+        device = self.mTot.device
+        dt = self.mTot.dtype
+        # Pads of the jacobian are set once and never written again.
+        self.wsJac = torch.zeros(k, 7, 6, dtype=dt, device=device)
+        self.wsProd = torch.zeros(9, k, dtype=dt, device=device)
+        self.wsPDot = torch.zeros(k, 7, 1, dtype=dt, device=device)
+        self.wsVDot = torch.zeros(k, 6, 1, dtype=dt, device=device)
+        self.wsD = torch.zeros(k, 6, 6, dtype=dt, device=device)
+        self.wsAbsV = torch.zeros(k, 6, dtype=dt, device=device)
+        self.wsCori = torch.zeros(k, 6, 6, dtype=dt, device=device)
+        self.wsMv = torch.zeros(k, 6, 1, dtype=dt, device=device)
+        self.wsDv = torch.zeros(k, 6, 1, dtype=dt, device=device)
+        self.wsCv = torch.zeros(k, 6, 1, dtype=dt, device=device)
+        self.wsG = torch.zeros(k, 6, 1, dtype=dt, device=device)
+        self.wsRhs = torch.zeros(k, 6, 1, dtype=dt, device=device)
+        self.wsK1 = torch.zeros(k, 13, 1, dtype=dt, device=device)
+        self.wsK2 = torch.zeros(k, 13, 1, dtype=dt, device=device)
+        self.wsX = torch.zeros(k, 13, 1, dtype=dt, device=device)
+        self.wsOut0 = torch.zeros(k, 13, 1, dtype=dt, device=device)
+        self.wsOut1 = torch.zeros(k, 13, 1, dtype=dt, device=device)
+        self.wsNorm = torch.zeros(k, 1, 1, dtype=dt, device=device)
+
+        # Restoring force and moment only depend on the last row of
+        # rotBtoI: g = -[fz * R[2], r x R[2]].
+        fng = -self.mass * self.gravity
+        fnb = self.volume * self.density * self.gravity
+        self.wsFz = torch.reshape(fng + fnb, (1, 1))
+        self.wsR = fng * self.cog + fnb * self.cob
+        self.ws = True
+
+    '''
+        Integrates the dynamics over one step with the integrator of the
+        model config.
+
+        input:
+        ------
+            - x: the states. Shape [k, 13, 1]
+            - u: the actions. Shape [k, 6, 1]
+            - rk: Int or None, overrides the integrator, 1 for euler, 2
+                for rk2 and 4 for rk4.
+            - dt: Float or None, the step duration. Defaults to the
+                model dt, set by controllers with a non-uniform horizon.
+
+        output:
+        -------
+            - the next states. Shape [k, 13, 1]
+    '''
+    def forward(self, x, u, rk:Optional[int]=None, dt:Optional[float]=None):
+        h = self.dt
+        if dt is not None:
+            h = dt
+        integrator = self.integrator
+        if rk is not None:
+            integrator = self.rk_integrator(rk)
+        if self.randomized and self.rMass.shape[0] == 0:
+            raise RuntimeError("No parameter draws, call resample(k) first.")
+
+        # The workspace only covers the matrix derivatives.
+        if self.closedForm:
+            s = self.integrate(x[..., 0], u[..., 0], integrator, h, -1)
+            return torch.unsqueeze(s, dim=-1)
+
+        if self.ws:
+            if integrator not in ["euler", "rk2"]:
+                raise ValueError("The workspace only supports the euler and rk2 integrators, got " + integrator + ".")
+            return self.forward_ws(x, u, 2 if integrator == "rk2" else 1, h)
+
+        return self.integrate(x, u, integrator, h, 1)
 
     def x_dot(self, x, u):
         p, v = torch.split(x, [7, 6], dim=1)
@@ -154,6 +362,357 @@ class AUVFossen(torch.nn.Module):
         vDot = self.acc(v, u, rotBtoI)
         return torch.concat([pDot, vDot], dim=-2)
 
+    '''
+        Integrates the dynamics over one step with the states in the
+        structure of arrays layout: every field is a contiguous row over
+        the batch. Always uses the closed form derivatives.
+
+        input:
+        ------
+            - x: the states. Shape [13, k]
+            - u: the actions. Shape [6, k]
+            - rk: Int or None, overrides the integrator, see forward.
+            - dt: Float or None, the step duration. Defaults to the
+                model dt.
+
+        output:
+        -------
+            - the next states. Shape [13, k]
+    '''
+    @torch.jit.export
+    def forward_soa(self, x, u, rk:Optional[int]=None, dt:Optional[float]=None):
+        h = self.dt
+        if dt is not None:
+            h = dt
+        integrator = self.integrator
+        if rk is not None:
+            integrator = self.rk_integrator(rk)
+        if self.randomized and self.rMass.shape[0] == 0:
+            raise RuntimeError("No parameter draws, call resample(k) first.")
+        return self.integrate(x, u, integrator, h, 0)
+
+    '''
+        Integrates the dynamics over one step, in substeps sub steps.
+        The quaternion is normalized after every sub step.
+
+        input:
+        ------
+            - s: the states, the fields lie along dim.
+            - a: the actions, the fields lie along dim.
+            - integrator: String, euler|rk2|rk4|semi_implicit.
+            - h: Float, the step duration.
+            - dim: Int, the dimension of the state fields. 1 for
+                [k, 13, 1] column vectors and the matrix derivatives,
+                -1 for [k, 13] rows and 0 for [13, k] arrays with the
+                closed form derivatives.
+
+        output:
+        -------
+            - the next states, same layout as s.
+    '''
+    def integrate(self, s, a, integrator:str, h:float, dim:int):
+        h = h/self.substeps
+        for _ in range(self.substeps):
+            if integrator == "euler":
+                s = torch.add(s, self.deriv(s, a, dim), alpha=h)
+            elif integrator == "rk2":
+                k1 = self.deriv(s, a, dim)
+                k2 = self.deriv(torch.add(s, k1, alpha=h), a, dim)
+                s = torch.add(s, torch.add(k1, k2), alpha=h/2.)
+            elif integrator == "rk4":
+                k1 = self.deriv(s, a, dim)
+                k2 = self.deriv(torch.add(s, k1, alpha=h/2.), a, dim)
+                k3 = self.deriv(torch.add(s, k2, alpha=h/2.), a, dim)
+                k4 = self.deriv(torch.add(s, k3, alpha=h), a, dim)
+                inc = torch.add(torch.add(k1, k4), torch.add(k2, k3), alpha=2.)
+                s = torch.add(s, inc, alpha=h/6.)
+            else:
+                # Semi-implicit (symplectic) euler: the velocity is stepped
+                # first and the pose moves with the new velocity. The
+                # rotation is shared, a single derivative evaluation.
+                v = torch.add(torch.narrow(s, dim, 7, 6), self.vel_dot(s, a, dim), alpha=h)
+                p = torch.add(torch.narrow(s, dim, 0, 7), self.pose_dot(s, v, dim), alpha=h)
+                s = torch.cat([p, v], dim=dim)
+            s = self.norm_quat_dim(s, dim)
+        return s
+
+    def norm_quat_dim(self, s, dim:int):
+        quat = torch.narrow(s, dim, 3, 4)
+        norm = torch.linalg.vector_norm(quat, dim=dim, keepdim=True)
+        return torch.cat([torch.narrow(s, dim, 0, 3), quat/norm,
+                          torch.narrow(s, dim, 7, 6)], dim=dim)
+
+    def rk_integrator(self, rk:int) -> str:
+        if rk == 1:
+            return "euler"
+        if rk == 2:
+            return "rk2"
+        if rk == 4:
+            return "rk4"
+        raise ValueError("Unsupported rk order " + str(rk) + ", supported are: 1|2|4")
+
+    def deriv(self, s, a, dim:int):
+        if dim == 1:
+            return self.x_dot(s, a)
+        return self.x_dot_closed(s, a, dim)
+
+    def pose_dot(self, s, v, dim:int):
+        if dim == 1:
+            rotBtoI, tBtoI = self.body2inertial(s[:, 0:7])
+            return torch.bmm(self.jacobian(rotBtoI, tBtoI), v)
+        return self.pose_dot_closed(s, v, dim)
+
+    def vel_dot(self, s, a, dim:int):
+        if dim == 1:
+            rotBtoI, _ = self.body2inertial(s[:, 0:7])
+            return self.acc(s[:, 7:13], a, rotBtoI)
+        return self.vel_dot_closed(s, a, dim)
+
+    '''
+        State derivative with element-wise vector formulas, no rotation,
+        jacobian, coriolis or damping matrix is built.
+
+        input:
+        ------
+            - s: the states. Shape [k, 13] or [13, k]
+            - a: the actions. Shape [k, 6] or [6, k]
+            - dim: Int, the dimension of the state fields, -1 for states
+                as rows, 0 for the structure of arrays layout.
+
+        output:
+        -------
+            - the state derivatives, same layout as s.
+    '''
+    def x_dot_closed(self, s, a, dim:int=-1):
+        pDot = self.pose_dot_closed(s, torch.narrow(s, dim, 7, 6), dim)
+        return torch.cat([pDot, self.vel_dot_closed(s, a, dim)], dim=dim)
+
+    def pose_dot_closed(self, s, nu, dim:int):
+        q = torch.narrow(s, dim, 3, 3)
+        w = torch.narrow(s, dim, 6, 1)
+        lin = torch.narrow(nu, dim, 0, 3)
+        ang = torch.narrow(nu, dim, 3, 3)
+
+        # Position, lin rotated to the inertial frame: v + w t + q x t
+        # with t = 2 q x v.
+        t = 2.*torch.linalg.cross(q, lin, dim=dim)
+        pDot = lin + w*t + torch.linalg.cross(q, t, dim=dim)
+
+        # Quaternion, same ordering as the jacobian of body2inertial.
+        qDot0 = -0.5*torch.sum(q*ang, dim=dim, keepdim=True)
+        qDot = 0.5*(w*ang + torch.linalg.cross(q, ang, dim=dim))
+        return torch.cat([pDot, qDot0, qDot], dim=dim)
+
+    def vel_dot_closed(self, s, a, dim:int):
+        q = torch.narrow(s, dim, 3, 3)
+        w = torch.narrow(s, dim, 6, 1)
+        nu = torch.narrow(s, dim, 7, 6)
+        lin = torch.narrow(s, dim, 7, 3)
+        ang = torch.narrow(s, dim, 10, 3)
+
+        # Coriolis.
+        mv = self.inertia(nu, self.mTot[0], dim)
+        mScale = torch.ones(1, dtype=s.dtype, device=s.device)
+        if self.randomized:
+            mScale = self.sample_param(self.rMtot, s, dim)
+            mv = mv*mScale
+        cv = self.coriolis_closed(mv, lin, ang, dim)
+
+        # Damping, the matrices are diagonal.
+        ld = self.field(torch.diagonal(self.linDamp[0]), dim)
+        lf = self.field(torch.diagonal(self.linDampFow[0]), dim)
+        qd = self.field(torch.diagonal(self.quadDamp[0]), dim)
+        if self.randomized:
+            ld = ld*self.sample_param(self.rLinDamp, s, dim)
+            qd = qd*self.sample_param(self.rQuadDamp, s, dim)
+        dv = -(ld + lf*nu + qd*torch.abs(nu))*nu
+
+        # Restoring.
+        fng = -self.mass*self.gravity
+        fnb = self.volume*self.density*self.gravity
+        if self.randomized:
+            fng = fng*self.sample_param(self.rMass, s, dim)
+            fnb = fnb*self.sample_param(self.rVolume, s, dim)
+            cog = self.field(self.cog[0], dim) + self.sample_param(self.rCog, s, dim)
+            cob = self.field(self.cob[0], dim) + self.sample_param(self.rCob, s, dim)
+            r = fng*cog + fnb*cob
+        else:
+            r = self.field((fng*self.cog + fnb*self.cob)[0], dim)
+        g = self.restoring_closed(q, w, fng + fnb, r, dim)
+
+        vDot = self.inertia(a - cv - dv + g, self.invMtot[0], dim)
+        if self.randomized:
+            # The inverse of a scaled inertia.
+            vDot = vDot/mScale
+        return vDot
+
+    # Coriolis, C(v)v = [-a x ang, -a x lin - b x ang] with [a, b] = M v.
+    def coriolis_closed(self, mv, lin, ang, dim:int):
+        ma = torch.narrow(mv, dim, 0, 3)
+        mb = torch.narrow(mv, dim, 3, 3)
+        return torch.cat([-torch.linalg.cross(ma, ang, dim=dim),
+                          -torch.linalg.cross(ma, lin, dim=dim) - torch.linalg.cross(mb, ang, dim=dim)],
+                         dim=dim)
+
+    # Restoring force and moment [fz R3, r x R3], only the last row R3 of
+    # rotBtoI is needed. fz is the net vertical force and r the sum of the
+    # weight and buoyancy moments arms.
+    def restoring_closed(self, q, w, fz, r, dim:int):
+        x = torch.narrow(q, dim, 0, 1)
+        y = torch.narrow(q, dim, 1, 1)
+        z = torch.narrow(q, dim, 2, 1)
+        r3 = torch.cat([2.*(x*z - y*w), 2.*(y*z + x*w), 1. - 2.*(x*x + y*y)], dim=dim)
+        return torch.cat([fz*r3, torch.linalg.cross(r.expand_as(r3), r3, dim=dim)], dim=dim)
+
+    '''
+        Per sample parameter of the batch of s, laid out like the fields.
+
+        input:
+        ------
+            - param: torch.Tensor, the drawn parameter of every slot.
+                Shape [K, p]
+            - s: the states, the fields lie along dim.
+            - dim: Int, the dimension of the state fields.
+
+        output:
+        -------
+            - the parameters of every sample, row i uses the set
+                rIndex[i] modulo K, i modulo K without rIndex.
+                Shape [k, p] or [p, k]
+    '''
+    def sample_param(self, param, s, dim:int):
+        k = s.shape[1] if dim == 0 else s.shape[0]
+        if self.rIndex.shape[0] > 0:
+            if self.rIndex.shape[0] != k:
+                raise RuntimeError("The sample index doesn't match the batch size.")
+            param = param[torch.remainder(self.rIndex, param.shape[0])]
+        elif k <= param.shape[0]:
+            param = param[:k]
+        else:
+            idx = torch.remainder(torch.arange(k, device=param.device), param.shape[0])
+            param = param[idx]
+        if dim == 0:
+            return torch.transpose(param, 0, 1)
+        return param
+
+    def field(self, vec, dim:int):
+        # Broadcasts a per field vector along the batch.
+        if dim == 0:
+            return torch.unsqueeze(vec, dim=-1)
+        return vec
+
+    def inertia(self, vec, M, dim:int):
+        # M vec for every element of the batch.
+        if self.mDiag:
+            return vec*self.field(torch.diagonal(M), dim)
+        if dim == 0:
+            return torch.matmul(M, vec)
+        return torch.matmul(vec, M.transpose(0, 1))
+
+    def forward_ws(self, x, u, rk:int, h:float):
+        k1 = self.x_dot_ws(x, u, self.wsK1)
+
+        out = self.wsOut1 if self.wsFlip else self.wsOut0
+        self.wsFlip = not self.wsFlip
+
+        if rk == 2:
+            torch.add(x, k1, alpha=h, out=self.wsX)
+            k2 = self.x_dot_ws(self.wsX, u, self.wsK2)
+            k2.add_(k1)
+            torch.add(x, k2, alpha=h/2., out=out)
+        else:
+            torch.add(x, k1, alpha=h, out=out)
+
+        quat = out[:, 3:7]
+        torch.linalg.vector_norm(quat, dim=-2, keepdim=True, out=self.wsNorm)
+        quat.div_(self.wsNorm)
+        return out
+
+    def x_dot_ws(self, x, u, out):
+        p = x[:, 0:7]
+        v = x[:, 7:13]
+        self.body2inertial_ws(p)
+        torch.bmm(self.wsJac, v, out=self.wsPDot)
+        self.acc_ws(v, u, self.wsJac[:, 0:3, 0:3])
+        torch.cat([self.wsPDot, self.wsVDot], dim=-2, out=out)
+        return out
+
+    def body2inertial_ws(self, pose):
+        # Writes rotBtoI and tBtoI in the blocks of the jacobian buffer.
+        x = pose[:, 3, 0]
+        y = pose[:, 4, 0]
+        z = pose[:, 5, 0]
+        w = pose[:, 6, 0]
+        P = self.wsProd
+        torch.mul(x, x, out=P[0])
+        torch.mul(y, y, out=P[1])
+        torch.mul(z, z, out=P[2])
+        torch.mul(x, y, out=P[3])
+        torch.mul(x, z, out=P[4])
+        torch.mul(y, z, out=P[5])
+        torch.mul(x, w, out=P[6])
+        torch.mul(y, w, out=P[7])
+        torch.mul(z, w, out=P[8])
+
+        R = self.wsJac
+        torch.add(P[1], P[2], out=R[:, 0, 0]).mul_(-2.).add_(1.)
+        torch.sub(P[3], P[8], out=R[:, 0, 1]).mul_(2.)
+        torch.add(P[4], P[7], out=R[:, 0, 2]).mul_(2.)
+        torch.add(P[3], P[8], out=R[:, 1, 0]).mul_(2.)
+        torch.add(P[0], P[2], out=R[:, 1, 1]).mul_(-2.).add_(1.)
+        torch.sub(P[5], P[6], out=R[:, 1, 2]).mul_(2.)
+        torch.sub(P[4], P[7], out=R[:, 2, 0]).mul_(2.)
+        torch.add(P[5], P[6], out=R[:, 2, 1]).mul_(2.)
+        torch.add(P[0], P[1], out=R[:, 2, 2]).mul_(-2.).add_(1.)
+
+        T = self.wsJac[:, 3:7, 3:6]
+        torch.mul(x, -0.5, out=T[:, 0, 0])
+        torch.mul(y, -0.5, out=T[:, 0, 1])
+        torch.mul(z, -0.5, out=T[:, 0, 2])
+        torch.mul(w, 0.5, out=T[:, 1, 0])
+        torch.mul(z, -0.5, out=T[:, 1, 1])
+        torch.mul(y, 0.5, out=T[:, 1, 2])
+        torch.mul(z, 0.5, out=T[:, 2, 0])
+        torch.mul(w, 0.5, out=T[:, 2, 1])
+        torch.mul(x, -0.5, out=T[:, 2, 2])
+        torch.mul(y, -0.5, out=T[:, 3, 0])
+        torch.mul(x, 0.5, out=T[:, 3, 1])
+        torch.mul(w, 0.5, out=T[:, 3, 2])
+
+    def acc_ws(self, v, u, rotBtoI):
+        # Damping, D = -linDamp - v*linDampFow - quadDamp*|diag(v)|
+        D = self.wsD
+        torch.mul(v, self.linDampFow, out=D)
+        D.neg_().sub_(self.linDamp)
+        torch.abs(v[:, :, 0], out=self.wsAbsV)
+        self.wsAbsV.mul_(torch.diagonal(self.quadDamp[0]))
+        torch.diagonal(D, dim1=-2, dim2=-1).sub_(self.wsAbsV)
+        torch.bmm(D, v, out=self.wsDv)
+
+        # Coriolis, the skew blocks are filled from M v.
+        torch.matmul(self.mTot, v, out=self.wsMv)
+        a = self.wsMv[:, 0:3, 0]
+        b = self.wsMv[:, 3:6, 0]
+        C = self.wsCori
+        for blk, vec in [(C[:, 0:3, 3:6], a), (C[:, 3:6, 0:3], a), (C[:, 3:6, 3:6], b)]:
+            blk[:, 0, 1] = vec[:, 2]
+            torch.neg(vec[:, 1], out=blk[:, 0, 2])
+            torch.neg(vec[:, 2], out=blk[:, 1, 0])
+            blk[:, 1, 2] = vec[:, 0]
+            blk[:, 2, 0] = vec[:, 1]
+            torch.neg(vec[:, 0], out=blk[:, 2, 1])
+        torch.bmm(C, v, out=self.wsCv)
+
+        # Restoring
+        r2 = rotBtoI[:, 2]
+        G = self.wsG[:, :, 0]
+        torch.mul(r2, self.wsFz, out=G[:, 0:3])
+        torch.linalg.cross(self.wsR.expand_as(r2), r2, out=G[:, 3:6])
+
+        torch.sub(u, self.wsCv, out=self.wsRhs)
+        self.wsRhs.sub_(self.wsDv).add_(self.wsG)
+        torch.matmul(self.invMtot, self.wsRhs, out=self.wsVDot)
+
     def norm_quat(self, quatState):
         quat = quatState[:, 3:7].clone()
         norm = torch.linalg.norm(quat, dim=-2)[..., None]
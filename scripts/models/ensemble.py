@@ -0,0 +1,108 @@
+import torch
+from models.auv_torch import AUVFossen
+
+
+class AUVEnsemble(AUVFossen):
+    '''
+        Ensemble of AUVFossen parameterisations evaluated in a single
+        forward. The parameters of the members are stacked along a leading
+        member dimension and the closed form derivatives broadcast over
+        it, so one call steps every member for every sample.
+
+        The states of the batch are member-major: [E*k] rows where rows
+        [e*k, (e+1)*k) belong to member e. The actions are either shared by
+        the members, [k], or given per member, [E*k].
+
+        - input:
+        --------
+            - members: list of AUVFossen configs, one per member. They
+                need to share the integrator and the substeps.
+            - dt: Float, the step duration.
+    '''
+    def __init__(self, members, dt=0.1):
+        if len(members) == 0:
+            raise ValueError("The ensemble needs at least one member.")
+        models = [AUVFossen(dict(m, kernel="closed_form"), dt) for m in members]
+        super(AUVEnsemble, self).__init__(dict(members[0], kernel="closed_form"), dt)
+        for m in models:
+            if m.randomized:
+                raise ValueError("Ensemble members can't be randomized.")
+            if m.integrator != self.integrator or m.substeps != self.substeps:
+                raise ValueError("Ensemble members need to share the integrator and the substeps.")
+
+        self.members = len(models)
+        self.register_buffer("eMass", torch.stack([m.mass for m in models])[:, None])
+        self.register_buffer("eVolume", torch.stack([m.volume for m in models])[:, None])
+        self.register_buffer("eCog", torch.cat([m.cog for m in models]))
+        self.register_buffer("eCob", torch.cat([m.cob for m in models]))
+        self.register_buffer("eMtot", torch.cat([m.mTot for m in models]))
+        self.register_buffer("eInvMtot", torch.cat([m.invMtot for m in models]))
+        self.register_buffer("eLinDamp", torch.stack([torch.diagonal(m.linDamp[0]) for m in models]))
+        self.register_buffer("eLinDampFow", torch.stack([torch.diagonal(m.linDampFow[0]) for m in models]))
+        self.register_buffer("eQuadDamp", torch.stack([torch.diagonal(m.quadDamp[0]) for m in models]))
+        self.eDiag = all(m.mDiag for m in models)
+
+    @torch.jit.ignore
+    def alloc_workspace(self, k: int):
+        raise ValueError("The ensemble doesn't support the workspace mode.")
+
+    '''
+        Velocity derivative of every member. The batch is split in its
+        member blocks, the member parameters broadcast over the samples of
+        their block.
+
+        input:
+        ------
+            - s: the states. Shape [E*k, 13] or [13, E*k]
+            - a: the actions. Shape [k, 6], [E*k, 6] or transposed.
+            - dim: Int, the dimension of the state fields, -1 or 0.
+
+        output:
+        -------
+            - the velocity derivatives. Shape [E*k, 6] or [6, E*k]
+    '''
+    def vel_dot_closed(self, s, a, dim:int):
+        if dim == 0:
+            k = s.shape[1]//self.members
+            s = torch.reshape(s, (13, self.members, k))
+            a = torch.reshape(a, (6, -1, k))
+        else:
+            k = s.shape[0]//self.members
+            s = torch.reshape(s, (self.members, k, 13))
+            a = torch.reshape(a, (-1, k, 6))
+        q = torch.narrow(s, dim, 3, 3)
+        w = torch.narrow(s, dim, 6, 1)
+        nu = torch.narrow(s, dim, 7, 6)
+        lin = torch.narrow(s, dim, 7, 3)
+        ang = torch.narrow(s, dim, 10, 3)
+
+        cv = self.coriolis_closed(self.member_inertia(nu, self.eMtot, dim), lin, ang, dim)
+
+        ld = self.member(self.eLinDamp, dim)
+        lf = self.member(self.eLinDampFow, dim)
+        qd = self.member(self.eQuadDamp, dim)
+        dv = -(ld + lf*nu + qd*torch.abs(nu))*nu
+
+        fng = -self.member(self.eMass, dim)*self.gravity
+        fnb = self.member(self.eVolume, dim)*self.density*self.gravity
+        r = fng*self.member(self.eCog, dim) + fnb*self.member(self.eCob, dim)
+        g = self.restoring_closed(q, w, fng + fnb, r, dim)
+
+        vDot = self.member_inertia(a - cv - dv + g, self.eInvMtot, dim)
+        if dim == 0:
+            return torch.reshape(vDot, (6, -1))
+        return torch.reshape(vDot, (-1, 6))
+
+    def member(self, param, dim:int):
+        # [E, p] member parameters broadcast over the samples of a block.
+        if dim == 0:
+            return torch.unsqueeze(torch.transpose(param, 0, 1), dim=-1)
+        return torch.unsqueeze(param, dim=1)
+
+    def member_inertia(self, vec, M, dim:int):
+        # M_e vec for every sample of every member block.
+        if self.eDiag:
+            return vec*self.member(torch.diagonal(M, dim1=-2, dim2=-1), dim)
+        if dim == 0:
+            return torch.einsum("eij,jek->iek", M, vec)
+        return torch.matmul(vec, torch.transpose(M, 1, 2))
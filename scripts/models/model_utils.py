@@ -135,15 +135,14 @@ class SE3enc(torch.nn.Module):
         self.rot = rot
         self.normV = normV
         self.maxU = maxU
-        if self.rot:
-            self.b2i = Body2Inertial()
+        self.b2i = Body2Inertial()
 
-    def forward(self, x, u, norm):
+    def forward(self, x, u, norm: bool=False):
         pose = x[:, :7]
         vel = x[:, 7:]
         if norm:
             vel = (vel - self.normV[0]) / self.normV[1]
-            u = u / self.maxnU
+            u = u / self.maxU
         
         if self.rot:
             rot, _ = self.b2i(pose)
@@ -172,7 +171,7 @@ class SE3integ(torch.nn.Module):
         self.jac = Jacobian()
         self.norm_quat = NormQuat()
 
-    def forward(self, x, delta, dt=0.1):
+    def forward(self, x, delta, dt: float=0.1):
         pose = x[:, :7]
         vel = x[:, 7:]
         jac = self.jac(pose)
@@ -188,8 +187,8 @@ class SE3integ(torch.nn.Module):
 class Jacobian(torch.nn.Module):
     def __init__(self):
         super(Jacobian, self).__init__()
-        self.pad3x3 = torch.zeros(1, 3, 3)
-        self.pad4x3 = torch.zeros(1, 4, 3)
+        self.register_buffer("pad3x3", torch.zeros(1, 3, 3))
+        self.register_buffer("pad4x3", torch.zeros(1, 4, 3))
         self.b2i = Body2Inertial()
 
     def forward(self, pose):
@@ -45,7 +45,7 @@ def main():
     s = torch.tensor([0., 0., 0.,
                       0., 0., 0., 1.,
                       0., 0., 0.,
-                      0., 0., 0.], dtype=dtype)[..., None].double().to(device)
+                      0., 0., 0.], dtype=dtype)[..., None].to(device)
     
     ############################
     ### Instanciate normal controller: ###
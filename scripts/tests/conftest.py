@@ -0,0 +1,39 @@
+import os
+import sys
+
+import pytest
+
+SCRIPTS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG = os.path.join(os.path.dirname(SCRIPTS), "config")
+sys.path.insert(0, SCRIPTS)
+
+from utils import load_param
+
+
+def config(*path):
+    return load_param(os.path.join(CONFIG, *path))
+
+
+@pytest.fixture
+def rexrov2():
+    return config("models", "rexrov2.default.yaml")
+
+
+@pytest.fixture
+def rexrov2_ensemble():
+    return config("models", "rexrov2_ensemble.yaml")
+
+
+@pytest.fixture
+def static_task():
+    return config("tasks", "static_cost_auv.yaml")
+
+
+@pytest.fixture
+def elipse3d_task():
+    return config("tasks", "elipse3d_task.default.yaml")
+
+
+@pytest.fixture
+def controller_config():
+    return config("controller", "state.default.yaml")
@@ -0,0 +1,172 @@
+import pytest
+import torch
+
+from controllers.mppi_base import shift_map
+from getters import get_controller, get_cost, get_model
+from utils import dtype
+
+
+class FixedNoise:
+    '''
+        Sampler serving the samples of a fixed noise tensor in order, from
+        the start again once every sample was served.
+    '''
+    def __init__(self, noise):
+        self.noise = noise
+        self.pos = 0
+
+    def __call__(self, n, k, device, dtype):
+        out = self.noise[:n, self.pos:self.pos + k]
+        self.pos = (self.pos + k) % self.noise.shape[1]
+        return out.to(device=device, dtype=dtype)
+
+
+def state(n=2):
+    s = torch.zeros(n, 13, 1, dtype=dtype)
+    s[:, 6] = 1.
+    s[:, 0:3, 0] = torch.randn(n, 3, dtype=dtype)
+    return s
+
+
+def build(rexrov2, static_task, config, k=64, tau=8, n=2, lam=0.5):
+    sigma = config["noise"]
+    cost = get_cost(static_task, lam, 0.1, 1., sigma)
+    model = get_model(rexrov2, config["dt"], 0., 0.)
+    return get_controller(config, model, cost, None, k, tau, lam, 1., sigma, n=n)
+
+
+@pytest.mark.parametrize("key", ["norm", "workspace"])
+def test_anytime_rejects_unchunked_options(rexrov2, static_task, controller_config, key):
+    config = dict(controller_config, type="anytime_controller", chunk=16)
+    with pytest.raises(ValueError):
+        build(rexrov2, static_task, dict(config, **{key: True}))
+
+
+def test_lagged_rejects_unsupported_options(rexrov2, static_task):
+    config = {"type": "lagged_controller", "history": 2, "steps": 1, "dt": 0.1,
+              "noise": (100.*torch.eye(6, dtype=dtype)).tolist()}
+    lagged = {"type": "auv_nn_speed_torch", "history": 2}
+    build(lagged, static_task, config)
+    for key, value in [("layout", "soa"), ("trajectory", True), ("terminate", True),
+                       ("horizon", [0.1]*8), ("backend", "local"), ("workspace", True)]:
+        with pytest.raises(ValueError, match=key):
+            build(lagged, static_task, dict(config, **{key: value}))
+    with pytest.raises(ValueError, match="lagged model"):
+        build(rexrov2, static_task, config)
+
+
+@pytest.mark.parametrize("chunk", [16, 24])
+def test_chunked_matches_plain(rexrov2, static_task, controller_config, chunk):
+    # The running log-sum-exp over the chunks gives the update of all the
+    # samples at once, 24 doesn't divide k.
+    torch.manual_seed(0)
+    plain = build(rexrov2, static_task, controller_config, lam=1e4)
+    chunked = build(rexrov2, static_task, dict(controller_config, chunk=chunk), lam=1e4)
+    noise = plain.noise(64)
+    plain.set_sampler(FixedNoise(noise))
+    chunked.set_sampler(FixedNoise(noise))
+    s = state()
+    with torch.no_grad():
+        for _ in range(2):
+            ref = plain(s)
+            res = chunked(s)
+            assert torch.allclose(res, ref, rtol=0., atol=1e-12)
+            assert torch.allclose(chunked.ess, plain.ess, rtol=1e-12, atol=0.)
+
+
+def test_batched_matches_independent(rexrov2, static_task, controller_config):
+    # One n=2 controller against one unbatched controller per vehicle,
+    # every vehicle sees the same samples.
+    torch.manual_seed(0)
+    batched = build(rexrov2, static_task, controller_config, lam=1e4)
+    singles = [build(rexrov2, static_task, controller_config, n=None, lam=1e4) for _ in range(2)]
+    noise = batched.noise(64)
+    batched.set_sampler(FixedNoise(noise))
+    for i, single in enumerate(singles):
+        single.set_sampler(FixedNoise(noise[i:i + 1]))
+    s = state()
+    with torch.no_grad():
+        for _ in range(2):
+            res = batched(s)
+            for i, single in enumerate(singles):
+                assert torch.equal(res[i], single(s[i]))
+                assert torch.equal(batched.A[i], single.A)
+
+
+def test_uniform_horizon_matches_fixed_dt(rexrov2, static_task, controller_config):
+    torch.manual_seed(0)
+    fixed = build(rexrov2, static_task, controller_config, lam=1e4)
+    uniform = build(rexrov2, static_task, dict(controller_config, horizon=[0.1]*8), lam=1e4)
+    assert uniform.variableDt
+    noise = fixed.noise(64)
+    fixed.set_sampler(FixedNoise(noise))
+    uniform.set_sampler(FixedNoise(noise))
+    s = state()
+    A = 10.*torch.randn(2, 8, 6, 1, dtype=dtype)
+    with torch.no_grad():
+        fixed.prepare(s)
+        uniform.prepare(s)
+        ref = fixed.rollout_cost(s, noise, A)
+        assert torch.allclose(uniform.rollout_cost(s, noise, A), ref, rtol=1e-12, atol=0.)
+        for _ in range(2):
+            assert torch.allclose(uniform(s), fixed(s), rtol=0., atol=1e-12)
+            assert torch.allclose(uniform.A, fixed.A, rtol=0., atol=1e-12)
+
+
+def test_shift_map():
+    # Uniform steps shift by one step, the last one is reset.
+    idx, tail = shift_map([], 4)
+    assert idx.tolist() == [1, 2, 3, 0] and tail == 1
+    assert shift_map([0.1]*4, 4)[0].tolist() == idx.tolist()
+    # Step starts 0, 0.1, 0.2, 0.4, 0.6 over 1.0 s. Shifted by 0.1 s the
+    # steps starting at 0.3, 0.5 and 0.7 hold the action of the step
+    # they fall in.
+    idx, tail = shift_map([0.1, 0.1, 0.2, 0.2, 0.4], 5)
+    assert idx.tolist() == [1, 2, 2, 3, 4] and tail == 0
+    # Starts 0, 0.2, 0.4 over 0.5 s, shifted by 0.2 s the last step
+    # starts at 0.6, past the horizon.
+    idx, tail = shift_map([0.2, 0.2, 0.1], 3)
+    assert idx.tolist() == [1, 2, 0] and tail == 1
+
+
+def test_norm_reaches_the_update(rexrov2, static_task, controller_config):
+    assert build(rexrov2, static_task, dict(controller_config, norm=True)).update.norm
+    assert not build(rexrov2, static_task, controller_config).update.norm
+
+
+@pytest.mark.parametrize("task", ["static_task", "elipse3d_task"])
+def test_trajectory_cost_matches_per_step(rexrov2, controller_config, task, request):
+    task = request.getfixturevalue(task)
+    torch.manual_seed(0)
+    step = build(rexrov2, task, controller_config)
+    traj = build(rexrov2, task, dict(controller_config, trajectory=True))
+    noise = step.noise(64)
+    s = state()
+    A = 10.*torch.randn(2, 8, 6, 1, dtype=dtype)
+    with torch.no_grad():
+        step.prepare(s)
+        traj.prepare(s)
+        ref = step.rollout_cost(s, noise, A)
+        assert torch.allclose(traj.rollout_cost(s, noise, A), ref, rtol=1e-12, atol=0.)
+
+
+def test_score_matches_one_controller_per_objective(rexrov2, static_task, elipse3d_task, controller_config):
+    # The shared rollout scored under every objective gives the update of
+    # a controller run with that objective as its cost. The trajectory
+    # costs sum in another order than the per-step ones.
+    torch.manual_seed(0)
+    tasks = [static_task, elipse3d_task]
+    scorer = build(rexrov2, static_task, dict(controller_config, objectives=tasks), lam=1e4)
+    noise = scorer.noise(64)
+    scorer.set_sampler(FixedNoise(noise))
+    s = state()
+    A = scorer.A.clone()
+    with torch.no_grad():
+        res = scorer.score(s)
+        assert torch.equal(scorer.A, A)
+        for i, task in enumerate(tasks):
+            single = build(rexrov2, task, controller_config, lam=1e4)
+            single.set_sampler(FixedNoise(noise))
+            assert torch.allclose(res["action"][i], single(s), rtol=1e-12, atol=1e-10)
+            assert torch.allclose(res["sequence"][i], single.A, rtol=1e-12, atol=1e-10)
+            assert torch.allclose(res["ess"][i], single.ess, rtol=1e-10, atol=0.)
@@ -0,0 +1,117 @@
+import pytest
+import torch
+
+from costs.obstacles import Obstacles, voxelize
+from costs.quadratic import QuadraticForm
+from getters import get_controller, get_cost, get_model
+from utils import dtype
+
+
+def per_step(cost, A, noise):
+    # Sum over the steps of CostBase.action_cost, [n, k].
+    total = 0.
+    for t in range(A.shape[1]):
+        a = torch.unsqueeze(A[:, t], dim=1)
+        total = total + torch.squeeze(cost.action_cost(a, noise[:, :, t]), dim=(-2, -1))
+    return total
+
+
+def test_action_cost_traj_matches_per_step(static_task, controller_config):
+    torch.manual_seed(0)
+    sigma = controller_config["noise"]
+    cost = get_cost(static_task, 0.5, 0.1, 2., sigma)
+    A = 10.*torch.randn(3, 8, 6, 1, dtype=dtype)
+    noise = 100.*torch.randn(3, 32, 8, 6, 1, dtype=dtype)
+    with torch.no_grad():
+        traj = cost.action_cost_traj(torch.unsqueeze(A[..., 0], dim=1), noise[..., 0])
+        ref = per_step(cost, A, noise)
+    assert traj.shape == (3, 32, 8)
+    assert torch.allclose(torch.sum(traj, dim=-1), ref, rtol=1e-12, atol=0.)
+
+
+@pytest.mark.parametrize("interp", ["linear", "cubic"])
+def test_action_cost_traj_matches_per_step_with_knots(rexrov2, static_task, controller_config, interp):
+    # The knot noise is expanded to the tau steps before the hoisted cost.
+    torch.manual_seed(0)
+    sigma = controller_config["noise"]
+    cost = get_cost(static_task, 0.5, 0.1, 2., sigma)
+    model = get_model(rexrov2, controller_config["dt"], 0., 0.)
+    controller = get_controller(dict(controller_config, knots=4, interp=interp), model, cost, None,
+                                32, 8, 0.5, 2., sigma, n=2)
+    A = 10.*torch.randn(2, 8, 6, 1, dtype=dtype)
+    noise = controller.noise(32)
+    assert noise.shape[2] == 4
+    with torch.no_grad():
+        traj = cost.action_cost_traj(torch.unsqueeze(A[..., 0], dim=1), controller.expand(noise)[..., 0])
+        steps = torch.stack([controller.step_noise(noise, t) for t in range(8)], dim=2)
+        ref = per_step(cost, A, steps)
+    assert torch.allclose(torch.sum(traj, dim=-1), ref, rtol=1e-12, atol=0.)
+
+
+def block_weights(m):
+    # Diagonal weights with a dense 3x3 and a dense 4x4 block.
+    Q = torch.diag(100.*torch.rand(m, dtype=dtype))
+    w = torch.randn(3, 3, dtype=dtype)
+    Q[3:6, 3:6] = torch.matmul(w, w.T)
+    w = torch.randn(4, 4, dtype=dtype)
+    Q[7:11, 7:11] = torch.matmul(w, w.T)
+    return Q
+
+
+def reference(x, Q, U):
+    # x^T (Q + U U^T) x on row states.
+    return torch.einsum("...i,ij,...j->...", x, Q + torch.matmul(U, U.T), x)
+
+
+@pytest.mark.parametrize("m, kind, rank, structure", [
+    (13, "diag", 0, "diag"),
+    (64, "block", 0, "block"),
+    (64, "diag", 2, "diag"),
+    (64, "block", 2, "block"),
+    (13, "block", 2, "dense"),
+])
+def test_quadratic_form_paths(m, kind, rank, structure):
+    torch.manual_seed(0)
+    Q = block_weights(m) if kind == "block" else torch.diag(100.*torch.rand(m, dtype=dtype))
+    U = torch.randn(m, rank, dtype=dtype)
+    form = QuadraticForm(Q, U if rank > 0 else None)
+    assert form.structure == structure
+    assert form.lowRank == (rank > 0 and structure != "dense")
+
+    x = torch.randn(5, 7, m, dtype=dtype)
+    ref = reference(x, Q, U)
+    assert torch.allclose(form(x, -1), ref, rtol=1e-12, atol=0.)
+    assert torch.allclose(form(torch.unsqueeze(x, dim=-1), -2)[..., 0], ref, rtol=1e-12, atol=0.)
+    assert torch.allclose(form(torch.permute(x, (2, 0, 1)), 0), ref, rtol=1e-12, atol=0.)
+
+
+def test_static_matrix_weights(static_task, controller_config):
+    # A full matrix Q, diag: false, against the dense form.
+    torch.manual_seed(0)
+    sigma = controller_config["noise"]
+    Q = block_weights(13)
+    task = dict(static_task, diag=False, Q=Q.tolist())
+    cost = get_cost(task, 0.5, 0.1, 1., sigma)
+    dense = get_cost(dict(task, structured=False), 0.5, 0.1, 1., sigma)
+    assert cost.weight.structure == "dense"
+    assert torch.equal(cost.weight.Q, Q)
+
+    s = torch.randn(4, 16, 13, 1, dtype=dtype)
+    ref = reference(s[..., 0] - cost.goal[:, 0], Q, torch.zeros(13, 0, dtype=dtype))
+    with torch.no_grad():
+        assert torch.allclose(cost.state_cost(s)[..., 0, 0], ref, rtol=1e-12, atol=0.)
+        assert torch.allclose(dense.state_cost(s)[..., 0, 0], ref, rtol=1e-12, atol=0.)
+        assert torch.allclose(cost.state_cost_traj(s[..., 0]), ref, rtol=1e-12, atol=0.)
+
+
+def test_obstacles_reject_infinite_grids(static_task, controller_config):
+    sigma = controller_config["noise"]
+    task = get_cost(static_task, 0.5, 0.1, 1., sigma)
+    with pytest.raises(ValueError):
+        voxelize([], [0., 0., 0.], 1., [4, 4, 4])
+    sdf = voxelize([{"type": "sphere", "center": [1.5, 1.5, 1.5], "radius": 1.}], [0., 0., 0.], 1., [4, 4, 4])
+    cost = Obstacles(0.5, 0.1, 1., sigma, task, sdf, [0., 0., 0.], 1.)
+    assert torch.isfinite(cost.distance(10.*torch.randn(32, 3, dtype=dtype))).all()
+    sdf[0, 0, 0] = float("inf")
+    with pytest.raises(ValueError):
+        Obstacles(0.5, 0.1, 1., sigma, task, sdf, [0., 0., 0.], 1.)
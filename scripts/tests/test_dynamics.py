@@ -0,0 +1,61 @@
+import pytest
+import torch
+from models.auv_torch import AUVFossen
+
+
+def random_batch(k):
+    x = torch.randn(k, 13, 1, dtype=torch.float64)
+    x[:, 3:7] = x[:, 3:7]/torch.linalg.norm(x[:, 3:7], dim=1, keepdim=True)
+    u = 100.*torch.randn(k, 6, 1, dtype=torch.float64)
+    return x, u
+
+
+def kernels(rexrov2):
+    matrix = AUVFossen(rexrov2, 0.1).double()
+    closed = AUVFossen(dict(rexrov2, kernel="closed_form"), 0.1).double()
+    return matrix, closed
+
+
+def test_closed_form_matches_matrix(rexrov2):
+    torch.manual_seed(0)
+    matrix, closed = kernels(rexrov2)
+    x, u = random_batch(256)
+    with torch.no_grad():
+        ref = matrix.x_dot(x, u)[..., 0]
+        rows = closed.x_dot_closed(x[..., 0], u[..., 0], -1)
+        soa = closed.x_dot_closed(x[..., 0].T.contiguous(), u[..., 0].T.contiguous(), 0)
+    assert torch.allclose(rows, ref, rtol=1e-9, atol=1e-9)
+    assert torch.allclose(soa.T, ref, rtol=1e-9, atol=1e-9)
+
+
+def test_closed_form_step_matches_matrix(rexrov2):
+    torch.manual_seed(1)
+    matrix, closed = kernels(rexrov2)
+    x, u = random_batch(256)
+    with torch.no_grad():
+        ref = matrix(x.clone(), u)
+        aos = closed(x.clone(), u)
+        soa = closed.forward_soa(x[..., 0].T.contiguous(), u[..., 0].T.contiguous())
+    assert torch.allclose(aos, ref, rtol=1e-9, atol=1e-9)
+    assert torch.allclose(soa.T, ref[..., 0], rtol=1e-9, atol=1e-9)
+
+
+def test_unsupported_rk_raises(rexrov2):
+    model = AUVFossen(rexrov2, 0.1).double()
+    x, u = random_batch(4)
+    with pytest.raises(ValueError):
+        model(x, u, rk=3)
+    with pytest.raises(Exception, match="Unsupported rk order"):
+        torch.jit.script(model)(x, u, rk=3)
+
+
+def test_workspace_rejects_other_integrators(rexrov2):
+    model = AUVFossen(rexrov2, 0.1).double()
+    model.alloc_workspace(4)
+    x, u = random_batch(4)
+    ref = AUVFossen(rexrov2, 0.1).double()
+    assert torch.allclose(model(x, u, rk=1), ref(x, u, rk=1), rtol=1e-12, atol=1e-12)
+    with pytest.raises(ValueError):
+        model(x, u, rk=4)
+    with pytest.raises(Exception, match="workspace only supports"):
+        torch.jit.script(model)(x, u, rk=4)
@@ -0,0 +1,38 @@
+import pytest
+import torch
+
+from getters import get_cost, get_model
+from models.auv_torch import AUVFossen
+from utils import dtype
+
+
+def test_members_match_standalone_models(rexrov2_ensemble):
+    ens_dict = rexrov2_ensemble
+    ensemble = get_model(ens_dict, 0.1, 0., 0.)
+    base = {key: value for key, value in ens_dict.items() if key != "members"}
+    singles = [AUVFossen(dict(base, **member), 0.1) for member in ens_dict["members"]]
+    E, k = ensemble.members, 32
+    assert E == len(singles) > 1
+
+    torch.manual_seed(0)
+    x = torch.randn(E*k, 13, 1, dtype=dtype)
+    x[:, 3:7] = x[:, 3:7]/torch.linalg.norm(x[:, 3:7], dim=1, keepdim=True)
+    u = 100.*torch.randn(k, 6, 1, dtype=dtype)
+    with torch.no_grad():
+        res = torch.reshape(ensemble(x, u), (E, k, 13, 1))
+        soa = torch.reshape(ensemble.forward_soa(x[..., 0].T.contiguous(), u[..., 0].T.contiguous()).T,
+                            (E, k, 13))
+        for e, single in enumerate(singles):
+            ref = single(x[e*k:(e + 1)*k], u)
+            assert torch.allclose(res[e], ref, rtol=1e-12, atol=1e-12)
+            assert torch.allclose(soa[e], ref[..., 0], rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize("risk, expected", [("mean", [[2.5, 25.]]),
+                                            ("worst", [[4., 40.]]),
+                                            ("cvar", [[3.5, 35.]])])
+def test_risk_aggregate(static_task, controller_config, risk, expected):
+    # 4 members, cvar with alpha 0.5 averages the 2 worst.
+    cost = get_cost(dict(static_task, risk=risk, cvar_alpha=0.5), 0.5, 0.1, 1., controller_config["noise"])
+    costs = torch.tensor([[[1., 40.]], [[4., 10.]], [[2., 30.]], [[3., 20.]]], dtype=dtype)
+    assert torch.equal(cost.risk_aggregate(costs), torch.tensor(expected, dtype=dtype))
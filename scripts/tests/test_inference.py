@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+from models.auv_nn_torch import AUVNNSpeed
+
+
+def histories(k, history):
+    x = torch.randn(k, history, 13, dtype=torch.float64)
+    x[..., 3:7] = x[..., 3:7]/torch.linalg.norm(x[..., 3:7], dim=-1, keepdim=True)
+    u = torch.randn(k, history, 6, dtype=torch.float64)
+    return x, u
+
+
+# Relative rms error bound of the velocity change against float64.
+@pytest.mark.parametrize("precision, tol", [("float32", 1e-6), ("bfloat16", 2e-2), ("int8", 3e-2)])
+def test_inference_error(precision, tol):
+    torch.manual_seed(0)
+    model = AUVNNSpeed({"type": "auv_nn_speed_torch", "history": 4}, 0.1)
+    x, u = histories(256, 4)
+    with torch.no_grad():
+        ref = model(x, u)
+        model.set_inference(precision)
+        report = model.calibrate(x, u)
+        out = model(x, u)
+    assert model.precision == precision
+    assert report["error"] < tol
+    delta, refDelta = out[:, 7:] - x[:, -1, 7:], ref[:, 7:] - x[:, -1, 7:]
+    err = torch.linalg.vector_norm(delta - refDelta)/torch.linalg.vector_norm(refDelta)
+    assert err < tol
+    # The pose is integrated in float64 from the current velocity.
+    assert torch.equal(out[:, :7], ref[:, :7])
+
+
+@pytest.mark.parametrize("history", [1, 2, 3, 4])
+def test_ring_step_matches_forward(history):
+    # The newest step can sit in any slot of the ring buffer.
+    torch.manual_seed(0)
+    model = AUVNNSpeed({"type": "auv_nn_speed_torch", "history": history}, 0.1)
+    x, u = histories(64, history)
+    with torch.no_grad():
+        ref = model(x, u)
+        for offset in range(history):
+            ring = torch.zeros(64, history, model.features, dtype=torch.float64)
+            for j in range(history - 1):
+                ring[:, (offset + j) % history] = model.encode(x[:, j], u[:, j])
+            res = model.step(ring, (offset + history - 1) % history, x[:, -1], u[:, -1])
+            assert torch.allclose(res, ref, rtol=1e-12, atol=1e-12)
@@ -0,0 +1,59 @@
+import pytest
+import torch
+
+from controllers.noise import Sampler
+from utils import dtype
+
+
+def test_same_seed_same_noise():
+    sigma = torch.diag(torch.arange(1., 7., dtype=dtype)).tolist()
+    a, b = Sampler(sigma, tau=4, seed=3), Sampler(sigma, tau=4, seed=3)
+    for _ in range(2):
+        noise = a(2, 16)
+        assert noise.shape == (2, 16, 4, 6, 1)
+        assert torch.equal(noise, b(2, 16))
+    assert not torch.equal(Sampler(sigma, tau=4, seed=4)(2, 16), Sampler(sigma, tau=4, seed=3)(2, 16))
+
+
+def test_cholesky_factor():
+    w = torch.randn(6, 6, dtype=dtype, generator=torch.Generator().manual_seed(0))
+    sigma = torch.matmul(w, w.T) + torch.eye(6, dtype=dtype)
+    sampler = Sampler(sigma.tolist(), upsilon=2., tau=1, seed=0, cholesky=True)
+    assert not sampler.diag
+    assert torch.allclose(torch.matmul(sampler.L, sampler.L.T), 2.*sigma, rtol=1e-12, atol=1e-12)
+    z = Sampler(torch.eye(6).tolist(), tau=1, seed=0)(1, 8)
+    assert torch.allclose(sampler(1, 8), torch.matmul(sampler.L, z), rtol=1e-12, atol=1e-12)
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_bank_wraps_around(background):
+    # A bank of 10 served 4 by 4, the third draw wraps to the start of the
+    # ring, refilled with fresh samples.
+    eye = torch.eye(6, dtype=dtype).tolist()
+    sampler = Sampler(eye, tau=2, seed=0, bank=10, background=background)
+    first = sampler.bank.clone()
+    # The bank holds the stream of an unbanked sampler of the same seed.
+    assert torch.equal(torch.reshape(Sampler(eye, tau=2, seed=0)(1, 10), (10, 12)), first)
+
+    assert torch.equal(torch.reshape(sampler(1, 4), (4, 12)), first[0:4])
+    assert torch.equal(torch.reshape(sampler(1, 4), (4, 12)), first[4:8])
+    z = torch.reshape(sampler(1, 4), (4, 12))
+    sampler.wait()
+    assert torch.equal(z[0:2], first[8:10])
+    assert not torch.equal(z[2:4], first[0:2])
+    assert sampler.head == 2
+    with pytest.raises(ValueError):
+        sampler(1, 11)
+
+
+@pytest.mark.parametrize("sequence", ["sobol", "halton"])
+def test_low_discrepancy_sequences(sequence):
+    sampler = Sampler(torch.eye(6, dtype=dtype).tolist(), tau=2, seed=0, sequence=sequence)
+    noise = sampler(2, 512)
+    assert noise.shape == (2, 512, 2, 6, 1) and noise.dtype == dtype
+    assert torch.isfinite(noise).all()
+    z = torch.reshape(noise, (-1, 12))
+    assert torch.all(torch.abs(torch.mean(z, dim=0)) < 0.05)
+    assert torch.all(torch.abs(torch.std(z, dim=0) - 1.) < 0.05)
+    # The sequence continues, it doesn't restart.
+    assert not torch.equal(sampler(2, 512), noise)
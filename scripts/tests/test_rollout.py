@@ -0,0 +1,128 @@
+import pytest
+import torch
+
+from controllers.rollout import LocalRollout, ProcessPoolRollout, _pack
+from getters import get_controller, get_cost, get_model
+from utils import dtype
+
+
+def make_controller(rexrov2, static_task, controller_config, k=64, tau=8, n=2):
+    sigma = controller_config["noise"]
+    cost = get_cost(static_task, 0.5, 0.1, 1., sigma)
+    model = get_model(rexrov2, controller_config["dt"], 0., 0.)
+    return get_controller(controller_config, model, cost, None, k, tau, 0.5, 1., sigma, n=n)
+
+
+def test_pool_matches_local(rexrov2, static_task, controller_config):
+    controller = make_controller(rexrov2, static_task, controller_config)
+    torch.manual_seed(0)
+    s = torch.zeros(2, 13, 1, dtype=dtype)
+    s[:, 6] = 1.
+    s[1, 0:3, 0] = torch.tensor([1., -1., -2.], dtype=dtype)
+    noise = controller.noise(controller.k)
+    A = torch.randn(2, controller.tau, 6, 1, dtype=dtype)
+
+    with torch.no_grad():
+        controller.prepare(s)
+        local = LocalRollout()(controller, s, noise, A)
+        with ProcessPoolRollout(controller.model, controller.cost, controller.tau, workers=2) as pool:
+            pooled = pool(controller, s, noise, A)
+
+    assert pooled.shape == (2, controller.k)
+    assert torch.allclose(pooled, local, rtol=1e-12, atol=0.)
+
+
+def test_pack_copies_eager_modules(rexrov2, static_task, controller_config):
+    # The pool ships copies, the modules of the caller stay on their device.
+    controller = make_controller(rexrov2, static_task, controller_config)
+    kind, model = _pack(controller.model)
+    assert kind == "eager" and model is not controller.model
+    for a, b in zip(model.buffers(), controller.model.buffers()):
+        assert torch.equal(a, b)
+        if a.numel() > 0:
+            assert a.data_ptr() != b.data_ptr()
+
+
+def test_chunks_use_the_draws_of_their_samples(rexrov2, static_task, controller_config):
+    # Every chunk of a randomized model rolls out with the parameter sets
+    # of its global samples, locally and on the pool.
+    rexrov2 = dict(rexrov2, randomize={"seed": 0, "linear_damping": {"dist": "uniform", "low": 0.5, "high": 1.5},
+                                       "quad_damping": {"dist": "uniform", "low": 0.5, "high": 1.5}})
+    controller = make_controller(rexrov2, static_task, dict(controller_config, chunk=16))
+    torch.manual_seed(0)
+    s = torch.zeros(2, 13, 1, dtype=dtype)
+    s[:, 6] = 1.
+    noise = controller.noise(controller.k)
+    A = torch.randn(2, controller.tau, 6, 1, dtype=dtype)
+
+    with torch.no_grad():
+        controller.prepare(s)
+        full = controller.rollout_cost(s, noise, A)
+        with ProcessPoolRollout(controller.model, controller.cost, controller.tau, workers=2) as pool:
+            for lo in range(0, controller.k, controller.chunk):
+                hi = lo + controller.chunk
+                controller.select_draws(2, lo, controller.chunk)
+                local = controller.rollout_cost(s, noise[:, lo:hi], A)
+                pooled = pool(controller, s, noise[:, lo:hi], A)
+                assert torch.allclose(local, full[:, lo:hi], rtol=1e-12, atol=0.)
+                assert torch.allclose(pooled, full[:, lo:hi], rtol=1e-12, atol=0.)
+        controller.select_draws(2, 0, 0)
+
+
+def test_pool_matches_local_with_termination(rexrov2, static_task, controller_config):
+    # Terminated samples are compacted away, the pool returns the costs
+    # and the counters of a local rollout of the same shards. The penalty
+    # is relative to the worst live sample of the shard.
+    config = dict(controller_config, terminate=True, depth=[-0.05, 0.05], compact=2)
+    controller = make_controller(rexrov2, static_task, config)
+    torch.manual_seed(0)
+    s = torch.zeros(2, 13, 1, dtype=dtype)
+    s[:, 6] = 1.
+    noise = 5.*controller.noise(controller.k)
+    A = torch.zeros(2, controller.tau, 6, 1, dtype=dtype)
+
+    with torch.no_grad():
+        controller.prepare(s)
+        half = controller.k//2
+        local = torch.cat([LocalRollout()(controller, s, noise[:, :half], A),
+                           LocalRollout()(controller, s, noise[:, half:], A)], dim=1)
+        counters = (controller.liveSteps, controller.skippedSteps, controller.terminated)
+        controller.prepare(s)
+        with ProcessPoolRollout(controller.model, controller.cost, controller.tau, workers=2) as pool:
+            pooled = pool(controller, s, noise, A)
+
+    assert 0 < counters[2] < 2*controller.k and counters[1] > 0
+    assert (controller.liveSteps, controller.skippedSteps, controller.terminated) == counters
+    assert torch.allclose(pooled, local, rtol=1e-12, atol=0.)
+
+
+def test_pool_raises_on_dead_worker(rexrov2, static_task, controller_config):
+    controller = make_controller(rexrov2, static_task, controller_config, k=8, tau=2)
+    s = torch.zeros(2, 13, 1, dtype=dtype)
+    s[:, 6] = 1.
+    noise = controller.noise(controller.k)
+    A = torch.zeros(2, controller.tau, 6, 1, dtype=dtype)
+    with ProcessPoolRollout(controller.model, controller.cost, controller.tau, workers=2, poll=0.1) as pool:
+        pool.procs[0].terminate()
+        pool.procs[0].join()
+        with pytest.raises(RuntimeError, match="exited with code"):
+            pool(controller, s, noise, A)
+
+
+def test_anytime_redraws_when_k_grows(rexrov2, static_task, controller_config):
+    # Every sample keeps its own parameter set when adapt raises k.
+    rexrov2 = dict(rexrov2, randomize={"seed": 0, "linear_damping": {"dist": "uniform", "low": 0.5, "high": 1.5}})
+    config = dict(controller_config, type="anytime_controller", chunk=16, k_max=128)
+    controller = make_controller(rexrov2, static_task, config, k=64)
+    assert controller.model.rMass.shape[0] == 2*64
+    controller.sampleTime = 1e-9
+    controller.adapt()
+    assert controller.k == 128
+    assert controller.model.rMass.shape[0] == 2*128
+    controller.select_draws(2, 112, 16)
+    assert int(torch.max(controller.model.rIndex)) == 2*128 - 1
+    controller.select_draws(2, 0, 0)
+
+    controller.model.resample(2*64)
+    with pytest.raises(RuntimeError, match="parameter sets"):
+        controller.select_draws(2, 0, 16)
@@ -0,0 +1,67 @@
+import torch
+
+from controllers.mppi_base import Update
+from utils import dtype
+
+
+def test_threshold_masks_gathered_samples_per_vehicle():
+    # Vehicle 0 keeps 4 samples, vehicle 1 only its best one: vehicle 1
+    # gathers 4 samples but only the best may contribute.
+    update = Update(torch.tensor(1., dtype=dtype), threshold=0.1)
+    costs = torch.tensor([[0., 0., 0., 0., 10., 10., 10., 10.],
+                          [0., 10., 10., 10., 10., 10., 10., 10.]], dtype=dtype)
+    noise = torch.randn(2, 8, 3, 6, 1, dtype=dtype)
+
+    weighted, _, ess = update(costs, noise)
+
+    assert torch.allclose(weighted[0], torch.mean(noise[0, :4], dim=0))
+    assert torch.equal(weighted[1], noise[1, 0])
+    assert torch.allclose(ess, torch.tensor([4., 1.], dtype=dtype))
+
+
+def reference(costs, noise, lam, norm=False):
+    # Min shift, exponential and normalization of the weights.
+    shift = costs - torch.min(costs, dim=-1, keepdim=True)[0]
+    if norm:
+        shift = shift/torch.max(shift, dim=-1, keepdim=True)[0]
+    exp = torch.exp(-shift/lam)
+    eta = torch.sum(exp, dim=-1)
+    w = exp/eta[:, None]
+    return torch.einsum("nk,nk...->n...", w, noise), eta
+
+
+def test_log_sum_exp_matches_normalized_exponentials():
+    torch.manual_seed(0)
+    lam = 2.
+    update = Update(torch.tensor(lam, dtype=dtype))
+    costs = 10.*torch.rand(2, 32, dtype=dtype)
+    noise = torch.randn(2, 32, 3, 6, 1, dtype=dtype)
+
+    weighted, eta, _ = update(costs, noise)
+    ref, refEta = reference(costs, noise, lam)
+
+    assert torch.allclose(weighted, ref, rtol=1e-12, atol=1e-14)
+    assert torch.allclose(eta, refEta, rtol=1e-12, atol=0.)
+
+
+def test_norm_scales_the_costs():
+    torch.manual_seed(0)
+    lam = 0.5
+    costs = 1e3*torch.rand(2, 32, dtype=dtype)
+    noise = torch.randn(2, 32, 3, 6, 1, dtype=dtype)
+
+    weighted, _, _ = Update(torch.tensor(lam, dtype=dtype), norm=True)(costs, noise)
+    plain, _, _ = Update(torch.tensor(lam, dtype=dtype))(costs, noise)
+
+    assert torch.allclose(weighted, reference(costs, noise, lam, norm=True)[0], rtol=1e-12, atol=1e-14)
+    assert not torch.allclose(weighted, plain)
+
+
+def test_effective_sample_size():
+    update = Update(torch.tensor(1., dtype=dtype))
+    costs = torch.tensor([[3.]*16, [0.] + [1e3]*15], dtype=dtype)
+    noise = torch.randn(2, 16, 3, 6, 1, dtype=dtype)
+
+    _, _, ess = update(costs, noise)
+
+    assert torch.allclose(ess, torch.tensor([16., 1.], dtype=dtype), rtol=1e-12, atol=0.)
@@ -8,6 +8,12 @@ import warnings
 npdtype= np.double
 dtype = torch.double
 
+# Rollout dtype of the controller precisions. mixed rolls out in float32
+# and reduces the update in float64.
+precisions = {"float64": torch.double,
+              "float32": torch.float,
+              "mixed": torch.float}
+
 def load_param(yaml_file):
     with open(yaml_file, "r") as stream:
         dict = yaml.safe_load(stream)